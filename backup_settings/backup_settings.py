@@ -9,27 +9,327 @@ from sip import template_render  #  Needed for working with web.py templates
 from webpages import ProtectedPage  # Needed for security
 from helpers import read_log
 from pathlib import Path
+import hashlib
 import json  # for working with data file
+import os
+import tarfile
+import zlib
 
 # Add new URLs to access classes in this plugin.
 # fmt: off
 urls.extend([
     u"/backup", u"plugins.backup_settings.backup",
-    u"/download", u"plugins.backup_settings.download"
+    u"/download", u"plugins.backup_settings.download",
+    u"/backup-snapshot", u"plugins.backup_settings.snapshot",
+    u"/backup-snapshots", u"plugins.backup_settings.snapshots",
+    u"/backup-snapshot-restore", u"plugins.backup_settings.snapshot_restore",
+    u"/backup-snapshot-prune", u"plugins.backup_settings.snapshot_prune"
     ])
 # fmt: on
 
 # Add this plugin to the PLUGINS menu ["Menu Name", "URL"], (Optional)
 gv.plugin_menu.append([_(u"Backup/Restore Settings"), u"/backup"])
 
+CHUNK_SIZE = 64 * 1024
+RESTORE_POINT = "__restorePoint"
+SNAPSHOT_DIR = "./data/backup_snapshots"
+
+
+def data_files():
+    """(archive name, path) of every data file included in a backup."""
+    for path in sorted(Path('./data').glob('**/*.json')):
+        name = str(path.relative_to('data'))
+        if name.startswith("backup_snapshots" + os.sep):
+            continue
+        yield name, str(path)
+
+
+def _tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def tar_stream(restorePoint):
+    """
+    Generate a .tar.gz of the data files in chunks. Each file is copied as
+    raw bytes CHUNK_SIZE at a time, so memory use does not grow with the
+    size of the log.
+    """
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+
+    point = restorePoint.encode("utf-8")
+    yield gz.compress(_tar_header(RESTORE_POINT, len(point), time.time()) + point + b"\0" * (-len(point) % 512))
+
+    for name, path in data_files():
+        try:
+            f = open(path, "rb")
+        except IOError as e:
+            print(f"Failed to backup {name} {e}")
+            continue
+        with f:
+            size = os.fstat(f.fileno()).st_size  # a growing log is cut here
+            print("Backing up " + name)
+            yield gz.compress(_tar_header(name, size, os.fstat(f.fileno()).st_mtime))
+            remaining = size
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:  # file shrank, keep the archive consistent
+                    chunk = b"\0" * remaining
+                remaining -= len(chunk)
+                out = gz.compress(chunk)
+                if out:
+                    yield out
+            yield gz.compress(b"\0" * (-size % 512))
+
+    yield gz.compress(b"\0" * 1024) + gz.flush()  # end of archive
+
+
+def _safe_path(name):
+    """Path under ./data for an archive member, None if it would escape."""
+    base = os.path.abspath("./data")
+    path = os.path.abspath(os.path.join(base, name))
+    if not path.startswith(base + os.sep):
+        return None
+    return path
+
+
+def _write_file(path, chunks):
+    """Write chunks to a temporary file next to path, then rename over it."""
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp, path)
+
+
+def _read_chunks(f):
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def restore_tar(fileobj):
+    """Restore data files from a .tar.gz stream. Returns the restore point."""
+    restorePoint = ""
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            src = tar.extractfile(member)
+            if member.name == RESTORE_POINT:
+                restorePoint = src.read().decode("utf-8")
+                continue
+            path = _safe_path(member.name)
+            if path is None:
+                print("Skipping " + member.name)
+                continue
+            print("Restoring " + member.name)
+            _write_file(path, _read_chunks(src))
+    return restorePoint
+
+
+def restore_json(data):
+    """Restore data files from the single JSON file format."""
+    restorePoint = ""
+    # break the master data into individual components corresponding to files
+    for d in data:
+        if d == RESTORE_POINT:
+            restorePoint = data[RESTORE_POINT]
+        elif d == "log":
+            print("Restoring log.json")
+            _write_file(
+                "./data/log.json",
+                ((json.dumps(r) + "\n").encode("utf-8") for r in data["log"]),
+            )
+        else:
+            path = _safe_path(d + ".json")
+            if path is None:
+                continue
+            print("Restoring " + d + ".json")
+            _write_file(
+                path, [json.dumps(data[d], indent=4, sort_keys=True).encode("utf-8")]
+            )
+    return restorePoint
+
+
+class SnapshotStore(object):
+    """
+    Content addressed snapshots of the data files.
+    Each file is stored once per distinct content as blobs/xx/<sha256> and
+    every restore point is a small manifest in points/ mapping file names
+    to hashes, so a snapshot only copies files that changed. Hashes of
+    unchanged files (same size and mtime) are reused from index.json.
+    """
+
+    def __init__(self, root=SNAPSHOT_DIR):
+        self.root = root
+        self.blobs = os.path.join(root, "blobs")
+        self.points = os.path.join(root, "points")
+        self.index_path = os.path.join(root, "index.json")
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _hash(self, path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in _read_chunks(f):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _store_blob(self, path, digest):
+        """Copy a file into the blob store unless that content is already there."""
+        blob = self._blob_path(digest)
+        if os.path.exists(blob):
+            return False
+        with open(path, "rb") as f:
+            _write_file(blob, _read_chunks(f))
+        # the file may have changed while copying, keep the blob only if it matches
+        if self._hash(blob) != digest:
+            os.remove(blob)
+            raise IOError("file changed during snapshot: " + path)
+        return True
+
+    def list(self):
+        """Restore points, newest first."""
+        try:
+            names = os.listdir(self.points)
+        except OSError:
+            return []
+        def order(name):  # "<time>" then "<time>-1", "<time>-2", ...
+            base, _, n = name[:-5].partition("-")
+            return base, int(n) if n.isdigit() else 0
+
+        points = []
+        for name in sorted(names, key=order, reverse=True):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.points, name), "r") as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError):
+                continue
+            points.append(
+                {
+                    "id": name[:-5],
+                    "restorePoint": manifest.get(RESTORE_POINT, ""),
+                    "files": len(manifest["files"]),
+                }
+            )
+        return points
+
+    def manifest(self, point):
+        if not point or os.sep in point or point.startswith("."):
+            raise ValueError("invalid restore point")
+        with open(os.path.join(self.points, point + ".json"), "r") as f:
+            return json.load(f)
+
+    def create(self, restorePoint):
+        """
+        Take a snapshot. Returns (point id, number of new blobs). If nothing
+        changed since the latest point that point is returned instead.
+        """
+        index = self._load_index()
+        new_index = {}
+        files = {}
+        stored = 0
+        for name, path in data_files():
+            try:
+                st = os.stat(path)
+                key = [st.st_size, st.st_mtime_ns]
+                cached = index.get(name)
+                if cached and cached[:2] == key:
+                    digest = cached[2]
+                else:
+                    digest = self._hash(path)
+                if self._store_blob(path, digest):
+                    stored += 1
+            except (IOError, OSError) as e:
+                print(f"Failed to snapshot {name} {e}")
+                continue
+            files[name] = digest
+            new_index[name] = key + [digest]
+        _write_file(self.index_path, [json.dumps(new_index).encode("utf-8")])
+
+        latest = self.list()
+        if latest and self.manifest(latest[0]["id"])["files"] == files:
+            return latest[0]["id"], 0
+
+        point = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        n = 1
+        while os.path.exists(os.path.join(self.points, point + ".json")):
+            point = "%s-%d" % (point.split("-")[0], n)
+            n += 1
+        manifest = {RESTORE_POINT: restorePoint, "files": files}
+        _write_file(
+            os.path.join(self.points, point + ".json"),
+            [json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8")],
+        )
+        return point, stored
+
+    def restore(self, point):
+        """Copy every file of a restore point back into ./data. Returns its restore point."""
+        manifest = self.manifest(point)
+        for name, digest in manifest["files"].items():
+            path = _safe_path(name)
+            if path is None:
+                continue
+            print("Restoring " + name)
+            with open(self._blob_path(digest), "rb") as f:
+                _write_file(path, _read_chunks(f))
+        return manifest.get(RESTORE_POINT, point)
+
+    def prune(self, keep):
+        """Keep the newest `keep` points and delete blobs no longer referenced."""
+        points = self.list()
+        for p in points[keep:]:
+            os.remove(os.path.join(self.points, p["id"] + ".json"))
+        used = set()
+        for p in points[:keep]:
+            used.update(self.manifest(p["id"])["files"].values())
+        removed = 0
+        if os.path.isdir(self.blobs):
+            for sub in os.listdir(self.blobs):
+                folder = os.path.join(self.blobs, sub)
+                for digest in os.listdir(folder):
+                    if digest not in used:
+                        os.remove(os.path.join(folder, digest))
+                        removed += 1
+        return max(0, len(points) - keep), removed
+
+
+snapshot_store = SnapshotStore()
+
+
 class download(ProtectedPage):
     """
-    Download all data files as a single JSON archive file.
+    Download all data files as a .tar.gz archive.
+    ?format=json gives the older single JSON file.
     """
 
     def GET(self):
+        restorePoint = time.strftime('%Y-%m-%dT%H:%M:%SZ', gv.nowt)
+        name = gv.sd['name'].replace(" ", "_")
+        if web.input(format="tar").format != "json":
+            web.header('Content-Type', 'application/gzip')
+            web.header('Content-disposition', 'attachment; filename=SIP-backup-%s-%s.tar.gz'%(name, restorePoint))
+            return tar_stream(restorePoint)
         try:
-            restorePoint = time.strftime('%Y-%m-%dT%H:%M:%SZ', gv.nowt)
             data = {
                 '__restorePoint' : restorePoint,
             }
@@ -50,7 +350,7 @@ class download(ProtectedPage):
                         data["log"] = read_log()
 
             web.header('Content-Type','text/json')
-            web.header('Content-disposition', 'attachment; filename=SIP-backup-%s-%s.json'%(gv.sd['name'].replace(" ", "_"),restorePoint))
+            web.header('Content-disposition', 'attachment; filename=SIP-backup-%s-%s.json'%(name, restorePoint))
             return json.dumps(data)  # return data as json txt file
         except IOError:  # If file does not exist return empty value
             raise web.seeother('/backup?success=false')
@@ -63,31 +363,68 @@ class backup(ProtectedPage):
     def POST(self):
         try:
             upload = web.input(myfile={})
-            data = json.loads(upload['myfile'].file.read())
-            # break the master data into individual components corresponding to files
-
-            for d in data:
-                if d == "__restorePoint":
-                    restorePoint = data["__restorePoint"]
-                elif d == "log":
-                    print("Restoring log.json")
-                    log = data["log"]
-                    lines = []
-                    for r in log:
-                        lines.append(json.dumps(r) + "\n")
-                        with open("./data/log.json", "w", encoding="utf-8") as f:
-                            f.writelines(lines)
-                else:
-                    print("Restoring " + d + ".json")
-                    with open(u"./data/" + d + ".json", u"w") as f:
-                        json.dump(data[d], f, indent=4, sort_keys=True)
-
-            raise web.seeother('/backup?success=true&restorePoint=' + restorePoint)
-        except IOError:
+            f = upload['myfile'].file
+            magic = f.read(2)
+            f.seek(0)
+            if magic == b"\x1f\x8b":  # gzip: .tar.gz archive
+                restorePoint = restore_tar(f)
+            else:
+                restorePoint = restore_json(json.loads(f.read()))
+        except (IOError, ValueError, tarfile.TarError) as e:
+            print(f"Restore failed {e}")
             raise web.seeother('/backup?success=false')
+        raise web.seeother('/backup?success=true&restorePoint=' + restorePoint)
 
 
     def GET(self):
         user_data = web.input(success="unknown", restorePoint="")
-        status = {"success" : user_data.success, "restorePoint" : user_data.restorePoint }  # report the status
+        status = {"success" : user_data.success, "restorePoint" : user_data.restorePoint,
+                  "snapshots" : snapshot_store.list() }  # report the status
         return template_render.backup_settings(status)  # open backup/restore page
+
+
+class snapshot(ProtectedPage):
+    """Take an incremental snapshot of the data files."""
+
+    def GET(self):
+        restorePoint = time.strftime('%Y-%m-%dT%H:%M:%SZ', gv.nowt)
+        point, stored = snapshot_store.create(restorePoint)
+        if web.input(format="").format == "json":
+            web.header('Content-Type', 'application/json')
+            return json.dumps({"id": point, "stored": stored})
+        raise web.seeother('/backup')
+
+
+class snapshots(ProtectedPage):
+    """List snapshot restore points as JSON."""
+
+    def GET(self):
+        web.header('Content-Type', 'application/json')
+        return json.dumps(snapshot_store.list())
+
+
+class snapshot_restore(ProtectedPage):
+    """Restore the data files from a snapshot."""
+
+    def GET(self):
+        try:
+            restorePoint = snapshot_store.restore(web.input(point="").point)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            print(f"Snapshot restore failed {e}")
+            raise web.seeother('/backup?success=false')
+        raise web.seeother('/backup?success=true&restorePoint=' + restorePoint)
+
+
+class snapshot_prune(ProtectedPage):
+    """Delete all but the newest ?keep= snapshots (default 24) and unused blobs."""
+
+    def GET(self):
+        try:
+            keep = max(1, int(web.input(keep="24").keep))
+        except ValueError:
+            keep = 24
+        points, blobs = snapshot_store.prune(keep)
+        if web.input(format="").format == "json":
+            web.header('Content-Type', 'application/json')
+            return json.dumps({"points": points, "blobs": blobs})
+        raise web.seeother('/backup')
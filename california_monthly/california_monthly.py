@@ -4,7 +4,7 @@
 from __future__ import print_function
 
 # standard library imports
-import json
+import datetime
 import time
 
 # local module imports
@@ -14,6 +14,7 @@ from sip import template_render
 from urls import urls  # Get access to SIP's URLs
 import web
 from webpages import ProtectedPage
+import monthly_levels
 
 
 # Add a new url to open the data entry page.
@@ -30,23 +31,15 @@ urls.extend(
 gv.plugin_menu.append([_(u"California Monthly"), u"/cama"])
 
 
-def set_wl(month):
+levels = monthly_levels.MonthlyLevels(u"./data/ca_levels.json")
+
+
+def set_wl(day=None):
     """Adjust irrigation time by percent per month."""
-    
-    try:
-        with open(
-            u"./data/ca_levels.json", u"r"
-        ) as f:  # Read the monthly percentages from file
-            levels = json.load(f)
-    except IOError:  # If file does not exist
-        levels = [100] * 12
-        with open(
-            u"./data/ca_levels.json", u"w"
-        ) as f:  # write default percentages to file
-            json.dump(levels, f)
-    gv.sd[u"wl_monthly_adj"] = levels[
-        month - 1
-    ]  # Set the water level % (levels list is zero based).
+
+    if day is None:
+        day = datetime.date.today()
+    gv.sd[u"wl_monthly_adj"] = levels.level(day)  # Set the water level %
     print(
         u"Monthly Adjust: Setting water level to {}%".format(
             gv.sd[u"wl_monthly_adj"]
@@ -59,19 +52,7 @@ class monthly_percent(ProtectedPage):
     """Load an html page for calculating or entering monthly irrigation time adjustments"""
 
     def GET(self):
-        try:
-            with open(
-                u"./data/ca_levels.json", u"r"
-            ) as f:  # Read the monthly percentages from file
-                levels = json.load(f)
-        except IOError as e:  # If file does not exist
-            print(u"File error: ", e)
-            levels = [100] * 12
-            with open(
-                u"./data/ca_levels.json", u"w"
-            ) as f:  # write default percentages to file
-                json.dump(levels, f)
-        return template_render.california_monthly(levels)
+        return template_render.california_monthly(levels.levels, levels.interpolate)
 
 
 class calc_percents(ProtectedPage):
@@ -105,15 +86,15 @@ class calc_percents(ProtectedPage):
         else:
             raise web.seeother(u"/cama")
         max_eto = max(z_vals)
-        levels = []
+        calc_levels = []
         for i in range(12):
-            levels.append(int(round((z_vals[i] / max_eto) * 100)))
+            calc_levels.append(int(round((z_vals[i] / max_eto) * 100)))
         if u"etoZone" in qdict and qdict[u"etoZone"]:
-            levels.append(int(qdict[u"etoZone"]))
+            calc_levels.append(int(qdict[u"etoZone"]))
         else:
-            levels.append(u"")
+            calc_levels.append(u"")
 
-        return template_render.california_monthly(levels)
+        return template_render.california_monthly(calc_levels, levels.interpolate)
 
 
 class update_percents(ProtectedPage):
@@ -143,23 +124,23 @@ class update_percents(ProtectedPage):
         else:
             vals.append(0)
         try:
-            with open(
-                u"./data/ca_levels.json", u"w"
-            ) as f:  # write the monthly percentages to file
-                json.dump(vals, f)
-        except Exeption as e:
+            levels.save(vals)  # write the monthly percentages to file
+            levels.set_interpolate(u"interpolate" in qdict)
+        except (IOError, OSError) as e:
             print(u"File error: ", e)
-        set_wl(gv.sd["month"])
+        set_wl()
         raise web.seeother("/")
 
 def update_wl_monthly(name, **kw):
     month = time.localtime().tm_mon
     if not u"month" in gv.sd:
         gv.sd["month"] = month
-        set_wl(month)
+        set_wl()
     elif  month != gv.sd["month"]:
         gv.sd["month"] = month
-        set_wl(month)
+        set_wl()
+    elif levels.interpolate:  # Level changes every day
+        set_wl()
 
 # check for new month each day
 new_day = signal(u"new_day")
@@ -4,8 +4,13 @@
 from __future__ import print_function
 
 # standard library imports
+from collections import deque
 import json
+import os
+import select
+import signal as os_signal
 import subprocess
+from threading import Condition, Thread
 import time
 
 # local module imports
@@ -23,6 +28,7 @@ urls.extend(
         u"/clic", u"plugins.cli_control.settings",
         u"/clicj", u"plugins.cli_control.settings_json",
         u"/clicu", u"plugins.cli_control.update",
+        u"/clics", u"plugins.cli_control.status_json",
     ]
 )
 # fmt: on
@@ -56,21 +62,177 @@ else:
     gv.use_gpio_pins = True
 
 
+class ShellHelper(object):
+    """
+    A persistent /bin/sh that runs commands sent on its stdin, so each
+    command forks from a small shell instead of from SIP. Commands get
+    shell syntax (quotes, pipes) and their output is discarded.
+    """
+
+    MARK = u"__cli_control_done__"
+
+    def __init__(self):
+        self.proc = None
+
+    def _start(self):
+        self.proc = subprocess.Popen(
+            [u"/bin/sh"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,  # so a timeout can kill the whole group
+            universal_newlines=True,
+            bufsize=1,
+        )
+
+    def stop(self):
+        if self.proc is not None:
+            try:
+                os.killpg(self.proc.pid, os_signal.SIGKILL)
+            except OSError:
+                pass
+            self.proc.wait()
+            self.proc = None
+
+    def run(self, command, timeout):
+        """Returns the exit code, or None on timeout."""
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        self.proc.stdin.write(
+            u"{ %s\n} </dev/null >/dev/null 2>&1; echo %s $?\n" % (command, self.MARK)
+        )
+        self.proc.stdin.flush()
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.proc.stdout], [], [], remaining)[0]:
+                self.stop()
+                return None
+            line = self.proc.stdout.readline()
+            if not line:  # shell died
+                self.stop()
+                return -1
+            if line.startswith(self.MARK):
+                return int(line.split()[1])
+
+
+class CommandExecutor(object):
+    """
+    Runs station commands on a small pool of worker threads.
+    Commands for different stations run concurrently, up to `workers` at
+    a time; commands for one station always run in the order queued.
+    Each command is limited to `timeout` seconds. Exit codes and
+    durations are kept in `last` (per station) and `history`.
+    """
+
+    def __init__(self, workers=4, timeout=30, helper=False):
+        self.timeout = timeout
+        self.helper = helper
+        self.last = {}
+        self.history = deque(maxlen=50)
+        self._cond = Condition()
+        self._pending = {}  # station -> deque of (state, command)
+        self._ready = deque()  # stations with pending commands and none running
+        self._busy = set()  # stations with a command running
+        for n in range(workers):
+            t = Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def submit(self, station, state, command):
+        with self._cond:
+            queue = self._pending.setdefault(station, deque())
+            queue.append((state, command))
+            if len(queue) == 1 and station not in self._busy:
+                self._ready.append(station)
+                self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            while not self._ready:
+                self._cond.wait()
+            station = self._ready.popleft()
+            self._busy.add(station)
+            return station, self._pending[station].popleft()
+
+    def _done(self, station):
+        with self._cond:
+            self._busy.discard(station)
+            if self._pending[station]:
+                self._ready.append(station)
+                self._cond.notify()
+
+    def _run(self, command, shell):
+        if shell is not None:
+            return shell.run(command, self.timeout)
+        proc = subprocess.Popen(command.split(), start_new_session=True)
+        try:
+            return proc.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, os_signal.SIGKILL)
+            proc.wait()
+            return None
+
+    def _work(self):
+        shell = ShellHelper() if self.helper else None
+        while True:
+            station, (state, command) = self._take()
+            start = time.time()
+            try:
+                code = self._run(command, shell)
+                error = u"timeout" if code is None else u""
+            except Exception as e:
+                code = None
+                error = str(e)
+            result = {
+                u"station": station + 1,
+                u"state": state,
+                u"command": command,
+                u"exit": code,
+                u"error": error,
+                u"duration": round(time.time() - start, 3),
+                u"time": start,
+            }
+            self.last[station] = result
+            self.history.appendleft(result)
+            if error:
+                print(u"CLI control: station {} {} command failed: {}".format(station + 1, state, error))
+            self._done(station)
+
+
+def executor_settings():
+    """(workers, timeout, helper) from the saved commands file"""
+    try:
+        workers = max(1, int(commands.get(u"workers", 4)))
+    except (TypeError, ValueError):
+        workers = 4
+    try:
+        timeout = max(1, float(commands.get(u"timeout", 30)))
+    except (TypeError, ValueError):
+        timeout = 30
+    return workers, timeout, bool(commands.get(u"helper", 0))
+
+
+executor = CommandExecutor(*executor_settings())
+
+
 #### output command when signal received ####
 def on_zone_change(name, **kw):
-    """ Send command when core program signals a change in station state."""
+    """ Queue commands when core program signals a change in station state."""
     global prior
     if gv.srvals != prior:  # check for a change
+        if len(prior) < len(gv.srvals):
+            prior += [0] * (len(gv.srvals) - len(prior))
         for i in range(len(gv.srvals)):
             if gv.srvals[i] != prior[i]:  #  this station has changed
                 if gv.srvals[i]:  # station is on
                     command = commands[u"on"][i]
                     if command:  #  If there is a command for this station:
-                        subprocess.call(command.split())
+                        executor.submit(i, u"on", command)
                 else:
                     command = commands[u"off"][i]
                     if command:
-                        subprocess.call(command.split())
+                        executor.submit(i, u"off", command)
         prior = gv.srvals[:]
     return
 
@@ -87,7 +249,7 @@ class settings(ProtectedPage):
     """Load an html page for entering cli_control commands"""
 
     def GET(self):
-        return template_render.cli_control(commands)
+        return template_render.cli_control(commands, list(executor.history))
 
 
 class settings_json(ProtectedPage):
@@ -99,6 +261,20 @@ class settings_json(ProtectedPage):
         return json.dumps(commands)
 
 
+class status_json(ProtectedPage):
+    """Returns recent command results in JSON format"""
+
+    def GET(self):
+        web.header(u"Access-Control-Allow-Origin", u"*")
+        web.header(u"Content-Type", u"application/json")
+        return json.dumps(
+            {
+                u"last": [executor.last[k] for k in sorted(executor.last)],
+                u"history": list(executor.history),
+            }
+        )
+
+
 class update(ProtectedPage):
     """Save user input to cli_control.json file"""
 
@@ -124,6 +300,9 @@ class update(ProtectedPage):
         else:
             commands[u"gpio"] = 0
             gv.use_gpio_pins = True
+        commands[u"workers"] = qdict.get(u"workers", u"4")
+        commands[u"timeout"] = qdict.get(u"timeout", u"30")
+        commands[u"helper"] = 1 if u"helper" in qdict else 0
         with open(u"./data/cli_control.json", u"w") as f:  # write the settings to file
             json.dump(commands, f, indent=4)
         raise web.seeother(u"/restart")
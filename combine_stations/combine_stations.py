@@ -3,7 +3,6 @@
 
 # Python 2/3 compatibility imports
 from __future__ import print_function
-from six.moves import range
 
 # standard library imports
 import json  # for working with data files
@@ -33,6 +32,49 @@ urls.extend([
 gv.plugin_menu.append([_(u"Combine Stations"), u"/combine-sp"])
 
 com_stations = {}
+virt_map = {}  # vid: ([station indexes], [(board, bitmask), ...]) compiled from com_stations
+virt_ids = []  # configured virtual station indexes, in order
+
+def virtual_boards():
+    """
+    Number of boards at the end of the station list used for virtual stations.
+    """
+    try:
+        vboards = int(com_stations.get(u"vboards", 1))
+    except ValueError:
+        vboards = 1
+    return max(1, min(vboards, gv.sd[u"nbrd"] - 1))
+
+def compile_settings(name=None, **kw):
+    """
+    Turn the comma separated station lists into index lists and per board
+    bitmasks so activating a virtual station needs no parsing.
+    Also called on option changes since the board count may have changed.
+    """
+    global virt_map, virt_ids
+    first = (gv.sd[u"nbrd"] - virtual_boards()) * 8  # first virtual station
+    compiled = {}
+    for key, val in com_stations.items():
+        if not key.isdigit() or not val.strip():
+            continue
+        vid = int(key)
+        if vid < first or vid >= gv.sd[u"nst"]:
+            continue
+        stn_list = []
+        masks = {}
+        for i in val.split(","):
+            try:
+                sid = int(i) - 1
+            except ValueError:
+                print(u"combine_stations: ignoring '{}' in V{}".format(i.strip(), vid + 1))
+                continue
+            if sid < 0 or sid >= first:  # only real stations can be combined
+                continue
+            stn_list.append(sid)
+            masks[sid // 8] = masks.get(sid // 8, 0) | 1 << (sid % 8)
+        compiled[vid] = (stn_list, sorted(masks.items()))
+    virt_map = compiled
+    virt_ids = sorted(compiled)
 
 def load_settings():
     """
@@ -46,6 +88,8 @@ def load_settings():
             com_stations = json.load(f)
             try:
                 for key in com_stations:
+                    if not key.isdigit():
+                        continue
                     if com_stations[key]:
                         gv.snames[int(key)] = u'V' + str(int(key) + 1) + u' runs ' +  com_stations[key]
                     else:
@@ -54,25 +98,22 @@ def load_settings():
                 pass
     except IOError:  # If file does not exist return empty value
         com_stations = {}
+    compile_settings()
         
-def set_stations(virt):
+def set_stations(vid):
     """
     Activate stations associated with a virtual station.
     Selected stations wil run concurrently.
     """
-    vid = ((gv.sd[u'nbrd'] - 1) * 8) + virt # vid = key of station group in com_stations dict.
-    stn_list = [int(i) - 1 for i in com_stations[str(vid)].split(",")]  
+    stn_list, masks = virt_map[vid]
+    for b, mask in masks:
+        gv.sbits[b] |= mask #  station bits, used to display stations that are on in UI (list of bytes, one byte per board)
     for sid in stn_list:
         gv.srvals[sid] = 1 #  set gv.srvals on for stations in this group
-    for b in range(gv.sd[u"nbrd"] - 1): #  don't include virtual stations
-        for s in range(8): # for each station per board
-            sidx = b * 8  + s
-            if gv.srvals[sidx]: #  If this station should be on
-                gv.sbits[b] |= 1 << s #  station bits, used to display stations that are on in UI (list of bytes, one byte per board)                
-                gv.ps[sidx][0] = 1
-                gv.rs[sidx] =  gv.rs[vid]
-                if not gv.sd[u'mm']: #  If under program control
-                    gv.ps[sidx][1] = gv.rs[vid][2]              
+        gv.ps[sid][0] = 1
+        gv.rs[sid] = gv.rs[vid]
+        if not gv.sd[u'mm']: #  If under program control
+            gv.ps[sid][1] = gv.rs[vid][2]
     set_output()
 
 class settings(ProtectedPage):
@@ -80,7 +121,9 @@ class settings(ProtectedPage):
     Load an html page for entering plugin settings.
     """
     def GET(self):
-        return template_render.combine_stations(com_stations)  # open settings page
+        return template_render.combine_stations(
+            com_stations, virtual_boards()
+        )  # open settings page
 
 
 class save_settings(ProtectedPage):
@@ -102,8 +145,7 @@ class save_settings(ProtectedPage):
 def modify_zone_change(name, **kw):
     global prior_virt
     if gv.sd[u'seq']: #  if in sequential mode.      
-        virtuals = gv.srvals[-8:]
-        virt = next((i for i, x in enumerate(virtuals) if x), None)
+        virt = next((vid for vid in virt_ids if gv.srvals[vid]), None)
         if (virt is not None
             and virt != prior_virt
             ):
@@ -121,6 +163,10 @@ def clear_prior_virt(name, **kw):
 complete = signal(u"station_completed")
 complete.connect(clear_prior_virt)
 
+### Recompile when the number of boards may have changed ###
+options = signal(u"option_change")
+options.connect(compile_settings)
+
 
 #  Run when plugin is loaded
 load_settings()
@@ -15,9 +15,25 @@ function background_svg(left_edge, right_edge) {
         "' height='100' fill='rgba(0,0,139,.15)'/%3E%3C/svg%3E\")";
 }
 
+// Sun times by "YYYY-MM-DD", fetched a month at a time
+var diurnal_display_days = {};
+
+function diurnal_display_get(day, callback) {
+    if (day in diurnal_display_days) {
+        callback(diurnal_display_days[day]);
+        return;
+    }
+    $.get( "/diurnal_display-data", {"start" : day.substring(0, 8) + "01", "days" : 31}, function( month_data ) {
+        for (var i = 0; i < month_data.length; i++) {
+            diurnal_display_days[month_data[i].date] = month_data[i];
+        }
+        callback(diurnal_display_days[day]);
+    });
+}
+
 function diurnal_display_update_schedule() {
     if ($('#displayScheduleDate').length > 0) {
-        $.get( "/diurnal_display-data", {"date" : toXSDate(displayScheduleDate)}, function( diurnal_data ) {
+        diurnal_display_get(toXSDate(displayScheduleDate), function( diurnal_data ) {
             $(".stationSchedule .scheduleTick").each( function() {
                 var cellTime = parseInt($(this).attr("data")) * 60;
                 if (cellTime < diurnal_data.sunrise + 60) {
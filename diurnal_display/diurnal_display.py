@@ -2,25 +2,18 @@
 # -*- coding: utf-8 -*-
 
 # standard library imports
+import calendar
 import json  # for working with data file
-from threading import Thread
-from time import sleep
+import math
+from threading import Lock
 
 # local module imports
-from blinker import signal
 import gv  # Get access to SIP's settings
 from sip import template_render  #  Needed for working with web.py templates
 from urls import urls  # Get access to SIP's URLs
 import web  # web.py framework
 from webpages import ProtectedPage  # Needed for security
-from datetime import datetime, timezone
-import subprocess
-try:
-    from suncalc import get_times
-except ModuleNotFoundError:
-    command = "pip install suncalc"
-    subprocess.call(command.split())
-    from suncalc import get_times
+from datetime import date, datetime, timedelta
 
 # Add new URLs to access classes in this plugin.
 # fmt: off
@@ -41,51 +34,146 @@ gv.plugin_scripts.append("diurnal_display.js")
 # Set a default location, roughly estimated to users time zone
 default_settings = {"lat" : 45, "lon" : -gv.tz_offset/3600*15 }
 
-# Package up data for access by javascript
-def plugin_data(params):
-    # load settings for lat/lon params
+diurnal_settings = {}
+# year -> list of (sunrise, sunset) in UTC minutes from midnight, one per day
+sun_tables = {}
+sun_lock = Lock()
+MAX_RANGE_DAYS = 366
+
+RAD = math.pi / 180
+J1970 = 2440588
+J2000 = 2451545
+J0 = 0.0009
+OBLIQUITY = RAD * 23.4397
+SUN_ALTITUDE = RAD * -0.833  # upper limb at the horizon, with refraction
+
+
+def load_settings():
+    global diurnal_settings
     try:
         with open(
             u"./data/diurnal_display.json", u"r"
         ) as f:  # Read settings from json file if it exists
-            settings = json.load(f)
+            diurnal_settings = json.load(f)
     except IOError:  # If file does not exist return empty value
-        settings = default_settings
+        diurnal_settings = default_settings
+
+
+def sun_times(day, lat, lon):
+    """
+    Sunrise and sunset for a date at lat, lon, in UTC minutes from the
+    date's UTC midnight (may be below 0 or past 1440 far from Greenwich).
+    This is the algorithm used by suncalc. Returns (None, None) for polar
+    night and (0, 0) for midnight sun, as the sun does not cross the
+    horizon.
+    """
+    lw = RAD * -lon
+    phi = RAD * lat
+    midnight = calendar.timegm(day.timetuple()) / 86400.0 + J1970 - 0.5
+    d = midnight + 0.5 - J2000  # about local noon for lon 0
+
+    n = round(d - J0 - lw / (2 * math.pi))
+    ds = J0 + lw / (2 * math.pi) + n
+    m = RAD * (357.5291 + 0.98560028 * ds)  # solar mean anomaly
+    c = RAD * (1.9148 * math.sin(m) + 0.02 * math.sin(2 * m) + 0.0003 * math.sin(3 * m))
+    lng = m + c + RAD * 102.9372 + math.pi  # ecliptic longitude
+    dec = math.asin(math.sin(OBLIQUITY) * math.sin(lng))
+    noon = J2000 + ds + 0.0053 * math.sin(m) - 0.0069 * math.sin(2 * lng)
+
+    cos_w = (math.sin(SUN_ALTITUDE) - math.sin(phi) * math.sin(dec)) / (
+        math.cos(phi) * math.cos(dec)
+    )
+    if cos_w > 1:
+        return None, None
+    if cos_w < -1:
+        return 0, 0
+    w = math.acos(cos_w)
+    sunset = J2000 + J0 + (w + lw) / (2 * math.pi) + n
+    sunset += 0.0053 * math.sin(m) - 0.0069 * math.sin(2 * lng)
+    sunrise = noon - (sunset - noon)
+    return (
+        int(math.floor((sunrise - midnight) * 1440)),
+        int(math.floor((sunset - midnight) * 1440)),
+    )
+
+
+def build_table(year):
+    """Sun times for every day of year at the configured location"""
+    lat = float(diurnal_settings["lat"])
+    lon = float(diurnal_settings["lon"])
+    day = date(year, 1, 1)
+    table = []
+    while day.year == year:
+        table.append(sun_times(day, lat, lon))
+        day += timedelta(days=1)
+    return table
+
+
+def year_table(year):
+    """The table for year, built on first use (e.g. at year rollover)"""
+    table = sun_tables.get(year)
+    if table is None:
+        with sun_lock:
+            table = sun_tables.get(year)
+            if table is None:
+                table = build_table(year)
+                sun_tables[year] = table
+    return table
+
+
+def reset_tables():
+    """Rebuild the current year's table after the location changed"""
+    with sun_lock:
+        sun_tables.clear()
+    year_table(datetime.now().year)
+
+
+def local_minutes(utc_minutes):
+    """UTC minutes from midnight to local minutes of the day, 0 - 1439"""
+    return (utc_minutes - gv.tz_offset / 60) % (24 * 60)
+
+
+def day_data(day):
+    """Sunrise and sunset of a date in local minutes from midnight"""
+    sunrise, sunset = year_table(day.year)[day.timetuple().tm_yday - 1]
+    if sunrise is None:
+        # Polar night: dark all day
+        return {"sunrise": 24 * 60, "sunset": 0}
+    if sunrise == sunset:
+        # Midnight sun: light all day
+        return {"sunrise": 0, "sunset": 24 * 60}
+    return {"sunrise": local_minutes(sunrise), "sunset": local_minutes(sunset)}
+
+
+def parse_date(text):
+    parts = text.split("-")
+    return date(int(parts[0]), int(parts[1]), int(parts[2]))
+
 
+# Package up data for access by javascript
+def plugin_data(params):
     # load date param from url to establish date to test
-    if hasattr(params,"date"):
-        parts = params.date.split("-")
-        date = datetime(int(parts[0]), int(parts[1]), int(parts[2]))
+    if hasattr(params, "start"):
+        # Range query: start and end (inclusive) dates, or a number of days
+        start = parse_date(params.start)
+        if hasattr(params, "end"):
+            days = (parse_date(params.end) - start).days + 1
+        else:
+            days = int(getattr(params, "days", 1))
+        days = max(0, min(days, MAX_RANGE_DAYS))
+        result = []
+        for i in range(days):
+            day = start + timedelta(days=i)
+            data = day_data(day)
+            data["date"] = day.isoformat()
+            result.append(data)
+        return result
+
+    if hasattr(params, "date"):
+        day = parse_date(params.date)
     else:
-        date = datetime.now()
-    
-    # calculate the sunrise/sunset times
-    lon = float(settings["lon"])
-    lat = float(settings["lat"])
-    times = get_times(date.astimezone(timezone.utc), lon, lat)
-    sunrise_time = times["sunrise"]
-    sunset_time = times["sunset"]
-    #print([sunrise_time, sunset_time])
-    
-    # convert to minutes-since-midnight format to return
-    sunrise_minutes = sunrise_time.hour * 60 + sunrise_time.minute - gv.tz_offset/60
-    sunset_minutes = sunset_time.hour * 60 + sunset_time.minute - gv.tz_offset/60
-    
-    # normalize values that extend beyond midnight in one direction or the other
-    if (sunrise_minutes < 0):
-        sunrise_minutes += 24*60
-    if (sunrise_minutes >=24*60):
-        sunrise_minutes -= 24*60
-
-    if (sunset_minutes < 0):
-        sunset_minutes += 24*60
-    if (sunset_minutes >=24*60):
-        sunset_minutes -= 24*60
-    
-    return {
-        "sunrise" : sunrise_minutes,
-        "sunset" : sunset_minutes
-    }
+        day = datetime.now().date()
+    return day_data(day)
 
 
 class fetch_data(ProtectedPage):
@@ -95,7 +183,11 @@ class fetch_data(ProtectedPage):
 
     def GET(self):
         web.header("Content-Type", "application/json")
-        return json.dumps(plugin_data(web.input()))
+        try:
+            data = plugin_data(web.input())
+        except (ValueError, IndexError):
+            raise web.badrequest()
+        return json.dumps(data)
     
 ## Handle settings
 class settings(ProtectedPage):
@@ -104,14 +196,7 @@ class settings(ProtectedPage):
     """
 
     def GET(self):
-        try:
-            with open(
-                u"./data/diurnal_display.json", u"r"
-            ) as f:  # Read settings from json file if it exists
-                settings = json.load(f)
-        except IOError:  # If file does not exist return empty value
-            settings = default_settings
-        return template_render.diurnal_display(settings)  # open settings page
+        return template_render.diurnal_display(diurnal_settings)  # open settings page
 
 
 class save_settings(ProtectedPage):
@@ -122,11 +207,18 @@ class save_settings(ProtectedPage):
     """
 
     def GET(self):
+        global diurnal_settings
         qdict = (
             web.input()
         )  # Dictionary of values returned as query string from settings page.
         #        print qdict  # for testing
         with open(u"./data/diurnal_display.json", u"w") as f:  # Edit: change name of json file
             json.dump(qdict, f)  # save to file
+        diurnal_settings = dict(qdict)
+        reset_tables()
         raise web.seeother(u"/")  # Return user to home page.
 
+
+#  Run when plugin is loaded
+load_settings()
+reset_tables()
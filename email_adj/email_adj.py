@@ -3,20 +3,24 @@
 """ this plugin sends email to google gmail"""
 
 from __future__ import print_function
-from threading import Thread
+from threading import Lock, Timer
 from random import randint
+import gzip
+import io
 import json
 import time
 import os
 import sys
 import traceback
 
+from blinker import signal
 import web
 import gv  # Get access to SIP's settings
 from urls import urls  # Get access to SIP's URLs
 from sip import template_render
 from webpages import ProtectedPage
 from helpers import timestr
+import notify_outbox
 
 from email import encoders
 import smtplib
@@ -40,18 +44,30 @@ urls.extend(
 gv.plugin_menu.append([_(u"Email settings"), u"/emla"])
 
 ################################################################################
-# Main function loop:                                                          #
+# Event handlers:                                                              #
 ################################################################################
 
 
-class EmailSender(Thread):
+class EmailSender(object):
+    """
+    Queues emails on SIP events. Rain and program end are picked up from
+    the rain_changed, zone_change, station_completed and
+    running_program_change signals; delivery is done by the
+    notify_outbox worker.
+    """
+
     def __init__(self):
-        Thread.__init__(self)
-        self.daemon = True
-        self.start()
         self.status = u""
-
-        self._sleep_time = 0
+        self.dataeml = None
+        self.subject = u""
+        self.last_rain = 0
+        self.was_running = False
+        self.last_run = None  # gv.lrun of the last completed station
+        self._lock = Lock()
+        # Start some time later to prevent printing before startup information
+        self._starter = Timer(randint(3, 10), self.start)
+        self._starter.daemon = True
+        self._starter.start()
 
     def add_status(self, msg):
         if self.status:
@@ -61,119 +77,124 @@ class EmailSender(Thread):
         print(msg)
 
     def update(self):
-        self._sleep_time = 0
-
-    def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        """Reload the options after they were saved"""
+        if self.dataeml is not None:
+            self.dataeml = get_email_options()
 
     def try_mail(self, subject, text, attachment=None):
         self.status = u""
-        try:
-            email(subject, text, attachment)  # send email with attachment from
-            self.add_status(u"Email was sent: " + text)
-        except Exception as err:
-            self.add_status(u"Email was not sent! " + str(err))
+        notify_outbox.enqueue(
+            u"email_adj", {u"subject": subject, u"text": text, u"attach": attachment}
+        )
+        self.add_status(u"Email was queued: " + text)
 
-    def run(self):
-        time.sleep(
-            randint(3, 10)
-        )  # Sleep some time to prevent printing before startup information
+    def _guard(self, handler, *args):
+        try:
+            handler(*args)
+        except Exception:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            err_string = "".join(
+                traceback.format_exception(exc_type, exc_value, exc_traceback)
+            )
+            self.add_status(u"Email plugin encountered an error: " + err_string)
 
-        dataeml = get_email_options()  # load data from file
-        subject = u"Report from " + gv.sd[u"name"]  # Subject in email
-        last_rain = 0
-        was_running = False
+    def start(self):
+        self.dataeml = get_email_options()  # load data from file
+        self.subject = u"Report from " + gv.sd[u"name"]  # Subject in email
 
         self.status = u""
         self.add_status(u"Email plugin is started")
 
-        if dataeml[u"emllog"] != u"off":  # if eml_log send email is enable (on)
+        if self.dataeml[u"emllog"] != u"off":  # if eml_log send email is enable (on)
             body = (
                 u"On "
                 + time.strftime(u"%d.%m.%Y at %H:%M:%S", time.localtime(time.time()))
                 + u": System was powered on."
             )
-            self.try_mail(subject, body, u"data/log.json")
-
-        while True:
-            try:
-                # send if rain detected
-                if dataeml[u"emlrain"] != u"off":  # if eml_rain send email is enable (on)
-                    if (
-                        gv.sd[u"rs"] != last_rain
-                    ):  # send email only 1x if  gv.sd rs change
-                        last_rain = gv.sd[u"rs"]
-
-                        if (
-                            gv.sd[u"rs"] and gv.sd[u"urs"]
-                        ):  # if rain sensed and use rain sensor
-                            body = (
-                                u"On "
-                                + time.strftime(
-                                    u"%d.%m.%Y at %H:%M:%S", time.localtime(time.time())
-                                )
-                                + u": System detected rain."
-                            )
-                            self.try_mail(
-                                subject, body
-                            )  # send email without attachments
-
-                if dataeml[u"emlrun"] != u"off":  # if eml_rain send email is enable (on)
-                    running = False
-                    for b in range(gv.sd[u"nbrd"]):  # Check each station once a second
-                        for s in range(8):
-                            sid = b * 8 + s  # station index
-                            if gv.srvals[sid]:  # if this station is on
-                                running = True
-                                was_running = True
-
-                    if was_running and not running:
-                        was_running = False
-                        if gv.lrun[1] == 98:
-                            pgr = u"Run-once"
-                        elif gv.lrun[1] == 99:
-                            pgr = u"Manual"
-                        else:
-                            pgr = str(gv.lrun[1])
-
-                        dur = str(timestr(gv.lrun[2]))
-                        start = time.gmtime(gv.now - gv.lrun[2])
-                        body = (
-                            u"On "
-                            + time.strftime(
-                                u"%d.%m.%Y at %H:%M:%S", time.localtime(time.time())
-                            )
-                            + u"\n"
-                            u"SIP has run: Station "
-                            + str(gv.lrun[0] + 1)
-                            + u", "
-                            + gv.snames[gv.lrun[0]]
-                            + u"\n"
-                            u"Program: " + pgr + u"\n"
-                            u"Start time: "
-                            + time.strftime(u"%d.%m.%Y at %H:%M:%S", start)
-                            + u"\n"
-                            u"Duration: " + dur
-                        )
-
-                        self.try_mail(subject, body)  # send email without attachment
-
-                self._sleep(1)
-
-            except Exception:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                err_string = "".join(
-                    traceback.format_exception(exc_type, exc_value, exc_traceback)
-                )
-                self.add_status(u"Email plugin encountered an error: " + err_string)
-                self._sleep(60)
+            self.try_mail(self.subject, body, u"data/log.json")
+
+        self.notify_rain_changed(u"startup")
+        self.notify_zone_change(u"startup")
+
+    def notify_rain_changed(self, name, **kw):
+        """Send email only 1x when gv.sd rs changes to rain"""
+        if self.dataeml is None or self.dataeml[u"emlrain"] == u"off":
+            return
+        with self._lock:
+            if gv.sd[u"rs"] == self.last_rain:
+                return
+            self.last_rain = gv.sd[u"rs"]
+        if gv.sd[u"rs"] and gv.sd[u"urs"]:  # if rain sensed and use rain sensor
+            body = (
+                u"On "
+                + time.strftime(u"%d.%m.%Y at %H:%M:%S", time.localtime(time.time()))
+                + u": System detected rain."
+            )
+            self._guard(self.try_mail, self.subject, body)  # send email without attachments
+
+    def notify_station_completed(self, name, **kw):
+        """Remember the run, gv.lrun is overwritten by the next station"""
+        self.last_run = gv.lrun[:]
+
+    def notify_zone_change(self, name, **kw):
+        """Send the run report when the last running station stops"""
+        if self.dataeml is None or self.dataeml[u"emlrun"] == u"off":
+            return
+        running = any(gv.srvals)
+        with self._lock:
+            if running:
+                self.was_running = True
+                return
+            if not self.was_running:
+                return
+            self.was_running = False
+        self._guard(self.mail_run)
+
+    def mail_run(self):
+        lrun = self.last_run or gv.lrun
+        if lrun[1] == 98:
+            pgr = u"Run-once"
+        elif lrun[1] == 99:
+            pgr = u"Manual"
+        else:
+            pgr = str(lrun[1])
+
+        dur = str(timestr(lrun[2]))
+        start = time.gmtime(gv.now - lrun[2])
+        body = (
+            u"On "
+            + time.strftime(u"%d.%m.%Y at %H:%M:%S", time.localtime(time.time()))
+            + u"\n"
+            u"SIP has run: Station "
+            + str(lrun[0] + 1)
+            + u", "
+            + gv.snames[lrun[0]]
+            + u"\n"
+            u"Program: " + pgr + u"\n"
+            u"Start time: "
+            + time.strftime(u"%d.%m.%Y at %H:%M:%S", start)
+            + u"\n"
+            u"Duration: " + dur
+        )
+
+        self.try_mail(self.subject, body)  # send email without attachment
 
 
 checker = EmailSender()
 
+rain_changed = signal(u"rain_changed")
+rain_changed.connect(checker.notify_rain_changed)
+
+zones = signal(u"zone_change")
+zones.connect(checker.notify_zone_change)
+
+complete = signal(u"station_completed")
+complete.connect(checker.notify_station_completed)
+
+# Also check when the running program changes, e.g. stopped from the web page
+running_program_change = signal(u"running_program_change")
+running_program_change.connect(checker.notify_zone_change)
+
 
 ################################################################################
 # Helper functions:                                                            #
@@ -206,44 +227,96 @@ def get_email_options():
     return dataeml
 
 
-def email(subject, text, attach=None):
-    """Send email with with attachments"""
-    dataeml = get_email_options()
+def _message(dataeml, subject, text, attach=None):
+    mail_user = dataeml[u"emlusr"]  # SMTP username
+    mail_from = mail_user if dataeml[u"emlsender"] != u"off" else gv.sd[u"name"]  # From Name
+    # --------------
+    msg = MIMEMultipart()
+    msg[u"From"] = mail_from
+    msg[u"To"] = dataeml[u"emladr"]
+    msg[u"Subject"] = subject
+    msg.attach(MIMEText(text))
+    if attach is not None and os.path.isfile(attach):  # If insert attachments
+        part = MIMEBase(u"application", u"gzip")
+        part.set_payload(_gzip_file(attach))
+        encoders.encode_base64(part)
+        part.add_header(
+            u"Content-Disposition",
+            u'attachment; filename="%s.gz"' % os.path.basename(attach),
+        )
+        msg.attach(part)
+    return mail_from, msg
+
+
+def _gzip_file(path):
+    """The gzip compressed contents of path, read when the mail is sent"""
+    buf = io.BytesIO()
+    with open(path, u"rb") as src:
+        with gzip.GzipFile(fileobj=buf, mode=u"wb") as dst:
+            while True:
+                chunk = src.read(65536)
+                if not chunk:
+                    break
+                dst.write(chunk)
+    return buf.getvalue()
+
+
+def _connect(dataeml):
     if dataeml[u"emlusr"] != "" and dataeml[u"emlpwd"] != "" and dataeml[u"emladr"] != "" and dataeml[
         u"emlserver"] != "" and dataeml[u"emlport"] != "":
-        mail_user = dataeml[u"emlusr"]  # SMTP username
-        mail_from = mail_user if dataeml[u"emlsender"] != u"off" else gv.sd[u"name"]  # From Name
-        mail_pwd = dataeml[u"emlpwd"]  # SMTP password
-        mail_server = dataeml[u"emlserver"]  # SMTP server address
-        mail_port = dataeml[u"emlport"]  # SMTP port
-        # --------------
-        msg = MIMEMultipart()
-        msg[u"From"] = mail_from
-        msg[u"To"] = dataeml[u"emladr"]
-        msg[u"Subject"] = subject
-        msg.attach(MIMEText(text))
-        if attach is not None:  # If insert attachments
-            part = MIMEBase(u"application", u"octet-stream")
-            part.set_payload(open(attach, u"rb").read())
-            encoders.encode_base64(part)
-            part.add_header(
-                u"Content-Disposition",
-                u'attachment; filename="%s"' % os.path.basename(attach),
-            )
-            msg.attach(part)
-        mailServer = smtplib.SMTP(mail_server, int(mail_port))
+        mailServer = smtplib.SMTP(dataeml[u"emlserver"], int(dataeml[u"emlport"]))  # SMTP server address and port
         mailServer.ehlo()
         mailServer.starttls()
         mailServer.ehlo()
-        mailServer.login(mail_user, mail_pwd)
-        mailServer.sendmail(
-            mail_from, dataeml[u"emladr"], msg.as_string()
-        )  # name + e-mail address in the From: field
-        mailServer.quit()
+        mailServer.login(dataeml[u"emlusr"], dataeml[u"emlpwd"])  # SMTP username and password
+        return mailServer
     else:
         raise Exception(u"E-mail plug-in is not properly configured!")
 
 
+def email(subject, text, attach=None):
+    """Send email with with attachments"""
+    dataeml = get_email_options()
+    mailServer = _connect(dataeml)
+    mail_from, msg = _message(dataeml, subject, text, attach)
+    mailServer.sendmail(
+        mail_from, dataeml[u"emladr"], msg.as_string()
+    )  # name + e-mail address in the From: field
+    mailServer.quit()
+
+
+class EmailChannel(notify_outbox.Channel):
+    """Delivers queued email, one SMTP session per batch."""
+
+    name = u"email_adj"
+    min_interval = 2.0
+
+    def __init__(self):
+        self.server = None
+        self.dataeml = None
+
+    def open(self):
+        self.dataeml = get_email_options()
+        self.server = _connect(self.dataeml)
+
+    def send(self, payload):
+        mail_from, msg = _message(
+            self.dataeml, payload[u"subject"], payload[u"text"], payload[u"attach"]
+        )
+        self.server.sendmail(mail_from, self.dataeml[u"emladr"], msg.as_string())
+        checker.add_status(u"Email was sent: " + payload[u"text"])
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            finally:
+                self.server = None
+
+
+notify_outbox.register(EmailChannel())
+
+
 ################################################################################
 # Web pages:                                                                   #
 ################################################################################
@@ -278,6 +351,7 @@ class update(ProtectedPage):
             qdict[u"emlrun"] = u"off"
         with open(u"./data/email_adj.json", u"w") as f:  # write the settings to file
             json.dump(qdict, f)
+        checker.update()
         raise web.seeother(u"/emla")
 
 
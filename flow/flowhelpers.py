@@ -5,11 +5,11 @@ import gv
 from os.path import exists
 import json
 import codecs
-import io
 import ast
 import threading
 import datetime
 from blinker import signal
+from sip_log import LogReader
 
 # Variables for flow measurement
 IGNORE_INITIAL = 15  # Time at beginning of flow window to ignore for rate measurement purposes (push air out of system)
@@ -653,20 +653,19 @@ def timestr(t):
     )
 
 
-def read_log():
+def _parse_log_line(line):
+    try:
+        return ast.literal_eval(json.loads(line))
+    except ValueError:
+        return json.loads(line)
+
+
+# Flow log reader, re-parsed only when flowlog.json changes
+flow_log = LogReader(u"./data/flowlog.json", parse=_parse_log_line)
+
+
+def read_log(n=0):
     """
-    Read data from irrigation log file.
+    Read data from irrigation log file, most recent n records (0 = all).
     """
-    result = []
-    try:
-        with io.open(u"./data/flowlog.json") as logf:
-            records = logf.readlines()
-            for i in records:
-                try:
-                    rec = ast.literal_eval(json.loads(i))
-                except ValueError:
-                    rec = json.loads(i)
-                result.append(rec)
-        return result
-    except IOError:
-        return result
+    return flow_log.latest(n)
@@ -39,7 +39,7 @@ import sys
 from time import sleep
 
 # threads
-from threading import Thread
+from threading import Event, Thread
 
 # get open sprinkler signals
 from blinker import signal
@@ -108,7 +108,7 @@ gv.plugin_menu.append([_("Keypad Plugin"), "/keypad-sp"])
 
 class ScanningKeypad:
     """ This class handles the keypad hardware """
-    def __init__(self, pin_columns, pin_rows, indices, char_list):
+    def __init__(self, pin_columns, pin_rows, indices, char_list, gpio=None):
         """
         Initializes a ScanningKeypad object
         Inputs: pin_columns - List of pin numbers for the keypad columns
@@ -116,7 +116,15 @@ class ScanningKeypad:
                 indices - A 2-dimensional table of the resulting index for each key when a column
                           meets with a row
                 char_list - List of characters where the key is a value within indices
+                gpio - Optional RPi.GPIO compatible object (e.g. FakeKeypadGPIO) used
+                       instead of the hardware library
         """
+        if gpio is None:
+            self._use_pigpio = gv.use_pigpio
+            self._gpio = None if gv.use_pigpio else GPIO
+        else:
+            self._use_pigpio = False
+            self._gpio = gpio
         self._pin_columns = pin_columns
         self._pin_rows = pin_rows
         self._indices = indices
@@ -127,12 +135,21 @@ class ScanningKeypad:
         self._pins_initialized = False
         # Boolean to help force blocking calls to exit once this transitions to False
         self._running = True
+        # Low power idle: wait for a row edge instead of scanning while no key is down
+        self.idle_interrupts = True
+        # Set from the row edge callbacks
+        self._row_edge = Event()
+        # True once edge callbacks are registered on the row pins
+        self._edges_registered = False
+        self._pi_callbacks = []
 
     def set_running(self, is_running):
         """
         Sets the running flag (forces some blocking calls to unblock when set to False)
         """
         self._running = is_running
+        if not is_running:
+            self._row_edge.set()  # Unblock an idle wait
 
     def isReady(self):
         """
@@ -140,16 +157,15 @@ class ScanningKeypad:
         """
         return self._pins_initialized
 
-    @staticmethod
-    def _set_floating_input(pin):
+    def _set_floating_input(self, pin):
         """
         Set the hardware input as floating (not pulled up or down by a resistor)
         """
-        if gv.use_pigpio:
+        if self._use_pigpio:
             pi.set_mode(gv.pin_map[pin], pigpio.INPUT)
             pi.set_pull_up_down(gv.pin_map[pin], pigpio.PUD_OFF)
         else:
-            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_OFF)
+            self._gpio.setup(pin, self._gpio.IN, pull_up_down=self._gpio.PUD_OFF)
 
     def _set_column(self, col):
         """
@@ -161,15 +177,15 @@ class ScanningKeypad:
             try:
                 if self._keypad_current_column >= 0:
                     # Set old value as floating input so it won't affect anyone else
-                    ScanningKeypad._set_floating_input(self._keypad_current_column)
+                    self._set_floating_input(self._keypad_current_column)
                 # set current pin and make output HIGH
                 self._keypad_current_column = col
-                if gv.use_pigpio:
+                if self._use_pigpio:
                     pi.set_mode(gv.pin_map[self._keypad_current_column], pigpio.OUTPUT)
                     pi.write(gv.pin_map[self._keypad_current_column], 1)
                 else:
-                    GPIO.setup(self._keypad_current_column, GPIO.OUT)
-                    GPIO.output(self._keypad_current_column, GPIO.HIGH)
+                    self._gpio.setup(self._keypad_current_column, self._gpio.OUT)
+                    self._gpio.output(self._keypad_current_column, self._gpio.HIGH)
             except Exception as err:
                 print(u"Keypad plugin: except:\n{}".format(err))
                 print(traceback.format_exc())
@@ -182,26 +198,105 @@ class ScanningKeypad:
         Returns: True if operation succeeded; False otherwise
         """
         try:
-            if not gv.use_pigpio:
-                GPIO.setmode(GPIO.BOARD)
+            if not self._use_pigpio:
+                self._gpio.setmode(self._gpio.BOARD)
             # set column pins as floating to start with
             for v in self._pin_columns:
-                ScanningKeypad._set_floating_input(v)
+                self._set_floating_input(v)
             self._keypad_current_column = -1
             # row pins will be used as input with pull down resistors
             for v in self._pin_rows:
-                if gv.use_pigpio:
+                if self._use_pigpio:
                     pi.set_mode(gv.pin_map[v], pigpio.INPUT)
                     pi.set_pull_up_down(gv.pin_map[v], pigpio.PUD_DOWN)
                 else:
-                    GPIO.setup(v, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+                    self._gpio.setup(v, self._gpio.IN, pull_up_down=self._gpio.PUD_DOWN)
             self._pins_initialized = True
+            self._register_row_edges()
         except Exception as err:
             print(u"Keypad plugin: except:\n{}".format(err))
             print(traceback.format_exc())
             self._pins_initialized = False
         return self._pins_initialized
 
+    def _on_row_edge(self, *args):
+        """
+        Row edge callback (runs on the GPIO library's thread)
+        """
+        self._row_edge.set()
+
+    def _register_row_edges(self):
+        """
+        Registers rising edge callbacks on the row pins. Idle waits fall back
+        to scanning if the GPIO library can't provide them.
+        """
+        if self._edges_registered:
+            return
+        try:
+            for v in self._pin_rows:
+                if self._use_pigpio:
+                    self._pi_callbacks.append(
+                        pi.callback(gv.pin_map[v], pigpio.RISING_EDGE, self._on_row_edge)
+                    )
+                else:
+                    self._gpio.add_event_detect(
+                        v, self._gpio.RISING, callback=self._on_row_edge
+                    )
+            self._edges_registered = True
+        except Exception as err:
+            print(u"Keypad plugin: row edge detection unavailable, scanning instead:\n{}".format(err))
+
+    def _drive_all_columns(self):
+        """
+        Output HIGH on every column so that any key press raises its row
+        Returns: True if any row is already high (a key is down)
+        """
+        self._keypad_current_column = -1
+        for v in self._pin_columns:
+            if self._use_pigpio:
+                pi.set_mode(gv.pin_map[v], pigpio.OUTPUT)
+                pi.write(gv.pin_map[v], 1)
+            else:
+                self._gpio.setup(v, self._gpio.OUT)
+                self._gpio.output(v, self._gpio.HIGH)
+        for v in self._pin_rows:
+            if self._use_pigpio:
+                if pi.read(gv.pin_map[v]):
+                    return True
+            elif self._gpio.input(v):
+                return True
+        return False
+
+    def _release_columns(self):
+        for v in self._pin_columns:
+            self._set_floating_input(v)
+
+    def _wait_for_row_edge(self, timeout_s=-1):
+        """
+        Sleeps until a key is pressed, with all columns driven and the
+        row edge callbacks armed, instead of scanning the matrix.
+        Inputs: timeout_s - The amount of time in seconds to block before giving up
+        Returns: True if woken by a key press (or a key was already down)
+        """
+        if not (self.idle_interrupts and self._edges_registered and self._pins_initialized):
+            return False
+        woke = True
+        try:
+            self._row_edge.clear()
+            if not self._drive_all_columns():
+                woke = self._row_edge.wait(timeout_s if timeout_s > 0 else None)
+        except Exception as err:
+            print(u"Keypad plugin: except:\n{}".format(err))
+            print(traceback.format_exc())
+            self._pins_initialized = False
+            return False
+        finally:
+            try:
+                self._release_columns()
+            except Exception:
+                pass
+        return woke and self._running
+
     def _sample(self):
         """
         Samples all rows and returns the depressed keys for the current column
@@ -212,10 +307,10 @@ class ScanningKeypad:
                 sleep(0.001)  # just to make sure the output is fully charged
                 try:
                     for row, row_v in enumerate(self._pin_rows):
-                        if gv.use_pigpio:
+                        if self._use_pigpio:
                             keys[self._indices[row][col]] = pi.read(gv.pin_map[row_v])
                         else:
-                            keys[self._indices[row][col]] = GPIO.input(row_v)
+                            keys[self._indices[row][col]] = self._gpio.input(row_v)
                 except Exception as err:
                     print(u"Keypad plugin: except:\n{}".format(err))
                     print(traceback.format_exc())
@@ -230,8 +325,9 @@ class ScanningKeypad:
         Waits for any key to be pressed
         """
         c = self._sample()
-        while True not in c:
-            sleep(0.01)
+        while c is not None and True not in c and self._running:
+            if not self._wait_for_row_edge():
+                sleep(0.01)
             c = self._sample()
 
     def getc(self, down_keys=None, timeout_s=-1):
@@ -260,6 +356,13 @@ class ScanningKeypad:
             current_time = time.time()
             if timeout_s > 0 and (current_time - start_time) >= timeout_s:
                 break  # Timeout occurred
+            if True not in keys and self.idle_interrupts and self._edges_registered:
+                # Nothing is down: sleep until a row edge rather than scanning
+                remaining = (
+                    timeout_s - (current_time - start_time) if timeout_s > 0 else -1
+                )
+                if not self._wait_for_row_edge(remaining):
+                    continue  # Timed out or stopping; checked at top of loop
             # Check for change every 25 ms so we don't bog anything down.
             # This also serves as a debounce.
             sleep(0.025)
@@ -304,6 +407,75 @@ class ScanningKeypad:
         return self.wait_for_key_index_up(key_index, timeout_s, running)
 
 
+class FakeKeypadGPIO:
+    """
+    Software stand-in for RPi.GPIO wired to a 4x4 keypad matrix.
+    press() and release() change which key is down; a row reads HIGH when
+    its pressed key's column is driven HIGH, and rising edges run the
+    registered callbacks. Pass one as the gpio argument of ScanningKeypad to
+    measure wake latency and idle CPU use without hardware.
+    """
+
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    RISING = 31
+
+    def __init__(self, pin_columns, pin_rows):
+        self._pin_columns = pin_columns
+        self._pin_rows = pin_rows
+        self._outputs = {}
+        self._callbacks = {}
+        self._down = None  # (row, col) of the pressed key
+        self.reads = 0  # input() calls, a measure of scanning work
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None):
+        if mode == self.IN:
+            self._outputs.pop(pin, None)
+        else:
+            self._outputs.setdefault(pin, self.LOW)
+
+    def output(self, pin, value):
+        rows_before = [self._row_level(r) for r in self._pin_rows]
+        self._outputs[pin] = value
+        self._fire(rows_before)
+
+    def input(self, pin):
+        self.reads += 1
+        return self._row_level(pin)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self._callbacks[pin] = callback
+
+    def _row_level(self, pin):
+        if self._down is None or pin not in self._pin_rows:
+            return self.LOW
+        row, col = self._down
+        if self._pin_rows[row] != pin:
+            return self.LOW
+        return self._outputs.get(self._pin_columns[col], self.LOW)
+
+    def _fire(self, rows_before):
+        for i, pin in enumerate(self._pin_rows):
+            if not rows_before[i] and self._row_level(pin) and pin in self._callbacks:
+                self._callbacks[pin](pin)
+
+    def press(self, row, col):
+        rows_before = [self._row_level(r) for r in self._pin_rows]
+        self._down = (row, col)
+        self._fire(rows_before)
+
+    def release(self):
+        self._down = None
+
+
 def float_to_field_str(value):
     return format(value, '0.2f').rstrip('0').rstrip('.')
 
@@ -406,6 +578,7 @@ class KeypadPlugin:
         self.keypad_manual_station_time_s = 300
         self.rain_delay_hrs = 24
         self.key_hold_time_s = 1
+        self._keypad.idle_interrupts = True
         self.selectable_functions = {
             "A": KeypadPlugin.FN_MANUAL_STATION,
             "B": KeypadPlugin.FN_START_RAIN_DELAY,
@@ -1049,6 +1222,8 @@ class KeypadPlugin:
             self.rain_delay_hrs = float(settings["hrraindelay"])
         if "keyholdtime" in settings:
             self.key_hold_time_s = float(settings["keyholdtime"])
+        if "idleinterrupts" in settings:
+            self._keypad.idle_interrupts = settings["idleinterrupts"] == "on"
         if (
             "akeyfn" in settings
             and "bkeyfn" in settings
@@ -1117,6 +1292,7 @@ class KeypadPlugin:
             "keytimeout": float_to_field_str(self.keypad_press_timeout_s),
             "hrraindelay": float_to_field_str(self.rain_delay_hrs),
             "keyholdtime": float_to_field_str(self.key_hold_time_s),
+            "idleinterrupts": "on" if self._keypad.idle_interrupts else "off",
             "akeyfn": str(self.selectable_functions["A"]),
             "bkeyfn": str(self.selectable_functions["B"]),
             "ckeyfn": str(self.selectable_functions["C"]),
@@ -1186,6 +1362,8 @@ class save_settings(ProtectedPage):
         qdict = (
             web.input()
         )  # Dictionary of values returned as query string from settings page.
+        if "idleinterrupts" not in qdict:
+            qdict["idleinterrupts"] = "off"
         keypad_plugin.load_from_dict(qdict)  # load settings from dictionary
         keypad_plugin.save_keypad_settings()  # Save keypad settings
         raise web.seeother("/")  # Return user to home page.
@@ -16,6 +16,7 @@ import datetime
 import copy
 import os
 from plugins import mqtt
+import rollup
 
 try:
     import jmespath
@@ -40,6 +41,7 @@ last_reading = {}
 mqtt_readers = {}
 SENSOR_DATA_PATH = "./static/data/moisture_sensor_data"
 CONFIG_FILE_PATH = "./data/moisture_sensor_data_mqtt.json"
+ROLLUP_STATE_PATH = "./data/moisture_sensor_data_mqtt_rollup.json"
 ATTRIBUTES = [
     "enable",
     "o_sensor",
@@ -247,6 +249,18 @@ def truncate_data_files(neme, **kw):
                 os.remove(sensor_file_tmp)
 
 
+def sensor_files():
+    """The data files of all configured sensors"""
+    return [f"{SENSOR_DATA_PATH}/{sensor}" for sensor in settings["sensors"].keys()]
+
+
+def rollup_data_files(name, **kw):
+    """Bring the hourly and daily rollups of the sensor data files up to
+    date. Only readings stored since the last run are read.
+    """
+    rollups.run(sensor_files(), gv.now)
+
+
 def load_moisture_data_mqtt_settings():
     global settings
 
@@ -284,6 +298,8 @@ def moisture_sensor_data_init():
                 mqtt.subscribe(topic, mqtt_reader, qos=0)
                 subscribed_topics.add(topic)
 
+    rollups.start_hourly(sensor_files, lambda: gv.now)
+
 
 class get_settings(ProtectedPage):
     """
@@ -354,6 +370,7 @@ class save_settings(ProtectedPage):
                     if os.path.isfile(old_file):
                         # missing_ok=True
                         os.remove(old_file)
+                    rollups.remove(old_file)
 
             elif new_sensor != old_sensor:
                 if old_sensor == "":
@@ -371,6 +388,7 @@ class save_settings(ProtectedPage):
                     )
                     if os.path.isfile(old_file) and not os.path.isfile(new_file):
                         os.rename(old_file, new_file)
+                        rollups.rename(old_file, new_file)
                     if old_sensor in last_reading:
                         last_reading[new_sensor] = last_reading.pop(old_sensor)
 
@@ -396,8 +414,11 @@ class save_settings(ProtectedPage):
 
 msd_signal = signal("moisture_sensor_data")
 
+rollups = rollup.Rollup(ROLLUP_STATE_PATH)
+
 new_day_signal = signal("new_day")
 new_day_signal.connect(truncate_data_files)
+new_day_signal.connect(rollup_data_files)
 
 # Run when plugin is loaded
 moisture_sensor_data_init()
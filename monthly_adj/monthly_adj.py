@@ -4,7 +4,7 @@
 from __future__ import print_function
 
 # standard library imports
-import json
+import datetime
 import time
 
 # local module imports
@@ -14,6 +14,7 @@ from sip import template_render
 from urls import urls  # Get access to sip's URLs
 import web
 from webpages import ProtectedPage
+import monthly_levels
 
 
 # Add a new url to open the data entry page.
@@ -30,24 +31,16 @@ urls.extend(
 gv.plugin_menu.append([_(u"Monthly Adjust"), u"/ma"])
 
 
+levels = monthly_levels.MonthlyLevels(u"./data/levels.json")
+
+
 # def set_wl(run_loop=False):
-def set_wl(month):
+def set_wl(day=None):
     """Adjust irrigation time by percent per month."""
-    
-    try:
-        with open(
-            u"./data/levels.json", u"r"
-        ) as f:  # Read the monthly percentages from file
-            levels = json.load(f)
-    except IOError:  # If file does not exist
-        levels = [100] * 12
-        with open(
-            u"./data/levels.json", u"w"
-        ) as f:  # write default percentages to file
-            json.dump(levels, f)
-    gv.sd[u"wl_monthly_adj"] = levels[
-        month - 1
-    ]  # Set the water level % (levels list is zero based).
+
+    if day is None:
+        day = datetime.date.today()
+    gv.sd[u"wl_monthly_adj"] = levels.level(day)  # Set the water level %
     print(
         u"Monthly Adjust: Setting water level to {}%".format(
             gv.sd[u"wl_monthly_adj"]
@@ -59,18 +52,7 @@ class monthly_percent(ProtectedPage):
     """Load an html page for entering monthly irrigation time adjustments"""
     
     def GET(self):
-        try:
-            with open(
-                u"./data/levels.json", u"r"
-            ) as f:  # Read the monthly percentages from file
-                levels = json.load(f)
-        except IOError:  # If file does not exist
-            levels = [100] * 12
-            with open(
-                u"./data/levels.json", u"w"
-            ) as f:  # write default percentages to file
-                json.dump(levels, f)
-        return template_render.monthly(levels)
+        return template_render.monthly(levels.levels, levels.interpolate)
 
 
 class update_percents(ProtectedPage):
@@ -95,21 +77,21 @@ class update_percents(ProtectedPage):
         vals = []
         for m in months:
             vals.append(int(qdict[m]))
-        with open(
-            u"./data/levels.json", u"w"
-        ) as f:  # write the monthly percentages to file
-            json.dump(vals, f)
-        set_wl(gv.sd["month"])
+        levels.save(vals)  # write the monthly percentages to file
+        levels.set_interpolate(u"interpolate" in qdict)
+        set_wl()
         raise web.seeother(u"/")
     
 def update_wl_monthly(name, **kw):
     month = time.localtime().tm_mon
     if not u"month" in gv.sd:
         gv.sd["month"] = month
-        set_wl(month)
+        set_wl()
     elif  month != gv.sd["month"]:
         gv.sd["month"] = month
-        set_wl(month)
+        set_wl()
+    elif levels.interpolate:  # Level changes every day
+        set_wl()
 
 # check for new month each day
 new_day = signal(u"new_day")
@@ -0,0 +1,101 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shared monthly irrigation level tables for the monthly adjustment plugins.
+
+A table is a JSON list of twelve percentages, January first, optionally
+followed by plugin specific values. It is read from disk once and then
+kept in memory; saves replace the file atomically. level() gives the
+percentage for a date, either the month's value or, with interpolation
+on, a value interpolated daily between the month values, each taken to
+apply at the middle of its month, so there is no step at month ends.
+"""
+
+from __future__ import print_function
+
+# standard library imports
+import datetime
+import json
+import os
+import threading
+
+
+def _write_json(path, data):
+    tmp = path + u".tmp"
+    with open(tmp, u"w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _mid_month(year, month):
+    """Ordinal date of the middle of a month (may be in another year)"""
+    year += (month - 1) // 12
+    month = (month - 1) % 12 + 1
+    start = datetime.date(year, month, 1).toordinal()
+    if month == 12:
+        end = datetime.date(year + 1, 1, 1).toordinal()
+    else:
+        end = datetime.date(year, month + 1, 1).toordinal()
+    return (start + end) / 2.0
+
+
+class MonthlyLevels(object):
+    def __init__(self, path, default=None):
+        self.path = path
+        self.options_path = os.path.splitext(path)[0] + u"_options.json"
+        self.default = default if default is not None else [100] * 12
+        self._lock = threading.Lock()
+        self._levels = None
+        self._options = None
+
+    @property
+    def levels(self):
+        """The cached table, loaded (or created with defaults) on first use"""
+        if self._levels is None:
+            with self._lock:
+                if self._levels is None:
+                    try:
+                        with open(self.path, u"r") as f:  # Read the monthly percentages from file
+                            self._levels = json.load(f)
+                    except (IOError, ValueError):  # If file does not exist
+                        self._levels = list(self.default)
+                        _write_json(self.path, self._levels)  # write default percentages to file
+        return self._levels
+
+    def save(self, levels):
+        with self._lock:
+            _write_json(self.path, levels)
+            self._levels = list(levels)
+
+    @property
+    def interpolate(self):
+        if self._options is None:
+            try:
+                with open(self.options_path, u"r") as f:
+                    self._options = json.load(f)
+            except (IOError, ValueError):
+                self._options = {u"interpolate": u"off"}
+        return self._options.get(u"interpolate", u"off") == u"on"
+
+    def set_interpolate(self, on):
+        self._options = {u"interpolate": u"on" if on else u"off"}
+        _write_json(self.options_path, self._options)
+
+    def level(self, day):
+        """The percentage for a date"""
+        levels = self.levels
+        if not self.interpolate:
+            return levels[day.month - 1]
+
+        x = day.toordinal()
+        mid = _mid_month(day.year, day.month)
+        if x < mid:
+            prev_month, next_month = day.month - 1, day.month
+        else:
+            prev_month, next_month = day.month, day.month + 1
+        x0 = _mid_month(day.year, prev_month)
+        x1 = _mid_month(day.year, next_month)
+        y0 = levels[(prev_month - 1) % 12]
+        y1 = levels[(next_month - 1) % 12]
+        return int(round(y0 + (y1 - y0) * (x - x0) / (x1 - x0)))
@@ -36,6 +36,12 @@ gv.plugin_menu.append([_("Monthly Adjust per Station"), "/monthly_adjust_per_sta
 # ADJUSTMENT_COLORS = ["#e8f4ea", "#e0f0e3", "#d2e7d6", "#c8e1cc", "#b8d8be"]
 ADJUSTMENT_COLORS = ["#d4ffc5", "#b2eb99", "#87ca6a", "#6bac50", "#54883d"]
 station_settings = {}
+# adjust_table[station_index][month - 1] = percent, None when not adjusted.
+# Rows are None for stations without adjustment enabled.
+adjust_table = []
+# station_index: (start, duration) of the last run adjusted, so the
+# per-station and whole schedule hooks never adjust the same run twice
+adjusted_runs = {}
 
 
 def validate_int(int_list):
@@ -53,67 +59,94 @@ def validate_int(int_list):
     return tuple(validated_list)
 
 
-def notify_station_scheduled(station, **kw):
-    """Apply the defined adjustment to the schedule running on the
+def compile_settings():
+    """Build adjust_table from station_settings so scheduling needs no
+    string parsing. The default is applied here to months left blank.
+    """
+    global adjust_table
+
+    (default,) = validate_int([station_settings.get("default")])
+    enabled = []
+    for key in station_settings:
+        if key.startswith("enable_"):
+            (station_index,) = validate_int([key[len("enable_"):]])
+            if station_index is not None:
+                enabled.append(station_index)
+
+    table = [None] * (max(enabled) + 1 if enabled else 0)
+    for station_index in enabled:
+        row = []
+        for mon in range(1, 13):
+            st_mon_key = f"st_mon_{station_index}_{mon}"
+            if st_mon_key not in station_settings:
+                row.append(None)
+                continue
+            (adjustment,) = validate_int([station_settings[st_mon_key]])
+            row.append(default if adjustment is None else adjustment)
+        table[station_index] = row
+    adjust_table = table
+
+
+def adjust_station(station_index, month):
+    """Apply the month's adjustment to the schedule running on the
     station if applicable (Not RUN NOW, enabled)
     """
-
-    ts = datetime.datetime.fromtimestamp(gv.now)
-    cur_month = ts.month
-    station_index = station - 1
-
     # TODO honor "Ignore Plugin adjustments"
 
     if gv.rn or gv.rs[station_index][3] == 98:
         # Skip RUN NOW and RUN ONCE programs
         return
 
-    st_enable_key = f"enable_{station_index}"
-    st_mon_key = f"st_mon_{station_index}_{cur_month}"
+    if station_index >= len(adjust_table) or adjust_table[station_index] is None:
+        return
 
-    if st_enable_key not in station_settings:
+    run = (gv.rs[station_index][0], gv.rs[station_index][2])
+    if adjusted_runs.get(station_index) == run:
+        # Already adjusted by the other hook
         return
 
-    if st_mon_key in station_settings:
-        (adjustment,) = validate_int(
-            [
-                station_settings[st_mon_key],
-            ]
-        )
-
-        if adjustment is None:
-            if "default" not in station_settings:
-                return
-            else:
-                (default,) = validate_int(
-                    [
-                        station_settings["default"],
-                    ]
-                )
-
-                if default is None:
-                    return
-                else:
-                    adjustment = default
+    adjustment = adjust_table[station_index][month - 1]
+    if adjustment is None or adjustment == 100:
+        # Nothing to adjust
+        return
 
-        if adjustment == 100:
-            # Nothing to adjust
-            return
+    duration = gv.rs[station_index][2]
 
-        duration = gv.rs[station_index][2]
+    duration = math.ceil(duration * adjustment / 100)
+    gv.rs[station_index][1] = gv.rs[station_index][0] + duration
+    gv.rs[station_index][2] = duration
+    if duration == 0:
+        gv.ps[station_index] = [0, 0]
+    else:
+        gv.ps[station_index][1] = duration
+    adjusted_runs[station_index] = (gv.rs[station_index][0], duration)
 
-        duration = math.ceil(duration * adjustment / 100)
-        gv.rs[station_index][1] = gv.rs[station_index][0] + duration
-        gv.rs[station_index][2] = duration
-        if duration == 0:
-            gv.ps[station_index] = [0, 0]
-        else:
-            gv.ps[station_index][1] = duration
+
+def notify_station_scheduled(station, **kw):
+    """Adjust one station as it is scheduled"""
+    month = datetime.datetime.fromtimestamp(gv.now).month
+    adjust_station(station - 1, month)
+
+
+def notify_stations_scheduled(name, **kw):
+    """Adjust every scheduled station in gv.rs in a single pass"""
+    if gv.rn:
+        return
+    month = datetime.datetime.fromtimestamp(gv.now).month
+    for station_index in range(min(len(adjust_table), len(gv.rs))):
+        if adjust_table[station_index] is None:
+            continue
+        duration = gv.rs[station_index][2]
+        if duration and duration != math.inf:
+            adjust_station(station_index, month)
 
 
 scheduled_signal = signal("station_scheduled")
 scheduled_signal.connect(notify_station_scheduled)
 
+schedule_signal = signal("stations_scheduled")
+schedule_signal.connect(notify_stations_scheduled)
+
 
 def load_settings():
     global station_settings
@@ -128,6 +161,8 @@ def load_settings():
         # If file does not exist return empty value
         station_settings = {}
 
+    compile_settings()
+
 
 class get_settings(ProtectedPage):
     """
@@ -197,6 +232,8 @@ class save_settings(ProtectedPage):
         with open("./data/monthly_adjust_per_station.json", "w") as f:
             json.dump(station_settings, f)
 
+        compile_settings()
+
         # Return user to plugin page
         raise web.seeother("/monthly_adjust_per_station")
 
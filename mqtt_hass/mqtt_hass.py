@@ -10,6 +10,7 @@ import uuid
 import re
 import slugify as unicode_slug  # python-slugify package
 import socket
+import time
 
 
 # local module imports
@@ -44,6 +45,7 @@ HASS_MQTT_DATA_FILE = u"./data/mqtt_hass.json"
 MQTT_HASS_DISCOVERY_TOPIC_PREFIX = u"homeassistant"
 MQTT_HASS_SYSTEM_NAME_DEFAULT = u"sip"
 MQTT_HASS_SYSTEM_ENABLE_SUB_TOPIC = u"/system/enable"
+MQTT_HASS_ZONES_SUB_TOPIC = u"/zones"
 
 # Base MQTT settings
 BASE_MQTT_BROKER_HOST = u"broker_host"
@@ -64,12 +66,18 @@ MQTT_HASS_PUB_DISABLED = u"hass_pub_disabled"
 MQTT_HASS_PUB_DISABLED_DEFAULT = HASS_OFF
 MQTT_HASS_UUID = u"hass_uuid"
 MQTT_HASS_UUID_DEFAULT = u"sip_uuid"
+MQTT_HASS_ZONES_STATE = u"hass_zones_state"
+MQTT_HASS_ZONES_STATE_DEFAULT = HASS_OFF
 
 # local globals
 _settings = {}
 _settings_stored = {}
 _settings_base_mqtt = {}
 _sip_web_url = u""
+_sip_web_url_time = 0.0  # When _sip_web_url was last worked out
+_local_ip = {}  # destination -> (get_local_ip() result, time it was found)
+LOCAL_IP_TTL = 300  # Seconds before the local ip and web URL are looked up again
+_json_encoder = json.JSONEncoder(sort_keys=True)
 
 
 # Helper functions
@@ -84,8 +92,29 @@ def sip_program_to_name(value):
     return str(value)
 
 
-def get_local_ip(destination="10.255.255.255"):
-    """Return the interface ip to a destination server"""
+def publish_batch(messages):
+    """
+    Publish a list of (topic, payload) pairs back to back on one client.
+    Dictionary payloads are sent as JSON
+    """
+    client = mqtt.get_client()
+    if not client:
+        return
+    for topic, payload in messages:
+        if isinstance(payload, dict):
+            payload = _json_encoder.encode(payload)
+        client.publish(topic, payload, qos=1, retain=True)
+
+
+def get_local_ip(destination="10.255.255.255", refresh=False):
+    """
+    Return the interface ip to a destination server
+    The result is kept for LOCAL_IP_TTL seconds (the address may change on
+    DHCP renewal) or until refresh is requested (e.g. broker host changed)
+    """
+    cached = _local_ip.get(destination)
+    if cached and not refresh and time.monotonic() - cached[1] < LOCAL_IP_TTL:
+        return cached[0]
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         # doesn't even have to be reachable
@@ -95,6 +124,7 @@ def get_local_ip(destination="10.255.255.255"):
         ip = "127.0.0.1"
     finally:
         s.close()
+    _local_ip[destination] = (ip, time.monotonic())
     return ip
 
 
@@ -219,6 +249,10 @@ class save_settings(ProtectedPage):
             HASS_ON if MQTT_HASS_DEVICE_IS_STATION_NAME in qdict else HASS_OFF
         )
 
+        qdict[MQTT_HASS_ZONES_STATE] = (
+            HASS_ON if MQTT_HASS_ZONES_STATE in qdict else HASS_OFF
+        )
+
         _settings_stored.update(qdict)
         write_settings()
         hass.notify_mqtt_hass_settings_change()  # process new plugin settings
@@ -274,6 +308,7 @@ class mqtt_hass_base:
 
         self._value = None
         self._json_state = True
+        self._discovery_key = None  # Inputs of the last published discovery payload
 
         self.discovery_topic = self.discovery_topic_get()
         self.state_topic = self.state_topic_get()
@@ -293,6 +328,12 @@ class mqtt_hass_base:
     def _system_web_url(self):
         """URL to access SIP web user interface.
         Redirection displayed in HASS devices user interface options"""
+        global _sip_web_url
+        global _sip_web_url_time
+
+        if time.monotonic() - _sip_web_url_time > LOCAL_IP_TTL:
+            _sip_web_url = sip_web_url(_settings.get(MQTT_HASS_SIP_FQDN))
+            _sip_web_url_time = time.monotonic()
         return _sip_web_url
 
     def _publish(self, topic, payload=u""):
@@ -300,12 +341,7 @@ class mqtt_hass_base:
         MQTT publish helper function.
         Publish dictionary as JSON
         """
-        client = mqtt.get_client()
-        if client:
-            if isinstance(payload, dict):
-                payload = json.dumps(payload, sort_keys=True)
-
-            client.publish(topic, payload, qos=1, retain=True)
+        publish_batch([(topic, payload)])
 
     def _publish_disabled(self):
         """Return True if publish and control is disabled"""
@@ -408,6 +444,26 @@ class mqtt_hass_base:
             + u"/config"
         )
 
+    def discovery_key(self):
+        """
+        Return the inputs the discovery payload depends on.
+        Discovery is only recomposed and republished when this changes.
+        """
+        return (
+            self.discovery_topic,
+            self.state_topic,
+            self.set_topic,
+            self.entity_name(),
+            self.entity_uid(),
+            self.device_name(),
+            self.device_uid(),
+            self._system_version(),
+            self._system_web_url(),
+            _settings_base_mqtt[BASE_MQTT_STATE_TOPIC],
+            _settings[MQTT_HASS_TOPIC],
+            tuple(self._options),
+        )
+
     def discovery_payload(self):
         """Compose HASS discovery payload"""
         payload = {}
@@ -491,13 +547,18 @@ class mqtt_hass_base:
         return payload
 
     def discovery_publish(self, force_enable=False):
-        """Publish MQTT HASS Discovery config to HASS"""
+        """Publish MQTT HASS Discovery config to HASS if it changed"""
+        key = self.discovery_key()
+        if key == self._discovery_key:
+            return
         payload = self.discovery_payload()
         self._publish(self.discovery_topic, payload)
+        self._discovery_key = key
 
     def discovery_unpublish(self, force_enable=False):
         """Remove MQTT HASS Discovery config"""
         self._publish(self.discovery_topic)
+        self._discovery_key = None
 
     def state_topic_get(self):
         """Return entity state MQTT topic"""
@@ -881,6 +942,10 @@ class mqtt_hass_zone(mqtt_hass_base):
             return
 
         self._value = value
+        self._publish(self.state_topic, self.state_payload(value))
+
+    def state_payload(self, value):
+        """Return zone state payload for a state name from get_sip_value()"""
         if value == HASS_ON:
             start_time = gv.rs[self._index][0]
             duration = gv.rs[self._index][2]
@@ -892,13 +957,12 @@ class mqtt_hass_zone(mqtt_hass_base):
             duration = u"inf"
             program = u"None"
 
-        payload = {
+        return {
             u"state": value,
             u"start_time": start_time,
             u"duration": duration,
             u"program": program,
         }
-        self._publish(self.state_topic, payload)
 
     def state_unpublish(self, force_enable=False):
         """Remove zone state from MQTT broker"""
@@ -988,6 +1052,8 @@ class mqtt_hass_to_sip:
         """Initialize MQTT HASS plugin components"""
         self._system = {}
         self._zone = {}
+        self._zone_snapshot = []  # Zone states last published, see zone_snapshot()
+        self._zones_topic = None  # Aggregated zones state topic in use
 
         # Init base mqtt settings
         self.apply_base_mqtt_settings(init=True)
@@ -1004,14 +1070,20 @@ class mqtt_hass_to_sip:
     def apply_base_mqtt_settings(self, init=False):
         """Initialize MQTT HASS plugin options from saved setting in mqtt_hass.json"""
         global _settings_base_mqtt
+        global _sip_web_url
 
+        broker_host = _settings_base_mqtt.get(BASE_MQTT_BROKER_HOST)
         _settings_base_mqtt = mqtt.get_settings()
-        base_topic = _settings_base_mqtt.get(BASE_MQTT_STATE_TOPIC, u"")
-        if base_topic != _settings_base_mqtt[BASE_MQTT_STATE_TOPIC]:
-            _settings_base_mqtt[BASE_MQTT_STATE_TOPIC] = base_topic
-            if not init:
-                self.system_discovery_publish()
-                self.zone_discovery_publish()
+        _settings_base_mqtt[BASE_MQTT_STATE_TOPIC] = _settings_base_mqtt.get(
+            BASE_MQTT_STATE_TOPIC, u""
+        )
+        if not init:
+            if _settings_base_mqtt.get(BASE_MQTT_BROKER_HOST) != broker_host:
+                _local_ip.clear()  # Route to the broker may have changed
+                _sip_web_url = sip_web_url(_settings[MQTT_HASS_SIP_FQDN])
+            # Only entities whose discovery inputs changed are republished
+            self.system_discovery_publish()
+            self.zone_discovery_publish()
 
     def apply_hass_settings(self, init=False):
         """Initialize MQTT HASS plugin options from saved setting in mqtt_hass.json"""
@@ -1060,8 +1132,14 @@ class mqtt_hass_to_sip:
             MQTT_HASS_DEVICE_IS_STATION_NAM_DEFAULT,
         )
 
+        _settings[MQTT_HASS_ZONES_STATE] = _settings_stored.get(
+            MQTT_HASS_ZONES_STATE, MQTT_HASS_ZONES_STATE_DEFAULT
+        )
+
         self.system_update_settings()
         self.zone_update_settings(force_enable)
+        if not init:
+            self.zones_state_update_settings()
 
     # System parameters - helper functions
     def system_init(self):
@@ -1144,6 +1222,8 @@ class mqtt_hass_to_sip:
         for k in range(nb_zones):
             self._zone[k] = mqtt_hass_zone(k)
         self.zone_start_publish()
+        self._zone_snapshot = self.zone_snapshot()
+        self.zones_state_publish()
 
     def zone_discovery_publish(self):
         """Publish zones Discovery configuraton to HASS"""
@@ -1165,6 +1245,66 @@ class mqtt_hass_to_sip:
         for k in self._zone.keys():
             self._zone[k].update_settings(force_enable)
 
+    def zone_snapshot(self):
+        """
+        Return the published view of every zone, in one pass over gv.srvals and gv.rs.
+        Off zones are 0, running zones are (start time, duration, program).
+        """
+        srvals = gv.srvals
+        rs = gv.rs
+        return [
+            (rs[k][0], rs[k][2], rs[k][3]) if srvals[k] else 0
+            for k in range(len(self._zone))
+        ]
+
+    def zone_changes(self):
+        """Return indexes of zones changed since the last call"""
+        snapshot = self.zone_snapshot()
+        previous = self._zone_snapshot
+        self._zone_snapshot = snapshot
+        changed = [
+            k for k, state in enumerate(snapshot)
+            if k >= len(previous) or previous[k] != state
+        ]
+        return changed
+
+    def zones_state_topic(self):
+        """Return aggregated zones state topic"""
+        return _settings[MQTT_HASS_TOPIC] + MQTT_HASS_ZONES_SUB_TOPIC
+
+    def zones_state_payload(self):
+        """Return all zone states in one payload, for installs with many zones"""
+        states = []
+        running = []
+        for k in range(len(self._zone_snapshot)):
+            if self._zone_snapshot[k]:
+                states.append(HASS_ON)
+                running.append(k + 1)
+            else:
+                states.append(HASS_OFF)
+        return {
+            u"state": len(running),
+            u"running": running,
+            u"zones": states,
+        }
+
+    def zones_state_publish(self):
+        """Publish aggregated zones state if enabled"""
+        if _settings.get(MQTT_HASS_ZONES_STATE) != HASS_ON:
+            return
+        self._zones_topic = self.zones_state_topic()
+        publish_batch([(self._zones_topic, self.zones_state_payload())])
+
+    def zones_state_update_settings(self):
+        """Clear the previous aggregated topic if disabled or renamed, then republish"""
+        topic = None
+        if _settings.get(MQTT_HASS_ZONES_STATE) == HASS_ON:
+            topic = self.zones_state_topic()
+        if self._zones_topic and self._zones_topic != topic:
+            publish_batch([(self._zones_topic, u"")])
+            self._zones_topic = None
+        self.zones_state_publish()
+
     # Handle system signaling - changes coming from SIP
     def notify_mqtt_hass_settings_change(self):
         """Handle MQTT HASS plugin options changed (from Web page)"""
@@ -1215,6 +1355,10 @@ class mqtt_hass_to_sip:
         # Rain sensor logic
         self._system[u"rain_sensor_enable"].start_publish()
 
+        # Zone count or topic changed
+        self._zone_snapshot = self.zone_snapshot()
+        self.zones_state_update_settings()
+
     def notify_system_options_change(self, name, **kw):
         """Handle SIP options from main web page"""
         for k in [u"enable", u"mode", u"rain_delay_timer", u"water_level_adjust"]:
@@ -1238,9 +1382,21 @@ class mqtt_hass_to_sip:
             self._zone[k].update_options()
 
     def notify_zone_states_change(self, name, **kw):
-        """Handle Zone(s) state changed"""
-        for k in self._zone.keys():
-            self._zone[k].state_publish()
+        """Handle Zone(s) state changed. Only zones that changed are published"""
+        changed = self.zone_changes()
+        if not changed:
+            return
+        messages = []
+        for k in changed:
+            zone = self._zone[k]
+            if zone._publish_disabled():
+                continue
+            zone._value = zone.get_sip_value()
+            messages.append((zone.state_topic, zone.state_payload(zone._value)))
+        if _settings.get(MQTT_HASS_ZONES_STATE) == HASS_ON:
+            self._zones_topic = self.zones_state_topic()
+            messages.append((self._zones_topic, self.zones_state_payload()))
+        publish_batch(messages)
 
     def notify_restart_before(self, name, **kw):
         """Handle System shutdown"""
@@ -5,6 +5,7 @@
 
 # standard library imports
 import json  # for working with data file
+from threading import Condition, Thread
 from time import sleep
 
 # local module imports
@@ -27,7 +28,8 @@ from webpages import change_options
 urls.extend([
     "/node-red-sp", "plugins.node_red.settings",
     "/node-red-save", "plugins.node_red.save_settings",
-    "/jsin", "plugins.node_red.handle_requests"
+    "/jsin", "plugins.node_red.handle_requests",
+    "/jsbatch", "plugins.node_red.handle_batch"
     ])
 # fmt: on
 
@@ -259,15 +261,103 @@ def bit_read(byts, read_lst):
     return res_dict
 
 
-def bit_write(bytes, bit_dict):
-    """Turn bits on or off."""
+def bit_set(byts, bit_dict):
+    """Return a copy of byts with bits turned on or off."""
+    byts = list(byts)
     for key, value in bit_dict.items():
         idx = int(key) - 1
         byte_idx = idx // 8
         if value:  # turn bits on
-            gv.sd[bytes][byte_idx] |= 1 << (idx % 8)
+            byts[byte_idx] |= 1 << (idx % 8)
         else:  # Turn bita off
-            gv.sd[bytes][byte_idx] &= ~(1 << (idx % 8))
+            byts[byte_idx] &= ~(1 << (idx % 8))
+    return byts
+
+
+def bit_write(bytes, bit_dict):
+    """Turn bits on or off."""
+    gv.sd[bytes][:] = bit_set(gv.sd[bytes], bit_dict)
+
+
+def batch_read(req):
+    """Return the value for one read in a batch request.
+    req is {"gv": attr} or {"sd": key} with optional
+    "sn"/"station"/"item" (1 based), "index" (0 based) or "bit" lists.
+    """
+    if "gv" in req:
+        val = getattr(gv, str(req["gv"]))
+    elif "sd" in req:
+        val = gv.sd[req["sd"]]
+    else:
+        raise ValueError("read needs gv or sd")
+    if "bit" in req:
+        return bit_read(val, req["bit"])
+    for key in ("sn", "station", "item"):
+        if key in req:
+            return {i: val[int(i) - 1] for i in req[key]}
+    if "index" in req:
+        return {i: val[int(i)] for i in req["index"]}
+    return val
+
+
+def batch_stage(req, pending):
+    """Validate one write in a batch request without changing anything.
+    pending holds the values staged so far by (target, key).
+    Returns (target, key, new_value), where target is gv or gv.sd.
+    """
+    if "gv" in req:
+        if not "chng-gv" in nr_settings:
+            raise ValueError("Global variable (gv) changes are disabled")
+        attr = str(req["gv"])
+        if attr in not_writable or not hasattr(gv, attr):
+            raise ValueError("gv." + attr + " is not writable")
+        target, key, cur = gv, attr, getattr(gv, attr)
+    elif "sd" in req:
+        if not "chng-sd" in nr_settings:
+            raise ValueError("Settinges (sd) changes are disabled")
+        key = req["sd"]
+        if not key in gv.sd:
+            raise ValueError("Unknown sd key " + str(key))
+        if key in set_sd and not "bit" in req:
+            raise ValueError("sd." + key + " has side effects, use /jsin")
+        if key in danger_list and not req.get("force") == 1:
+            raise ValueError("Not recommended")
+        target, key, cur = gv.sd, key, gv.sd[key]
+    else:
+        raise ValueError("write needs gv or sd")
+    cur = pending.get((id(target), key), cur)
+
+    if "bit" in req:
+        return target, key, bit_set(cur, req["bit"])
+    for sel, base in (("sn", 1), ("station", 1), ("item", 1), ("index", 0)):
+        if sel in req:
+            new = list(cur)
+            for i, v in req[sel].items():
+                new[int(i) - base] = v
+            return target, key, new
+    if "val" in req:
+        return target, key, req["val"]
+    raise ValueError("write needs val, bit, sn, station, item or index")
+
+
+def batch_commit(staged):
+    """Apply staged writes. Lists are updated in place so references stay valid."""
+    sd_changed = False
+    for target, key, new in staged:
+        if target is gv.sd:
+            sd_changed = True
+            cur = gv.sd[key]
+        else:
+            cur = getattr(gv, key)
+        if isinstance(cur, list) and isinstance(new, list):
+            cur[:] = new
+        elif target is gv.sd:
+            gv.sd[key] = new
+        else:
+            setattr(gv, key, new)
+    if sd_changed:
+        jsave(gv.sd, "sd")
+        report_option_change()
 
 
 def load_settings():
@@ -299,12 +389,84 @@ def load_settings():
 load_settings()
 
 
-def to_node_red(msg):
-    url = nr_settings["nr-url"]
-    try:
-        resp = requests.post(url, data = msg)
-    except Exception:
-        pass
+class NodeRedSender(Thread):
+    """
+    Posts messages to node-red from a background thread so signal
+    handlers never wait on the network. One keep-alive session is reused.
+    Messages arriving within `coalesce` seconds go out together and a
+    station's later state replaces its earlier one. Every message gets a
+    sequence number so node-red can spot gaps.
+    With the "nr-batch" setting each burst is one POST of a JSON array,
+    otherwise messages are posted one at a time as before.
+    """
+    def __init__(self, coalesce=0.1, timeout=5):
+        Thread.__init__(self)
+        self.daemon = True
+        self.coalesce = coalesce
+        self.timeout = timeout
+        self.seq = 0
+        self._cond = Condition()
+        self._queue = []
+        self._stations = {}  # station number -> position in _queue
+        self._session = requests.Session()
+        self.start()
+
+    def put(self, msg, station=None):
+        """Queue a message. Pass station to coalesce state changes."""
+        with self._cond:
+            if station is not None and station in self._stations:
+                self._queue[self._stations[station]] = msg
+            else:
+                if station is not None:
+                    self._stations[station] = len(self._queue)
+                self._queue.append(msg)
+            self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+        sleep(self.coalesce)  # let the rest of a burst arrive
+        with self._cond:
+            batch = self._queue
+            self._queue = []
+            self._stations = {}
+        return batch
+
+    def _number(self, msg, batch):
+        self.seq += 1
+        if isinstance(msg, dict):
+            msg = dict(msg)
+            msg["seq"] = self.seq
+        elif batch:
+            msg = {"msg": msg, "seq": self.seq}
+        return msg
+
+    def run(self):
+        while True:
+            msgs = self._take()
+            batch = "nr-batch" in nr_settings
+            msgs = [self._number(m, batch) for m in msgs]
+            if batch:
+                self._post(json=msgs)
+            else:
+                for msg in msgs:  # A failed post only loses its own message
+                    self._post(data=msg)
+
+    def _post(self, **kw):
+        try:
+            url = nr_settings.get("nr-url")
+            if url:
+                self._session.post(url, timeout=self.timeout, **kw)
+        except Exception:
+            pass
+
+
+sender = NodeRedSender()
+
+
+def to_node_red(msg, station=None):
+    sender.put(msg, station)
         
 
 # def nr_run_once(list, pre):
@@ -475,7 +637,7 @@ def send_zone_change(name, **kw):
                     else:
                         name = gv.snames[i]
                     msg = {"station": i + 1, "name": name, "state": 0}
-                    to_node_red(msg)
+                    to_node_red(msg, i + 1)
                 else:
                     if gv.sd["mas"] and gv.sd["mas"] == i + 1:
                         name = "master"
@@ -483,7 +645,7 @@ def send_zone_change(name, **kw):
                         name = gv.snames[i]
                     msg = {"station": i + 1, "name": name, "state": 1}
                     # print("sending message to NR")  # - test
-                    to_node_red(msg)
+                    to_node_red(msg, i + 1)
         prior_srvals = gv.srvals[:]
 
 
@@ -839,3 +1001,48 @@ class handle_requests(object):
             msg = "Unknown request"
             to_node_red(msg)
             return
+
+class handle_batch(object):
+    """
+    Several reads and writes from node-red in one request.
+    POST {"read": [{"gv": "srvals"}, {"sd": "show", "bit": [1, 2]}, ...],
+          "write": [{"sd": "wl", "val": 50}, {"gv": "rovals", "sn": {"1": 60}}, ...]}
+    Writes are all applied, with a single save of gv.sd, or none are
+    if any fails validation. Reads see the values after the writes.
+    """
+    def POST(self):
+        web.header("Content-Type", "application/json")
+        try:
+            data = json.loads(web.data().decode("utf-8"))
+        except ValueError as e:
+            return json.dumps({"error": "invalid JSON: " + str(e)})
+        if isinstance(data, list):
+            data = {"read": data}
+        result = {}
+
+        writes = data.get("write", [])
+        staged = []
+        pending = {}
+        errors = []
+        for req in writes:
+            try:
+                target, key, new = batch_stage(req, pending)
+                pending[(id(target), key)] = new
+                staged.append((target, key, new))
+                errors.append(None)
+            except Exception as e:
+                errors.append(str(e))
+        if any(errors):
+            result["write"] = {"applied": False, "errors": errors}
+        elif writes:
+            batch_commit(staged)
+            result["write"] = {"applied": True, "count": len(staged)}
+
+        reads = []
+        for req in data.get("read", []):
+            try:
+                reads.append(batch_read(req))
+            except Exception as e:
+                reads.append({"error": str(e)})
+        result["read"] = reads
+        return json.dumps(result, default=str)
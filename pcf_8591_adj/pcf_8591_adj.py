@@ -2,7 +2,8 @@
 # This plugin read data (temp or voltage) from I2C PCF8591 on adress 0x48. For temperature probe use LM35D. Power for PCF8591 or LM35D is 5V dc! no 3.3V dc
 
 from __future__ import print_function
-from threading import Thread
+from collections import deque
+from threading import Lock, Thread
 from random import randint
 import json
 import time
@@ -15,6 +16,7 @@ from urls import urls  # Get access to SIP's URLs
 from sip import template_render
 from webpages import ProtectedPage
 from helpers import get_rpi_revision
+from ring_log import RingLog
 
 # I2C bus Rev Raspi RPI=1 rev1 RPI=0 rev0
 try:
@@ -43,6 +45,80 @@ urls.extend(
 # Add this plugin to the home page plugins menu
 gv.plugin_menu.append(["PCF8591 voltage and temperature settings ", "/pcf"])
 
+# Sample log, stored as append-only segments in ./data/pcflog/
+pcflog = RingLog("./data/pcflog", legacy_file="./data/pcflog.json")
+
+################################################################################
+# Sampling engine:                                                             #
+################################################################################
+
+PCF_ADDRESS = 0x48
+PCF_AUTO_INCREMENT = 0x44  # Analog output enabled, auto-increment from AD0
+
+
+class PCFSampler(object):
+    """
+    Reads all four PCF8591 inputs in one I2C block transaction.
+    With the auto-increment flag set the chip returns the previous (stale)
+    conversion first, then AD0-AD3, so the first byte is discarded.
+    Each sample is the mean or median of oversample block reads and is
+    kept, with its timestamp, in a ring buffer that the web pages, the
+    logger and other plugins read from without touching the bus.
+    """
+
+    def __init__(self, bus, address=PCF_ADDRESS, oversample=4, method="mean", history=600):
+        self.bus = bus
+        self.address = address
+        self.oversample = oversample
+        self.method = method
+        self.buffer = deque(maxlen=history)
+        self._lock = Lock()
+
+    def read_block(self):
+        """Return raw AD0-AD3 values from one block read."""
+        data = self.bus.read_i2c_block_data(self.address, PCF_AUTO_INCREMENT, 5)
+        return data[1:5]
+
+    @staticmethod
+    def _median(values):
+        values = sorted(values)
+        mid = len(values) // 2
+        if len(values) % 2:
+            return values[mid]
+        return (values[mid - 1] + values[mid]) / 2.0
+
+    def sample(self):
+        """Take one oversampled reading of all channels and buffer it."""
+        blocks = [self.read_block() for i in range(max(1, self.oversample))]
+        channels = list(zip(*blocks))
+        if self.method == "median":
+            values = [self._median(c) for c in channels]
+        else:
+            values = [sum(c) / float(len(c)) for c in channels]
+        values = [int(round(v)) for v in values]
+        with self._lock:
+            self.buffer.append((time.time(), values))
+        return values
+
+    def latest(self):
+        """Most recent (timestamp, [AD0, AD1, AD2, AD3]) or None."""
+        with self._lock:
+            if self.buffer:
+                return self.buffer[-1]
+        return None
+
+    def history(self, seconds=0):
+        """Buffered samples, oldest first, optionally only the last seconds."""
+        with self._lock:
+            samples = list(self.buffer)
+        if seconds:
+            since = time.time() - seconds
+            samples = [s for s in samples if s[0] >= since]
+        return samples
+
+
+sampler = PCFSampler(ADC)
+
 ################################################################################
 # Main function loop:                                                          #
 ################################################################################
@@ -84,6 +160,12 @@ class PCFSender(Thread):
             try:
                 datapcf = get_pcf_options()  # load data from file
                 if datapcf["use_pcf"] != "off":  # if pcf plugin is enabled
+                    sampler.oversample = int(datapcf["oversample"])
+                    sampler.method = datapcf["method"]
+                    try:
+                        sampler.sample()  # one bus transaction batch per second
+                    except AttributeError:  # no I2C bus
+                        pass
                     if (
                         datapcf["use_log"] != "off" and datapcf["time"] != "0"
                     ):  # if log is enabled and time is not 0 min
@@ -91,10 +173,7 @@ class PCFSender(Thread):
                         if actual_time - last_time > (
                             int(datapcf["time"]) * 60
                         ):  # if is time for save
-                            ad0 = get_now_measure(1)
-                            ad1 = get_now_measure(2)
-                            ad2 = get_now_measure(3)
-                            ad3 = get_now_measure(4)
+                            ad0, ad1, ad2, ad3 = [get_now_measure(i) for i in range(1, 5)]
                             if datapcf["ad0"] != "off":
                                 ad0 = get_volt(ad0)
                             else:
@@ -166,12 +245,11 @@ def get_temp(data):
 
 
 def get_now_measure(AD_pin):
-    """Return number 0-255 from A/D PCF8591 to webpage"""
-    try:
-        ADC.write_byte_data(0x48, (0x40 + AD_pin), AD_pin)
-        return ADC.read_byte(0x48)
-    except AttributeError:
-        return "0"
+    """Return number 0-255 for input AD_pin - 1 from the sample buffer"""
+    last = sampler.latest()
+    if last is None:
+        return 0
+    return last[1][AD_pin - 1]
 
 
 def get_write_DA(Y):  # PCF8591 D/A converter Y=(0-255) for future use
@@ -202,6 +280,8 @@ def get_pcf_options():
         "ad2val": get_now_measure(3),
         "ad3val": get_now_measure(4),
         "da0val": "0",
+        "oversample": "4",
+        "method": "mean",
         "status": checker.status,
     }
     try:
@@ -229,6 +309,8 @@ def get_pcf_options():
             "ad2val": 0,
             "ad3val": 0,
             "da0val": 0,
+            "oversample": "4",
+            "method": "mean",
             "status": "",
         }
 
@@ -241,18 +323,22 @@ def get_pcf_options():
     return datapcf
 
 
-def read_log():
-    """Read pcf log"""
+def read_log(offset=0, limit=0):
+    """
+    Read pcf log - most recent first.
+    Records are read while they are consumed, so errors are handled here
+    as they happen and end the listing early.
+    """
     try:
-        with open("./data/pcflog.json") as logf:
-            records = logf.readlines()
-        return records
-    except IOError:
-        return []
+        max_records = int(get_pcf_options()["records"])
+        for record in pcflog.records(offset, limit, max_records):
+            yield record
+    except (IOError, OSError, ValueError) as e:
+        print("Log could not be read:", e)
 
 
 def write_log(ad0, ad1, ad2, ad3):
-    """Add run data to csv file - most recent first."""
+    """Append run data to the log."""
     datapcf = get_pcf_options()
     logline = (
         '{"Time":"'
@@ -267,13 +353,7 @@ def write_log(ad0, ad1, ad2, ad3):
         + str(ad3)
         + '"}\n'
     )
-    log = read_log()
-    log.insert(0, logline)
-    with open("./data/pcflog.json", "w") as f:
-        if int(datapcf["records"]) != 0:
-            f.writelines(log[: int(datapcf["records"])])
-        else:
-            f.writelines(log)
+    pcflog.append(logline, int(datapcf["records"]))
     return
 
 
@@ -322,14 +402,24 @@ class update(ProtectedPage):
 
 
 class pcf_log(ProtectedPage):  # save log file from web as csv file type
-    """Simple PCF Log API"""
+    """
+    Simple PCF Log API.
+    Optional offset and limit inputs return one page of records.
+    """
 
     def GET(self):
-        records = read_log()
-        data = "Date, Time, AD0, AD1, AD2, AD3\n"
+        qdict = web.input(offset="0", limit="0")
+        try:
+            offset = int(qdict["offset"])
+            limit = int(qdict["limit"])
+        except ValueError:
+            raise web.badrequest()
+        records = read_log(offset, limit)
+        web.header("Content-Type", "text/csv")
+        yield "Date, Time, AD0, AD1, AD2, AD3\n"
         for r in records:
             event = json.loads(r)
-            data += (
+            yield (
                 event["Date"]
                 + ", "
                 + event["Time"]
@@ -344,8 +434,6 @@ class pcf_log(ProtectedPage):  # save log file from web as csv file type
                 + ", "
                 + "\n"
             )
-        web.header("Content-Type", "text/csv")
-        return data
 
 
 class delete_log(ProtectedPage):  # delete log file from web
@@ -353,6 +441,5 @@ class delete_log(ProtectedPage):  # delete log file from web
 
     def GET(self):
         qdict = web.input()
-        with open("./data/pcflog.json", "w") as f:
-            f.write("")
+        pcflog.clear()
         raise web.seeother("/pcf")
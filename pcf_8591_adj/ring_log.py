@@ -0,0 +1,156 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Append-only, segmented record log shared by sensor logging plugins.
+
+Records are JSON lines appended to numbered segment files kept in a
+directory under ./data. A new segment is started once the current one
+holds segment_size lines, and capped retention is applied by deleting
+whole segments, so writing a sample never rewrites earlier records.
+Records are read back newest first, one segment at a time.
+"""
+
+from __future__ import print_function
+
+# standard library imports
+import os
+import threading
+
+SEGMENT_SIZE = 500  # Lines per segment file
+
+
+class RingLog(object):
+    """
+    Ring of segment files, e.g. ./data/pcflog/00000001.json.
+    legacy_file is a single newest-first log written by earlier plugin
+    versions. It is imported once and then removed.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, legacy_file=None):
+        self.path = path
+        self.segment_size = segment_size
+        self.legacy_file = legacy_file
+        self._lock = threading.Lock()
+        self._current = None  # Number of the segment being appended to
+        self._current_lines = 0
+
+    def _segment_name(self, number):
+        return os.path.join(self.path, u"{:08d}.json".format(number))
+
+    def _segments(self):
+        """Return existing segment numbers, oldest first."""
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        numbers = []
+        for name in names:
+            stem, ext = os.path.splitext(name)
+            if ext == u".json" and stem.isdigit():
+                numbers.append(int(stem))
+        return sorted(numbers)
+
+    def _open(self):
+        """Locate the segment to append to. Caller holds the lock."""
+        if self._current is not None:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        segments = self._segments()
+        if segments:
+            self._current = segments[-1]
+            with open(self._segment_name(self._current)) as seg:
+                self._current_lines = sum(1 for line in seg)
+        else:
+            self._current = 1
+            self._current_lines = 0
+            self._import_legacy()
+
+    def _import_legacy(self):
+        """Move records from an old single-file log into segments."""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return
+        with open(self.legacy_file) as legacy:
+            lines = [line for line in legacy if line.strip()]
+        lines.reverse()  # Legacy file is newest first
+        for line in lines:
+            self._write(line)
+        os.remove(self.legacy_file)
+
+    def _write(self, line):
+        if self._current_lines >= self.segment_size:
+            self._current += 1
+            self._current_lines = 0
+        with open(self._segment_name(self._current), u"a") as seg:
+            seg.write(line)
+        self._current_lines += 1
+
+    def _trim(self, max_records):
+        """Drop the oldest segments not needed to hold max_records."""
+        segments = self._segments()
+        keep = -(-max_records // self.segment_size)  # ceil
+        if self._current_lines < self.segment_size:
+            keep += 1  # Partly filled segment does not hold a full share
+        for number in segments[: max(len(segments) - keep, 0)]:
+            try:
+                os.remove(self._segment_name(number))
+            except OSError:
+                pass
+
+    def append(self, line, max_records=0):
+        """
+        Append one record line. max_records of 0 keeps everything.
+        """
+        if not line.endswith(u"\n"):
+            line += u"\n"
+        with self._lock:
+            self._open()
+            self._write(line)
+            if max_records and self._current_lines == 1:
+                self._trim(max_records)  # Only needed when a segment starts
+
+    def records(self, offset=0, limit=0, max_records=0):
+        """
+        Generator yielding record lines newest first.
+        Skips offset records and stops after limit records (0 = all).
+        max_records hides records beyond the retention cap that are still
+        held in the oldest segment.
+        """
+        with self._lock:
+            self._open()
+            segments = self._segments()
+        if max_records:
+            limit = min(limit, max_records - offset) if limit else max_records - offset
+            if limit <= 0:
+                return
+        sent = 0
+        skip = offset
+        for number in reversed(segments):
+            try:
+                with open(self._segment_name(number)) as seg:
+                    lines = seg.readlines()
+            except IOError:
+                continue  # Segment dropped while reading
+            if skip >= len(lines):
+                skip -= len(lines)
+                continue
+            for line in reversed(lines[: len(lines) - skip]):
+                if not line.strip():
+                    continue
+                yield line
+                sent += 1
+                if limit and sent >= limit:
+                    return
+            skip = 0
+
+    def clear(self):
+        """Delete all records."""
+        with self._lock:
+            for number in self._segments():
+                try:
+                    os.remove(self._segment_name(number))
+                except OSError:
+                    pass
+            self._current = None
+            self._current_lines = 0
@@ -3,12 +3,16 @@
 
 # standard library imports
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import json
-import pathlib
+import os
 import re
-import subprocess
+import shutil
+import stat
+import tempfile
 import time
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 # local module imports
 import gv  # Get access to SIP's settings
@@ -19,6 +23,18 @@ import web
 from webpages import ProtectedPage
 
 installed = []
+# Manifest name -> (mtime_ns, description, file list)
+manifest_index = {}
+PLUGIN_DIR = u"plugins"
+MANIFEST_DIR = u"plugins/manifests"
+
+# Plugin repository, may be pointed at a local mirror
+README_URL = u"https://api.github.com/repos/Dan-in-CA/SIP_plugins/readme"
+RAW_URL = u"https://raw.github.com/Dan-in-CA/SIP_plugins/master/"
+CATALOG_FILE = u"./data/plugin_catalog.json"
+CATALOG_TTL = 3600  # Seconds before the catalog is revalidated
+HTTP_TIMEOUT = 15
+DOWNLOAD_WORKERS = 6
 
 # Add new url(s).
 # fmt: off
@@ -35,63 +51,217 @@ gv.plugin_menu.append([_(u"Manage Plugins"), u"/plugins"])
 
 
 def get_permissions():
+    """
+    Return {plugin file: 1 if enabled else 0} for the installed plugins.
+    A plugin is enabled when its file has the group execute bit set.
+    """
     global installed
     try:
-        permissions = []
-        files = subprocess.check_output([u"ls", u"plugins"])
-        files = files.decode(u'utf-8') #  to unicode string
-        installed = [f for f in list(files.split(u"\n")) if re.match("[^_].+\.py$", f)]
-        pm = installed.index(u"plugin_manager.py")
-        del installed[pm]  #  Remove this plugin from list
-        for p in installed:
-            mod = subprocess.check_output([u"stat", u"-c %a", u"plugins/" + p])
-            mod = mod.decode(u'utf-8')
-            permissions.append(int(list(mod.strip())[1]) % 2)
-        settings = dict(list(zip(installed, permissions)))
+        settings = {}
+        with os.scandir(PLUGIN_DIR) as entries:
+            for entry in entries:
+                if entry.name == u"plugin_manager.py":  # Leave out this plugin
+                    continue
+                if re.match(r"[^_].+\.py$", entry.name) and entry.is_file():
+                    settings[entry.name] = 1 if entry.stat().st_mode & stat.S_IXGRP else 0
+        installed = sorted(settings)
         return settings
-    except IOError as e:
+    except OSError as e:
         settings = {}
         return settings
 
 
-def parse_manifest(plugin):
+def _read_manifest(path):
+    with open(path) as mf:
+        mf_list = mf.readlines()
+    sep = [i for i, s in enumerate(mf_list) if u"###" in s][0]
+    desc = u"".join(mf_list[:sep]).rstrip()
+    f_list = [line.strip() for line in mf_list[int(sep) + 2 :] if line.strip()]
+    return desc, f_list
+
+
+def load_manifests():
+    """
+    Bring manifest_index up to date with plugins/manifests. Only manifests
+    whose modification time changed are read again.
+    """
+    seen = set()
     try:
-        with open(u"plugins/manifests/" + plugin + u".manifest") as mf:
-            mf_list = mf.readlines()
-            sep = [i for i, s in enumerate(mf_list) if u"###" in s][0]
-            desc = u"".join(mf_list[:sep]).rstrip()
-            f_list = [line.strip() for line in mf_list[int(sep) + 2 :]]
-            return (desc, f_list)
-    except IOError as e:
+        with os.scandir(MANIFEST_DIR) as entries:
+            for entry in entries:
+                if not entry.name.endswith(u".manifest"):
+                    continue
+                name = entry.name[: -len(u".manifest")]
+                seen.add(name)
+                mtime = entry.stat().st_mtime_ns
+                cached = manifest_index.get(name)
+                if cached is not None and cached[0] == mtime:
+                    continue
+                try:
+                    desc, f_list = _read_manifest(entry.path)
+                except (IOError, IndexError):
+                    desc, f_list = u"", []
+                manifest_index[name] = (mtime, desc, f_list)
+    except OSError:
+        pass
+    for name in list(manifest_index):
+        if name not in seen:
+            del manifest_index[name]
+    return manifest_index
+
+
+def parse_manifest(plugin):
+    entry = load_manifests().get(plugin)
+    if entry is None:
         return (u"", [])
+    return (entry[1], entry[2])
 
 
-def get_readme():
+def delete_plugins(names):
+    """
+    Remove the files of the named plugins. Files that the manifest of
+    another, remaining plugin also lists (shared modules) are kept.
+    """
+    index = load_manifests()
+    keep = set()
+    for other, (mtime, desc, files) in index.items():
+        if other not in names:
+            keep.update(tuple(f.split()[:2]) for f in files)
+    for name in names:
+        desc, files = parse_manifest(name)
+        for f in files:
+            victim = f.split()
+            if len(victim) < 2 or tuple(victim[:2]) in keep:
+                continue
+            paths = [os.path.join(victim[1], victim[0])]
+            if victim[0][-3:] == u".py":
+                paths.append(os.path.join(victim[1], victim[0][:-3] + u".pyc"))
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    load_manifests()
+
+
+def parse_readme(text):
+    """{plugin name: description} from the plugin repository README"""
     plugs = {}
+    t_list = text.split()
+    sep = [i for i, s in enumerate(t_list) if u"***" in s][0]
+    plug_list = t_list[sep + 1 :]
+    breaks = [i for i, s in enumerate(plug_list) if u"---" in s]
+
+    for i in range(len(breaks)):
+        if i < len(breaks) - 1:
+            plugs[plug_list[breaks[i] - 1]] = u" ".join(
+                plug_list[breaks[i] + 1 : breaks[i + 1] - 1]
+            )
+        else:
+            plugs[plug_list[breaks[i] - 1]] = u" ".join(plug_list[breaks[i] + 1 :])
+    return plugs
+
+
+def load_catalog():
     try:
-        response = urlopen(
-            u"https://api.github.com/repos/Dan-in-CA/SIP_plugins/readme"
-        )
+        with open(CATALOG_FILE, u"r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {u"etag": u"", u"fetched": 0, u"plugs": {}}
+
+
+def save_catalog(catalog):
+    tmp = CATALOG_FILE + u".tmp"
+    with open(tmp, u"w") as f:
+        json.dump(catalog, f)
+    os.replace(tmp, CATALOG_FILE)
+
+
+def get_readme():
+    """
+    Return the plugin catalog. A cached copy younger than CATALOG_TTL is
+    used as is; an older one is revalidated with its ETag. When the
+    repository cannot be reached the cached copy is used, however old.
+    """
+    catalog = load_catalog()
+    if catalog[u"plugs"] and time.time() - catalog[u"fetched"] < CATALOG_TTL:
+        return catalog[u"plugs"]
+
+    headers = {}
+    if catalog[u"etag"] and catalog[u"plugs"]:
+        headers[u"If-None-Match"] = catalog[u"etag"]
+    try:
+        response = urlopen(Request(README_URL, headers=headers), timeout=HTTP_TIMEOUT)
         data = response.read()
         d = json.loads(data.decode('utf-8'))
         text = base64.b64decode(d[u"content"]).decode(u'utf-8')
-        t_list = text.split()
-        sep = [i for i, s in enumerate(t_list) if u"***" in s][0]
-        plug_list = t_list[sep + 1 :]
-        breaks = [i for i, s in enumerate(plug_list) if u"---" in s]
-
-
-        for i in range(len(breaks)):
-            if i < len(breaks) - 1:
-                plugs[plug_list[breaks[i] - 1]] = u" ".join(
-                    plug_list[breaks[i] + 1 : breaks[i + 1] - 1]
-                )
-            else:
-                plugs[plug_list[breaks[i] - 1]] = u" ".join(plug_list[breaks[i] + 1 :])
-    except IOError as e:
+        catalog[u"plugs"] = parse_readme(text)
+        catalog[u"etag"] = response.headers.get(u"ETag", u"")
+    except HTTPError as e:
+        if e.code != 304:  # 304: cached copy is still current
+            print(u"We couldn't get readme file for github", e)
+            return catalog[u"plugs"]
+    except (IOError, ValueError, KeyError, IndexError) as e:
         print(u"We couldn't get readme file for github", e)
+        return catalog[u"plugs"]
 
-    return plugs
+    catalog[u"fetched"] = time.time()
+    try:
+        save_catalog(catalog)
+    except IOError as e:
+        print(u"Could not save plugin catalog", e)
+    return catalog[u"plugs"]
+
+
+def fetch(path):
+    """Download a file from the plugin repository"""
+    response = urlopen(RAW_URL + path, timeout=HTTP_TIMEOUT)
+    return response.read()
+
+
+def install(names):
+    """
+    Download every file of the named plugins concurrently and install
+    them together. Files are written to a staging directory first and
+    only moved into place, each with an atomic rename, once all
+    downloads succeeded, so a failed download leaves nothing half
+    installed. Manifests are moved last.
+    """
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        manifests = dict(
+            zip(names, pool.map(lambda p: fetch(p + u"/" + p + u".manifest"), names))
+        )
+        jobs = []  # (source path in repository, destination directory, file name)
+        for p in names:
+            data = manifests[p].decode(u"utf-8").splitlines(True)
+            sep = [i for i, s in enumerate(data) if u"###" in s][0]
+            file_list = [line.strip() for line in data[int(sep) + 2 :] if line.strip()]
+            short_list = [
+                x for x in file_list if not u"data" in x and not u"manifest" in x
+            ]
+            for f in short_list:
+                pf = f.split()
+                jobs.append((p + u"/" + pf[0], pf[1], pf[0]))
+        contents = list(pool.map(lambda job: fetch(job[0]), jobs))
+
+    staging = tempfile.mkdtemp(prefix=u".plugin-install-", dir=u".")
+    try:
+        staged = [(data, job[1], job[2]) for job, data in zip(jobs, contents)]
+        for p in names:
+            staged.append((manifests[p], MANIFEST_DIR, p + u".manifest"))
+
+        moves = []
+        for i, (data, dest_dir, name) in enumerate(staged):
+            tmp = os.path.join(staging, str(i))
+            with open(tmp, u"wb") as f:
+                f.write(data)
+            moves.append((tmp, os.path.join(dest_dir, name)))
+        for tmp, dest in moves:
+            os.makedirs(os.path.dirname(dest) or u".", exist_ok=True)  # If a needed sub-directory is missing
+            os.replace(tmp, dest)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    load_manifests()
 
 
 class plugins(ProtectedPage):
@@ -114,31 +284,25 @@ class update_plugins(ProtectedPage):
         global installed
         qdict = web.input()
         if qdict[u"btnId"] == u"upd":
-            for f in installed:
-                if f in qdict:
-                    command = u"chmod g+x plugins/" + f
-                    subprocess.call(command.split())
-                else:
-                    command = u"chmod g-x plugins/" + f
-                    subprocess.call(command.split())
-                time.sleep(1)
+            for f in installed:  # Only files whose setting changed are touched
+                path = os.path.join(PLUGIN_DIR, f)
+                try:
+                    mode = os.stat(path).st_mode
+                    if f in qdict:
+                        new_mode = mode | stat.S_IXGRP
+                    else:
+                        new_mode = mode & ~stat.S_IXGRP
+                    if new_mode != mode:
+                        os.chmod(path, stat.S_IMODE(new_mode))
+                except OSError as e:
+                    print(u"Could not change permissions of", path, e)
             raise web.seeother(u"/restart")
         if qdict[u"btnId"] == u"del":
             del_list = []
             for k in list(qdict.keys()):  # Get plugins to delete
                 if k[:3] == u"del":
-                    del_list.append(k[4:])
-            for p in del_list:  # get files to delete for each plugin in list
-                name = p.split(u".")[0]
-                desc, files = parse_manifest(name)
-                for f in files:
-                    victim = f.split()
-                    if victim[0][-3:] == u".py":
-                        b_code = victim[0].replace(u".py", u".pyc")
-                        command = u"rm -f " + victim[1] + u"/" + b_code
-                        subprocess.call(command.split())
-                    command = u"rm -f " + victim[1] + u"/" + victim[0]
-                    subprocess.call(command.split())
+                    del_list.append(k[4:].split(u".")[0])
+            delete_plugins(del_list)
             raise web.seeother(u"/restart")
 
 
@@ -159,45 +323,10 @@ class install_plugins(ProtectedPage):
 
     def GET(self):
         qdict = web.input()
-        for p in list(qdict.keys()):  # Get plugins to install
-            #           https://raw.github.com/<username>/<repo>/<branch>/some_directory/file.r #### Example
-            response = urlopen(
-                u"https://raw.github.com/Dan-in-CA/SIP_plugins/master/"
-                + p
-                + u"/"
-                + p
-                + u".manifest"
-            )
-            data = response.readlines()
-            data = [i.decode('utf-8') for i in data]
-            sep = [i for i, s in enumerate(data) if u"###" in s][0]
-            file_list = [line.strip() for line in data[int(sep) + 2 :]]
-            short_list = [
-                x for x in file_list if not u"data" in x and not u"manifest" in x
-            ]
-            with open(u"plugins/manifests/" + p + u".manifest", "w") as new_mf:
-                new_mf.writelines(data)
-            for f in short_list:
-                pf = f.split()
-                response = urlopen(
-                    u"https://raw.github.com/Dan-in-CA/SIP_plugins/master/"
-                    + p
-                    + u"/"
-                    + pf[0]
-                )
-                f_data = response.read()
-                try:
-                    f_data = f_data.decode('utf-8')
-                    with open(pf[1] + u"/" + pf[0], "w") as next_file:
-                        next_file.write(f_data)                        
-                except FileNotFoundError: # If a needed sub-directory is missing
-                    sub = pf[1].split("/")
-                    pathlib.Path("plugins/" + sub[1]).mkdir(exist_ok=True) 
-                    with open(pf[1] + u"/" + pf[0], "w") as next_file:
-                        next_file.write(f_data)                                                  
-                except UnicodeDecodeError:
-                    with open(pf[1] + u"/" + pf[0], "wb") as next_file:
-                        next_file.write(f_data)
+        try:
+            install(list(qdict.keys()))  # Get plugins to install
+        except (IOError, ValueError, IndexError) as e:
+            print(u"Plugin install failed, nothing was installed:", e)
         raise web.seeother(u"/plugins")
 
     class restart_page(ProtectedPage):
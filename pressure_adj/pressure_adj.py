@@ -2,13 +2,14 @@
 # this plugins check pressure in pipe if master station is switched on
 
 from __future__ import print_function
-from threading import Thread
+from threading import Event, Lock, Thread, Timer
 from random import randint
 import json
 import time
 import sys
 import traceback
 
+from blinker import signal
 import web
 import gv  # Get access to ospi's settings
 from urls import urls  # Get access to ospi's URLs
@@ -36,7 +37,50 @@ gv.plugin_menu.append(["Pressure Monitor Settings", "/pressa"])
 # GPIO input pullup:                                                           #
 ################################################################################
 
-from gpio_pins import GPIO as GPIO
+
+class SoftGPIO(object):
+    """
+    Software stand-in for RPi.GPIO.
+    Pin levels are changed with set_level(), which runs any registered
+    edge callback the way the real library does, so the monitor timing
+    can be exercised without hardware.
+    """
+
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    BOTH = 33
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+
+    def setup(self, pin, mode, pull_up_down=None):
+        self.levels.setdefault(pin, 1 if pull_up_down == self.PUD_UP else 0)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def set_level(self, pin, level):
+        if self.levels.get(pin) != level:
+            self.levels[pin] = level
+            if pin in self.callbacks:
+                self.callbacks[pin](pin)
+
+
+try:
+    from gpio_pins import GPIO as GPIO
+except ImportError:
+    GPIO = None
+if GPIO is None:  # No GPIO library on this platform
+    GPIO = SoftGPIO()
+    pin_pressure = 22
 
 try:
     if gv.platform == "pi":  # If this will run on Raspberry Pi:
@@ -46,23 +90,170 @@ try:
 except AttributeError:
     pass
 
+try:
+    if gv.use_pigpio:
+        import pigpio
+
+        pi = pigpio.pi()
+    else:
+        pi = None
+except (AttributeError, ImportError):
+    pi = None
+
 try:
     GPIO.setup(pin_pressure, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 except NameError:
     pass
 
 
+class PressureMonitor(object):
+    """
+    Edge driven pressure supervision.
+    Each edge on the sensor pin starts a short settle timer (debounce);
+    the level read when it expires is the one acted on. While the master
+    station is on, a low (open) sensor arms a watchdog which calls
+    on_fail if the sensor has not closed within timeout seconds.
+    Transient drops between master activations are therefore caught as
+    soon as they happen rather than at the next poll.
+    """
+
+    def __init__(self, gpio, pin, on_fail, debounce=0.05, pi=None, on_change=None):
+        self.gpio = gpio
+        self.pin = pin
+        self.on_fail = on_fail
+        self.on_change = on_change
+        self.debounce = debounce
+        self.timeout = 20
+        self.pi = pi
+        self.master_on = False
+        self.active = False
+        self._cb = None
+        self._settle = None
+        self._watchdog = None
+        self._lock = Lock()
+
+    def read(self):
+        if self.pi is not None:
+            return self.pi.read(gv.pin_map[self.pin])
+        return self.gpio.input(self.pin)
+
+    def start(self):
+        """Register the edge callback. Returns False if not supported."""
+        if self.active:
+            return True
+        try:
+            if self.pi is not None:
+                self._cb = self.pi.callback(
+                    gv.pin_map[self.pin], pigpio.EITHER_EDGE, self._edge
+                )
+            else:
+                self.gpio.add_event_detect(
+                    self.pin, self.gpio.BOTH, callback=self._edge
+                )
+            self.active = True
+        except Exception as err:
+            print(u"Pressure plugin: edge detection not available:", err)
+        return self.active
+
+    def stop(self):
+        with self._lock:
+            self._cancel_timers()
+            self.master_on = False
+        if not self.active:
+            return
+        try:
+            if self._cb is not None:
+                self._cb.cancel()
+                self._cb = None
+            else:
+                self.gpio.remove_event_detect(self.pin)
+        except Exception:
+            pass
+        self.active = False
+
+    def _cancel_timers(self):
+        for t in (self._settle, self._watchdog):
+            if t is not None:
+                t.cancel()
+        self._settle = None
+        self._watchdog = None
+
+    def _edge(self, *args):
+        with self._lock:
+            if self._settle is not None:
+                self._settle.cancel()
+            self._settle = Timer(self.debounce, self._settled)
+            self._settle.daemon = True
+            self._settle.start()
+
+    def _settled(self):
+        level = self.read()
+        with self._lock:
+            self._settle = None
+            self._check(level)
+        self._changed(level)
+
+    def set_master(self, on):
+        """Called when the master station switches."""
+        level = self.read()
+        with self._lock:
+            self.master_on = on
+            self._check(level)
+        self._changed(level)
+
+    def _changed(self, level):
+        if self.on_change is not None:
+            self.on_change(self.master_on, level)
+
+    def _check(self, level):
+        """Arm or disarm the watchdog. Caller holds the lock."""
+        if self.master_on and level == 0:
+            if self._watchdog is None:  # Never extend a running deadline
+                self._watchdog = Timer(self.timeout, self._expired)
+                self._watchdog.daemon = True
+                self._watchdog.start()
+        elif self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    def _expired(self):
+        level = self.read()
+        with self._lock:
+            self._watchdog = None
+            failed = self.master_on and level == 0
+        if failed:
+            self.on_fail()
+
+
 ################################################################################
 # Main function loop:                                                          #
 ################################################################################
 
 
+def master_station_on():
+    """True if a master station is in use (not manual mode) and is on."""
+    return bool(
+        gv.sd["mas"]
+        and not gv.sd["mm"]
+        and gv.srvals[gv.sd["mas"] - 1]
+    )
+
+
 class PressureSender(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ""
+        self._state = ""
+        self.failed = Event()
+        self.alarm = False
+        try:
+            self.monitor = PressureMonitor(
+                GPIO, pin_pressure, self.pressure_failed, pi=pi, on_change=self.sensor_changed
+            )
+        except NameError:
+            self.monitor = None
+        self.start()
 
         self._sleep_time = 0
 
@@ -73,8 +264,18 @@ class PressureSender(Thread):
             self.status = msg
         print(msg)
 
+    def set_state(self, msg):
+        """Show msg as the current state, replacing the previous one."""
+        if msg == self._state:
+            return
+        if self._state and self.status.endswith(self._state):
+            self.status = self.status[: -len(self._state)].rstrip("\n")
+        self._state = msg
+        self.add_status(msg)
+
     def update(self):
         self._sleep_time = 0
+        self.failed.set()  # Wake the edge mode loop to reload settings
 
     def _sleep(self, secs):
         self._sleep_time = secs
@@ -82,23 +283,82 @@ class PressureSender(Thread):
             time.sleep(1)
             self._sleep_time -= 1
 
+    def sensor_changed(self, master_on, level):
+        """Edge mode status, from the sensor edges and master switching."""
+        if not gv.sd["mas"] or gv.sd["mm"]:
+            self.set_state("Not used master station.")
+        elif not master_on:
+            self.set_state("Waiting...")
+        elif level == 0:
+            self.set_state("Master station is ON, waiting for the pressure sensor.")
+        else:
+            self.set_state("Pressure sensor is active - pressure in pipeline is OK.")
+
+    def pressure_failed(self):
+        """Watchdog callback: sensor did not activate in time."""
+        stop_stations()
+        self.add_status(
+            "Pressure sensor is not activated in time -> stops all stations and sends email."
+        )
+        self._state = ""  # Keep the alarm in the status
+        self.alarm = True
+        self.failed.set()
+
+    def use_edges(self, datapressure):
+        """Start or stop edge monitoring to match the settings."""
+        if self.monitor is None:
+            return False
+        if datapressure["press"] != "off" and datapressure.get("edge", "on") != "off":
+            self.monitor.timeout = int(datapressure["time"])
+            if self.monitor.start():
+                self.monitor.set_master(master_station_on())
+                return True
+        self.monitor.stop()
+        return False
+
+    def send_email(self):
+        SUBJ = "Reporting from ospi"  # Subject in email
+        TEXT = (
+            "On "
+            + time.strftime("%d.%m.%Y at %H:%M:%S", time.localtime(time.time()))
+            + " System detected error: pressure sensor."
+        )
+        try:
+            from plugins.email_adj import email
+
+            email(SUBJ, TEXT)  # send email without attachments
+            self.add_status("Email was sent: " + TEXT)
+            return True
+        except Exception as err:
+            self.add_status("Email was not sent! " + str(err))
+            return False
+
     def run(self):
         time.sleep(
             randint(3, 10)
         )  # Sleep some time to prevent printing before startup information
         print("Pressure plugin is active")
         send = False
-        SUBJ = "Reporting from ospi"  # Subject in email
-        self.add_status("Waiting...")
+        self.set_state("Waiting...")
 
         while True:
             try:
                 datapressure = get_pressure_options()  # load data from file
+                if self.use_edges(datapressure):
+                    # Edge mode: sleep until the watchdog fires or settings change
+                    self.failed.wait()
+                    self.failed.clear()
+                    if self.alarm:
+                        self.alarm = False
+                        if datapressure["sendeml"] != "off":  # if enabled send email
+                            self.send_email()
+                    continue
+
                 if datapressure["press"] != "off":  # if pressure plugin is enabled
                     if (gv.sd["mas"] != 0) and not (
                         gv.sd["mm"]
                     ):  # if is use master station and not manual control
-                        if gv.srvals[gv.sd["mas"]] != 0:  # if master station is ON
+                        if master_station_on():  # if master station is ON
                             if GPIO.input(pin_pressure) == 0:  # if sensor is open
                                 self._sleep(
                                     int(datapressure["time"])
@@ -119,22 +379,8 @@ class PressureSender(Thread):
                         self.status = ""
                         self.add_status("Not used master station.")
 
-                if send:
-                    TEXT = (
-                        "On "
-                        + time.strftime(
-                            "%d.%m.%Y at %H:%M:%S", time.localtime(time.time())
-                        )
-                        + " System detected error: pressure sensor."
-                    )
-                    try:
-                        from plugins.email_adj import email
-
-                        email(SUBJ, TEXT)  # send email without attachments
-                        self.add_status("Email was sent: " + TEXT)
-                        send = False
-                    except Exception as err:
-                        self.add_status("Email was not sent! " + str(err))
+                if send and self.send_email():
+                    send = False
 
                 self._sleep(1)
 
@@ -149,6 +395,16 @@ class PressureSender(Thread):
 
 checker = PressureSender()
 
+
+def notify_zone_change(name, **kw):
+    """Arm or disarm the pressure watchdog when the master station switches."""
+    if checker.monitor is not None and checker.monitor.active:
+        checker.monitor.set_master(master_station_on())
+
+
+zones = signal("zone_change")
+zones.connect(notify_zone_change)
+
 ################################################################################
 # Helper functions:                                                            #
 ################################################################################
@@ -160,6 +416,7 @@ def get_pressure_options():
         "time": 20,
         "press": "off",
         "sendeml": "off",
+        "edge": "on",
         "sensor": get_pressure_sensor(),
         "status": checker.status,
     }
@@ -216,6 +473,8 @@ class update(ProtectedPage):
             qdict["press"] = "off"
         if "sendeml" not in qdict:
             qdict["sendeml"] = "off"
+        if "edge" not in qdict:
+            qdict["edge"] = "off"
         with open("./data/pressure_adj.json", "w") as f:  # write the settings to file
             json.dump(qdict, f)
         checker.update()
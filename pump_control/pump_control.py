@@ -14,6 +14,7 @@ from urls import urls  # Get access to SIP's URLs
 from sip import template_render
 from webpages import ProtectedPage
 from helpers import get_rpi_revision
+from ring_log import RingLog
 from blinker import signal
 
 # I2C bus Rev Raspi RPI=1 rev1 RPI=0 rev0
@@ -46,6 +47,9 @@ gv.plugin_menu.append(["Pump Control settings", "/pcontrol"])
 # Define Alarm Signal
 alarm = signal("alarm_toggled")
 
+# Sample log, stored as append-only segments in ./data/pump_control_log/
+pclog = RingLog("./data/pump_control_log", legacy_file="./data/pump_control_log.json")
+
 ################################################################################
 # Main function loop:                                                          #
 ################################################################################
@@ -222,18 +226,22 @@ def get_pump_control_options():
     return datapc
 
 
-def read_log():
-    """Read pump_control log"""
+def read_log(offset=0, limit=0):
+    """
+    Read pump_control log - most recent first.
+    Records are read while they are consumed, so errors are handled here
+    as they happen and end the listing early.
+    """
     try:
-        with open("./data/pump_control_log.json") as logf:
-            records = logf.readlines()
-        return records
-    except IOError:
-        return []
+        max_records = int(get_pump_control_options()["records"])
+        for record in pclog.records(offset, limit, max_records):
+            yield record
+    except (IOError, OSError, ValueError) as e:
+        print("Log could not be read:", e)
 
 
 def write_log(pressure, status):
-    """Add run data to csv file - most recent first."""
+    """Append run data to the log."""
     datapc = get_pump_control_options()
     logline = (
         '{"Time":"'
@@ -244,13 +252,7 @@ def write_log(pressure, status):
         + str(status)
         + '"}\n'
     )
-    log = read_log()
-    log.insert(0, logline)
-    with open("./data/pump_control_log.json", "w") as f:
-        if int(datapc["records"]) != 0:
-            f.writelines(log[: int(datapc["records"])])
-        else:
-            f.writelines(log)
+    pclog.append(logline, int(datapc["records"]))
     return
 
 
@@ -300,14 +302,24 @@ class update(ProtectedPage):
 
 
 class pump_control_log(ProtectedPage):  # save log file from web as csv file type
-    """Simple PCF Log API"""
+    """
+    Simple PCF Log API.
+    Optional offset and limit inputs return one page of records.
+    """
 
     def GET(self):
-        records = read_log()
-        data = "Date, Time, Pressure, Pump Control Status\n"
+        qdict = web.input(offset="0", limit="0")
+        try:
+            offset = int(qdict["offset"])
+            limit = int(qdict["limit"])
+        except ValueError:
+            raise web.badrequest()
+        records = read_log(offset, limit)
+        web.header("Content-Type", "text/csv")
+        yield "Date, Time, Pressure, Pump Control Status\n"
         for r in records:
             event = json.loads(r)
-            data += (
+            yield (
                 event["Date"]
                 + ", "
                 + event["Time"]
@@ -317,8 +329,6 @@ class pump_control_log(ProtectedPage):  # save log file from web as csv file typ
                 + str(event["Status"])
                 + "\n"
             )
-        web.header("Content-Type", "text/csv")
-        return data
 
 
 class delete_log(ProtectedPage):  # delete log file from web
@@ -326,6 +336,5 @@ class delete_log(ProtectedPage):  # delete log file from web
 
     def GET(self):
         qdict = web.input()
-        with open("./data/pump_control_log.json", "w") as f:
-            f.write("")
+        pclog.clear()
         raise web.seeother("/pcontrol")
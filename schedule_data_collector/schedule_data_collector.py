@@ -13,17 +13,22 @@ import gv  # Get access to SIP's settings
 # import web  # web.py framework
 # from webpages import ProtectedPage  # Needed for security
 
-import datetime
+import glob
 import os
 
+import rollup
+
 # Add this plugin to the PLUGINS menu ["Menu Name", "URL"], (Optional)
 # gv.plugin_menu.append([_("Schedule Data Collector"), "/schedule_data_collector"])
 
 settings = {}
 SCHEDULE_DATA_PATH = "./static/data/schedule_data_collector"
 CONFIG_FILE_PATH = "./data/schedule_data_collector.json"
+ROLLUP_STATE_PATH = "./data/schedule_data_collector_rollup.json"
 # 60 days, in seconds
 RETENTION = 86400 * 60
+# Runs are logged when they end, stamped with their start time
+ROLLUP_LAG = 3600 * 6
 
 
 def validate_int_list(int_list):
@@ -64,51 +69,17 @@ def log_stat(timestamp, value, station, period, stat):
         f.write(f"{timestamp * 1000},{value}\n")
 
 
-def accumulate_data_files():
-    """Sum the discrete values for a day and save an accumulated
-    daily total.
-
-    As I do not know if this functionality is required I will leave it
-    for the next version of the plugin"""
-
-    return
+def data_files():
+    """The discrete data files, one per station and statistic"""
+    return glob.glob(os.path.join(SCHEDULE_DATA_PATH, "discrete", "*.csv"))
 
-    now = datetime.datetime.now()
 
-    # for station in settings["stations"].keys():
-    for station in range(0, len(gv.snames)):
-        for stat in ["planned", "actual", "diff"]:
-            discrete_data_file = os.path.join(
-                SCHEDULE_DATA_PATH, "discrete", station + "_" + stat + ".csv"
-            )
-            accumulated_data_file = os.path.join(
-                SCHEDULE_DATA_PATH, "daily", station + "_" + stat + ".csv"
-            )
-            if os.path.isfile(discrete_data_file):
-                if os.path.isfile(accumulated_data_file):
-                    # Could read the file contents to get last entry but is it
-                    # worth it?
-                    last_accumulated = datetime.fromtimestamp(
-                        os.path.getmtime(accumulated_data_file)
-                    )
-                else:
-                    last_accumulated = now - datetime.timedelta(days=5)
-
-                next_accumulate_midnight = last_accumulated.replace(
-                    hour=0, minute=0, second=0, microsecond=0
-                ) + datetime.timedelta(days=2)
-
-                if next_accumulate_midnight > now:
-                    continue
-
-                period_start = next_accumulate_midnight - datetime.timedelta(days=1)
-                period_end = next_accumulate_midnight
-                duration = 0
-                with open(discrete_data_file, "r") as f:
-                    for line in f:
-                        fields = line.split(",")
-                        timestamp = datetime.fromtimestamp(fields[0])
-                        print(timestamp)
+def accumulate_data_files():
+    """Bring the hourly and daily rollups (min, max, mean, sum and count)
+    of the discrete data files up to date. Only samples logged since the
+    last run are read.
+    """
+    rollups.run(data_files(), gv.now)
 
 
 def truncate_data_files():
@@ -162,9 +133,7 @@ def truncate_data_files():
 
 def process_data_files(name, **kw):
     """Remove readings from data files that are past the retention
-    period. Only process files once a week to save disk IO. Store that
-    last truncate timestamp as the new_day signal is also sent on
-    startup.
+    period and update the rollups. Also sent on startup.
     """
     truncate_data_files()
     accumulate_data_files()
@@ -214,6 +183,10 @@ def schedule_data_collector_init():
 
     load_schedule_data_collector_settings()
 
+    rollups.start_hourly(data_files, lambda: gv.now)
+
+
+rollups = rollup.Rollup(ROLLUP_STATE_PATH, lag=ROLLUP_LAG)
 
 new_day_signal = signal("new_day")
 new_day_signal.connect(process_data_files)
@@ -0,0 +1,222 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shared hourly and daily rollups of chart data files.
+
+Data plugins write CSV series of x,y rows, where x is a timestamp in
+milliseconds, under ./static/data. Rollup.run() keeps for each series an
+hourly and a daily file of complete buckets under ./static/data/rollup,
+laid out like the source tree:
+
+    static/data/moisture_sensor_data/bed1
+    static/data/rollup/hourly/moisture_sensor_data/bed1
+    static/data/rollup/daily/moisture_sensor_data/bed1
+
+Rollup rows are x,y,min,max,sum,count with x the bucket start and y the
+mean, so a rollup file charts like its source. Hourly rows are built
+from the source samples and daily rows from the hourly rows. Each run
+reads only what was appended since the last one: a high-water mark
+(the end of the last bucket written) and the byte offset to resume from
+are kept per file in the owning plugin's state file. Samples that arrive
+for a bucket that has already been written are ignored; plugins that log
+samples late (e.g. at the end of a run, stamped with its start) give a
+lag so buckets are only closed that long after they end.
+"""
+
+from __future__ import print_function
+
+# standard library imports
+import json
+import os
+import threading
+import time
+
+DATA_PATH = u"./static/data"
+ROLLUP_PATH = u"./static/data/rollup"
+HEADER = u"x,y,min,max,sum,count\n"
+# Resolution name -> bucket length in milliseconds, finest first
+RESOLUTIONS = [(u"hourly", 3600 * 1000), (u"daily", 86400 * 1000)]
+
+
+def rollup_path(source, resolution):
+    """The rollup file of a source data file"""
+    rel = os.path.relpath(os.path.normpath(source), os.path.normpath(DATA_PATH))
+    return os.path.join(ROLLUP_PATH, resolution, rel)
+
+
+def _read_new(path, state, hw, cutoff):
+    """
+    Read the complete rows of path with hw <= x < cutoff as
+    (x, min, max, sum, count), starting at the saved offset when the file
+    is the same one. Returns (rows, offset to resume from, inode).
+    """
+    rows = []
+    try:
+        st = os.stat(path)
+    except OSError:
+        return rows, 0, None
+    offset = state.get(u"offset", 0)
+    if state.get(u"ino") != st.st_ino or offset > st.st_size:
+        offset = 0  # replaced or truncated; hw skips what was done
+
+    with open(path, u"rb") as f:
+        f.seek(offset)
+        data = f.read()
+    resume = None
+    pos = offset
+    for line in data.split(b"\n")[:-1]:  # leave a partly written last line
+        start = pos
+        pos += len(line) + 1
+        parts = line.split(b",")
+        try:
+            x = float(parts[0])
+            if len(parts) >= 6:  # a rollup row
+                row = (x, float(parts[2]), float(parts[3]), float(parts[4]), int(parts[5]))
+            else:
+                y = float(parts[1])
+                row = (x, y, y, y, 1)
+        except (IndexError, ValueError):
+            continue  # header or bad row
+        if x >= cutoff:
+            # Bucket still open; read this row again next time
+            if resume is None:
+                resume = start
+            continue
+        if x >= hw:
+            rows.append(row)
+    if resume is None:
+        resume = pos
+    return rows, resume, st.st_ino
+
+
+def _append_buckets(path, rows, size):
+    """Aggregate rows into buckets of size ms and append them to path"""
+    buckets = {}
+    for x, lo, hi, total, count in rows:
+        key = int(x // size * size)
+        b = buckets.get(key)
+        if b is None:
+            buckets[key] = [lo, hi, total, count]
+        else:
+            b[0] = min(b[0], lo)
+            b[1] = max(b[1], hi)
+            b[2] += total
+            b[3] += count
+    if not buckets:
+        return
+
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, u"w") as f:
+            f.write(HEADER)
+    with open(path, u"a") as f:
+        for key in sorted(buckets):
+            lo, hi, total, count = buckets[key]
+            f.write(
+                u"{},{},{},{},{},{}\n".format(
+                    key, _num(total / count), _num(lo), _num(hi), _num(total), count
+                )
+            )
+
+
+def _num(v):
+    """Short text for a value; whole numbers without a decimal point"""
+    v = round(v, 3)
+    return int(v) if v == int(v) else v
+
+
+class Rollup(object):
+    """
+    Rollups for the data files of one plugin. The state (high-water
+    marks and offsets) is saved in state_file. lag is in seconds.
+    """
+
+    def __init__(self, state_file, lag=0):
+        self.state_file = state_file
+        self.lag = lag
+        self._lock = threading.Lock()
+        self._timer = None
+        try:
+            with open(state_file, u"r") as f:
+                self.state = json.load(f)
+        except (IOError, ValueError):
+            self.state = {}
+
+    def _save(self):
+        tmp = self.state_file + u".tmp"
+        with open(tmp, u"w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_file)
+
+    def run(self, sources, now):
+        """
+        Bring the rollups of sources up to date with the buckets that are
+        complete at now (seconds, as gv.now).
+        """
+        now_ms = int(now - self.lag) * 1000
+        with self._lock:
+            for source in sources:
+                if not os.path.isfile(source):
+                    continue
+                src = source
+                for resolution, size in RESOLUTIONS:
+                    dst = rollup_path(source, resolution)
+                    key = resolution + u":" + source
+                    st = self.state.get(key, {})
+                    hw = st.get(u"hw", 0)
+                    cutoff = now_ms // size * size
+                    if hw < cutoff:
+                        try:
+                            rows, offset, ino = _read_new(src, st, hw, cutoff)
+                            _append_buckets(dst, rows, size)
+                        except (IOError, OSError) as e:
+                            print(u"Rollup of {} failed:".format(src), e)
+                            break
+                        self.state[key] = {u"hw": cutoff, u"offset": offset, u"ino": ino}
+                    src = dst  # the next resolution is built from this one
+            self._save()
+
+    def rename(self, old, new):
+        """Move the rollups and state of a renamed source"""
+        with self._lock:
+            for resolution, size in RESOLUTIONS:
+                old_path = rollup_path(old, resolution)
+                if os.path.isfile(old_path):
+                    new_path = rollup_path(new, resolution)
+                    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                    os.replace(old_path, new_path)
+                st = self.state.pop(resolution + u":" + old, None)
+                if st is not None:
+                    self.state[resolution + u":" + new] = st
+            self._save()
+
+    def remove(self, source):
+        """Delete the rollups and state of a deleted source"""
+        with self._lock:
+            for resolution, size in RESOLUTIONS:
+                path = rollup_path(source, resolution)
+                if os.path.isfile(path):
+                    os.remove(path)
+                self.state.pop(resolution + u":" + source, None)
+            self._save()
+
+    def start_hourly(self, sources, now):
+        """
+        Run every hour, shortly after the hour, on a daemon thread.
+        sources and now are callables returning the source list and the
+        current time (seconds, as gv.now).
+        """
+
+        def loop():
+            while True:
+                t = now()
+                time.sleep(3600 - t % 3600 + 5)
+                try:
+                    self.run(sources(), now())
+                except Exception as e:
+                    print(u"Rollup failed:", e)
+
+        self._timer = threading.Thread(target=loop)
+        self._timer.daemon = True
+        self._timer.start()
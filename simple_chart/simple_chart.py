@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 
 # standard library imports
+from bisect import bisect_left, bisect_right
+import datetime
 import json  # for working with data file
+from threading import Lock
 
 # local module imports
 import gv  # Get access to SIP's settings
@@ -15,6 +18,8 @@ import os
 import re
 import glob
 
+import rollup
+
 
 # Add new URLs to access classes in this plugin.
 # fmt: off
@@ -22,6 +27,7 @@ urls.extend([
     u"/simple_chart", u"plugins.simple_chart.display_charts",
     u"/simple_chart-save", u"plugins.simple_chart.save_settings",
     u"/simple_chart_config", u"plugins.simple_chart.get_settings",
+    u"/simple_chart-data", u"plugins.simple_chart.chart_data",
 
     ])
 # fmt: on
@@ -33,6 +39,13 @@ settings = {}
 CONFIG_FILE_PATH = "./data/simple_chart.json"
 CONFIG_DIR_PATH = "./data/simple_chart"
 
+DEFAULT_WIDTH = 1000  # points returned when the page does not give a width
+MAX_WIDTH = 5000
+
+# Parsed series: path -> {"stat": (ino, size, mtime_ns), "offset", "x", "y"}
+series_cache = {}
+series_lock = Lock()
+
 
 def load_settings():
     global settings
@@ -93,6 +106,187 @@ def load_settings():
         settings[chart_name]["data"].sort()
 
 
+def _parse_lines(lines, xs, ys):
+    """Append numeric x,y rows to xs, ys. Returns False if x went backwards."""
+    ordered = True
+    for line in lines:
+        parts = line.split(",")
+        if len(parts) < 2:
+            continue
+        try:
+            x = float(parts[0])
+            y = float(parts[1])
+        except ValueError:
+            continue  # header or bad row
+        if xs and x < xs[-1]:
+            ordered = False
+        xs.append(x)
+        ys.append(y)
+    return ordered
+
+
+def load_series(path):
+    """
+    Return (x, y) lists for a CSV data file, sorted by x.
+    Parsed files are cached; when a file has only grown since it was last
+    read, just the new lines are parsed. Files that were rewritten or
+    replaced (e.g. trimmed by the producing plugin) are parsed again.
+    """
+    st = os.stat(path)
+    stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+    with series_lock:
+        cached = series_cache.get(path)
+        if cached and cached["stat"] == stat:
+            return cached["x"], cached["y"]
+
+        if (
+            cached
+            and cached["stat"][0] == st.st_ino
+            and cached["offset"] <= st.st_size
+            and cached["stat"][1] <= st.st_size
+        ):
+            xs, ys, offset = cached["x"], cached["y"], cached["offset"]
+        else:
+            xs, ys, offset = [], [], 0
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # Leave a partly written last line for the next read
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].decode("utf-8", "replace").splitlines()
+        if not _parse_lines(lines, xs, ys):
+            pairs = sorted(zip(xs, ys))
+            xs = [p[0] for p in pairs]
+            ys = [p[1] for p in pairs]
+
+        series_cache[path] = {
+            "stat": stat,
+            "offset": offset + end,
+            "x": xs,
+            "y": ys,
+        }
+        return xs, ys
+
+
+def lttb(xs, ys, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Keeps the first and last
+    points and from each bucket in between the point forming the largest
+    triangle with the previous kept point and the next bucket's average.
+    Returns a list of indexes into xs, ys.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    every = (n - 2) / (threshold - 2)
+    keep = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, n)
+        count = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / count
+        avg_y = sum(ys[next_start:next_end]) / count
+
+        ax = xs[a]
+        ay = ys[a]
+        best = start
+        best_area = -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = j
+        keep.append(best)
+        a = best
+    keep.append(n - 1)
+    return keep
+
+
+def min_max(xs, ys, threshold):
+    """
+    Min/max bucketing. Splits the points into threshold / 2 buckets and
+    keeps the lowest and highest point of each, in time order, so peaks
+    are never lost. Returns a list of indexes into xs, ys.
+    """
+    n = len(xs)
+    buckets = threshold // 2
+    if threshold >= n or buckets < 1:
+        return list(range(n))
+
+    every = n / buckets
+    keep = []
+    for i in range(buckets):
+        start = int(i * every)
+        end = int((i + 1) * every)
+        lo = hi = start
+        for j in range(start + 1, end):
+            if ys[j] < ys[lo]:
+                lo = j
+            elif ys[j] > ys[hi]:
+                hi = j
+        keep.extend(sorted({lo, hi}))
+    return keep
+
+
+def pick_resolution(path, start, end, width, res):
+    """
+    Choose the file to serve: the coarsest rollup of path that still
+    gives at least a quarter of width buckets over the window (res=auto),
+    the rollup named by res, or the raw file. Returns (name, size ms,
+    file path); size is 0 for the raw file.
+    """
+    if res == "raw":
+        return "raw", 0, path
+    for name, size in reversed(rollup.RESOLUTIONS):
+        if res not in ("auto", name):
+            continue
+        rollup_file = rollup.rollup_path(path, name)
+        if not os.path.isfile(rollup_file):
+            continue
+        if res == name:
+            return name, size, rollup_file
+        if start is not None and end is not None and (end - start) / size >= width / 4:
+            return name, size, rollup_file
+    return "raw", 0, path
+
+
+def series_window(xs, ys, start, end, width, mode):
+    """
+    Points of the series between start and end (ms), plus one either side
+    so lines run to the chart edges, downsampled to about width points.
+    """
+    lo = 0 if start is None else max(bisect_left(xs, start) - 1, 0)
+    hi = len(xs) if end is None else min(bisect_right(xs, end) + 1, len(xs))
+    wx = xs[lo:hi]
+    wy = ys[lo:hi]
+    if mode == "minmax":
+        keep = min_max(wx, wy, width)
+    else:
+        keep = lttb(wx, wy, width)
+    return [{"x": wx[i], "y": wy[i]} for i in keep]
+
+
+def not_modified(etag, last_modified):
+    """
+    Set the ETag and Last-Modified headers and check them against the
+    request. The ETag is preferred when the browser sends one, since
+    Last-Modified only has one second resolution.
+    """
+    web.header("ETag", f'"{etag}"')
+    web.lastmodified(last_modified)
+    if_none_match = web.ctx.env.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        tags = [t.strip().lstrip("W/").strip('"') for t in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    since = web.parsehttpdate(web.ctx.env.get("HTTP_IF_MODIFIED_SINCE", "").split(";")[0])
+    return since is not None and last_modified <= since
+
+
 class display_charts(ProtectedPage):
     """
     Load an html page for entering plugin settings.
@@ -122,6 +316,61 @@ class get_settings(ProtectedPage):
         return template_render.simple_chart_config(settings)
 
 
+class chart_data(ProtectedPage):
+    """
+    Return one data file of a chart as JSON [{x, y}, ...], limited to the
+    window start..end (ms timestamps) and downsampled to width points
+    with LTTB (default) or min/max buckets (mode=minmax).
+    Long windows are served from the hourly or daily rollup when one
+    exists (res=auto, or res=raw, hourly or daily to choose).
+    Responses carry ETag and Last-Modified so unchanged data is answered
+    with 304 Not Modified.
+    """
+
+    def GET(self):
+        qdict = web.input(file="", start="", end="", width="", mode="lttb", res="auto")
+
+        path = qdict.file
+        if not any(path in settings[c]["data"] for c in settings):
+            load_settings()  # a new data file may have appeared
+            if not any(path in settings[c]["data"] for c in settings):
+                raise web.notfound()
+
+        try:
+            start = float(qdict.start) if qdict.start else None
+            end = float(qdict.end) if qdict.end else None
+            width = int(qdict.width) if qdict.width else DEFAULT_WIDTH
+        except ValueError:
+            raise web.badrequest()
+        width = max(3, min(width, MAX_WIDTH))
+        mode = "minmax" if qdict.mode == "minmax" else "lttb"
+
+        resolution, size, data_path = pick_resolution(path, start, end, width, qdict.res)
+
+        try:
+            stats = [os.stat(p) for p in ([path] if path == data_path else [path, data_path])]
+        except OSError:
+            raise web.notfound()
+
+        etag = "-".join(f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}" for st in stats)
+        etag += f"-{qdict.start}-{qdict.end}-{width}-{mode}-{resolution}"
+        last_modified = datetime.datetime.utcfromtimestamp(int(max(st.st_mtime for st in stats)))
+        web.header("Cache-Control", "no-cache")
+        if not_modified(etag, last_modified):
+            raise web.notmodified()
+
+        xs, ys = load_series(data_path)
+        if size:
+            # Rollups hold complete buckets only; finish with raw samples
+            raw_xs, raw_ys = load_series(path)
+            tail = bisect_left(raw_xs, xs[-1] + size if xs else 0)
+            xs = xs + raw_xs[tail:]
+            ys = ys + raw_ys[tail:]
+        web.header("Content-Type", "application/json")
+        web.header("X-Resolution", resolution)
+        return json.dumps(series_window(xs, ys, start, end, width, mode))
+
+
 class save_settings(ProtectedPage):
     """
     Save user input to json file.
@@ -29,6 +29,8 @@ import traceback
 from blinker import signal
 import gv  # Get access to SIP's settings
 from helpers import timestr
+import notify_outbox
+import sip_log
 from sip import template_render
 from urls import urls  # Get access to SIP's URLs
 import web
@@ -86,35 +88,85 @@ def get_email_options():
     return email_dat
 
 
-def email(subject, msg): #  Send an email message
-    """Send email"""
-    email_dat = get_email_options()
+def _smtp_settings(email_dat):
     # fmt: off
-    if (email_dat["emlSender"]
-        and email_dat["appPwd"] 
-        and email_dat["sendTo"] 
+    if not (email_dat["emlSender"]
+        and email_dat["appPwd"]
+        and email_dat["sendTo"]
         ):
-        mail_from = email_dat["emlSender"]  # Gmail address
-        app_pwd = email_dat["appPwd"]  # Gmail app password
-        mail_to = email_dat["sendTo"]  # Recipient address (can be same as mail_from)
-        smtp_server = email_dat["smtpServer"] # SMTP server
-        port = email_dat["smtpPort"] # SMTP port
-    # fmt: on
-        message = EmailMessage()
-        message.set_content(msg)
-        message["Subject"] = subject
-        message["From"] = mail_from
-        message["To"] = mail_to      
-         
-        # Create a secure SSL context      
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-            server.login(mail_from, app_pwd)
-            server.sendmail(
-                mail_from, mail_to, message.as_string()
-            )                    
-    else:
         raise Exception("E-mail plug-in is not properly configured!")
+    # fmt: on
+
+
+def _message(email_dat, subject, msg):
+    message = EmailMessage()
+    message.set_content(msg)
+    message["Subject"] = subject
+    message["From"] = email_dat["emlSender"]  # Gmail address
+    message["To"] = email_dat["sendTo"]  # Recipient address (can be same as mail_from)
+    return message
+
+
+def _connect(email_dat):
+    """Open and log in to the SMTP server."""
+    # Create a secure SSL context
+    context = ssl.create_default_context()
+    server = smtplib.SMTP_SSL(
+        email_dat["smtpServer"], email_dat["smtpPort"], context=context
+    )
+    server.login(email_dat["emlSender"], email_dat["appPwd"])  # Gmail app password
+    return server
+
+
+def email(subject, msg): #  Send an email message
+    """Send email now (blocking)"""
+    email_dat = get_email_options()
+    _smtp_settings(email_dat)
+    message = _message(email_dat, subject, msg)
+    with _connect(email_dat) as server:
+        server.sendmail(
+            email_dat["emlSender"], email_dat["sendTo"], message.as_string()
+        )
+
+
+class EmailChannel(notify_outbox.Channel):
+    """
+    Delivers queued email. One SMTP login is shared by every message
+    in a batch.
+    """
+
+    name = "sip_email"
+    min_interval = 2.0
+
+    def __init__(self):
+        self.server = None
+        self.email_dat = None
+
+    def open(self):
+        self.email_dat = get_email_options()
+        _smtp_settings(self.email_dat)
+        self.server = _connect(self.email_dat)
+
+    def send(self, payload):
+        message = _message(self.email_dat, payload["subject"], payload["msg"])
+        self.server.sendmail(
+            self.email_dat["emlSender"], self.email_dat["sendTo"], message.as_string()
+        )
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            finally:
+                self.server = None
+
+
+notify_outbox.register(EmailChannel())
+
+
+def queue_email(subject, msg):
+    """Queue an email for the background sender."""
+    notify_outbox.enqueue("sip_email", {"subject": subject, "msg": msg})
 
 ################################################################################
 # Message functions:                                                                   #
@@ -132,16 +184,9 @@ def send_restart_notice():  # Notice 1
             message += "In case running or scheduled programs were interrupted please check SIP's log page.\n"
             message += "The last 5 log entries are shown below for quick reference. \n\n"
             message += "Date\t\tStartTime\tDuration\tProgram\tStation\n"
-            try:
-                with open("./data/log.json") as logf:
-                    i = 0
-                    while i < 5:
-                        line_dict = json.loads(logf.readline())
-                        message += f"{line_dict['date']}\t{line_dict['start']}\t{line_dict['duration']}\t\t{line_dict['program']}\t{gv.snames[line_dict['station']]}\n"
-                        i += 1
-            except IOError:
-                pass
-            email(subject, message)
+            for line_dict in sip_log.latest(5):
+                message += f"{line_dict['date']}\t{line_dict['start']}\t{line_dict['duration']}\t\t{line_dict['program']}\t{gv.snames[line_dict['station']]}\n"
+            queue_email(subject, message)
             sent = 1
 
     
@@ -180,7 +225,7 @@ def email_start_stop(name, **kw):  # Notice 2 and 3
                     message += f"{gv.snames[i]} for {int(e[2]//60)}m {int(e[2] % 60)}s\n"
                     stn_sum += 1
             if "2" in send_lst:
-                email(subject, message)
+                queue_email(subject, message)
         elif (not gv.pon  # program has ended
               and "3" in send_lst
               ):          
@@ -193,19 +238,11 @@ def email_start_stop(name, **kw):  # Notice 2 and 3
                 message = f"Program {gv.lrun[1]} ended at {lt.tm_hour:02d}:{lt.tm_min:02d}.\n\n"
             message += "Stations logged in this program:\n"
             message += "Date\t\tStartTime\tDuration\tStation\n"
-            
-            try:
-                with open("./data/log.json") as logf:
-                    i = 0
-                    while i < stn_sum:
-                        line_dict = json.loads(logf.readline())
-                        message += f"{line_dict['date']}\t{line_dict['start']}\t{line_dict['duration']}\t\t{gv.snames[line_dict['station']]}\n"
-                        i += 1
-            except IOError:
-                pass
-                print("IOError opening log file")
+            if stn_sum:
+                for line_dict in sip_log.latest(stn_sum):
+                    message += f"{line_dict['date']}\t{line_dict['start']}\t{line_dict['duration']}\t\t{gv.snames[line_dict['station']]}\n"
             stn_sum = 0
-            email(subject, message)
+            queue_email(subject, message)
     
 program_change = signal("running_program_change")
 program_change.connect(email_start_stop) 
@@ -216,7 +253,7 @@ def email_rain_delay_expired(name, **kw):  # Notice 4
         subject = "SIP Rain delay has expired"
         message = f"SIP's manually set rain delay expired on {time.strftime('%d.%m.%Y at %H:%M:%S', time.localtime(time.time()))}.\n"
         message += "Scheduled irrigation programs are now active."
-        email(subject, message)
+        queue_email(subject, message)
     
 delay_expired = signal("rain_delay_change")
 delay_expired.connect(email_rain_delay_expired) 
@@ -238,7 +275,7 @@ def email_rain_sensor(name, **kw):  # Notice 5 and 6
             subject = "SIP rain sensor off"
             message = f"SIP's rain sensor stopped suppressing stations on {time.strftime('%d.%m.%Y at %H:%M:%S', time.localtime(time.time()))}.\n"
             message += "Station controlled by rain sensor are now active"  
-        email(subject, message)          
+        queue_email(subject, message)          
     
 rain_sensor = signal("rain_changed")
 rain_sensor.connect(email_rain_sensor)
@@ -257,7 +294,7 @@ def plugin_alert(name, **kw):  # Notice 7
             message = kw["msg"]
         else:
             message = "SIP plugin " + name + " has reported a problem. Please check your system"
-        email(subject, message)
+        queue_email(subject, message)
 
 plugin_alarm = signal("email_alert") # expected blinker signal name from plugin
 plugin_alarm.connect(plugin_alert)  # Run plugin_alert() to send email when signal is received. 
@@ -3,12 +3,21 @@ from __future__ import print_function
 # !/usr/bin/env python
 # this plugins send and check SMS data for modem to control your SIP
 
-from threading import Thread
+from threading import Event, Thread
 from random import randint
 import json
+import os
+import select
+import termios
 import time
 import sys
 import traceback
+import tty
+
+try:
+    from queue import Queue
+except ImportError:  # python 2
+    from Queue import Queue
 
 import web
 import gv  # Get access to SIP's settings
@@ -48,10 +57,11 @@ class SMS(Thread):
     def __init__(self):
         Thread.__init__(self)
         self.daemon = True
-        self.start()
         self.status = ""
 
         self._sleep_time = 0
+        self._wake = Event()  # set by update() and by new message indications
+        self.start()
 
     def add_status(self, msg):
         if self.status:
@@ -62,6 +72,11 @@ class SMS(Thread):
 
     def update(self):
         self._sleep_time = 0
+        self._wake.set()
+
+    def new_message(self):
+        """Called by the notifier when the modem reports a new SMS"""
+        self._wake.set()
 
     def _sleep(self, secs):
         self._sleep_time = secs
@@ -81,7 +96,12 @@ class SMS(Thread):
                 data = get_sms_options()
                 if data["use_sms"] != "off":  # if use_sms is enable (on)
                     sms_check(self)  # Check SMS command from modem
-                self._sleep(20)
+                if notifier.listening:
+                    wait = poll_seconds(data)  # fallback poll, notifications wake us
+                else:
+                    wait = 20
+                self._wake.wait(wait)
+                self._wake.clear()
 
             except Exception:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -92,7 +112,111 @@ class SMS(Thread):
                 self._sleep(60)
 
 
+class ModemNotifier(Thread):
+    """
+    Listens for unsolicited new message indications from the modem.
+    AT+CNMI=2,1 asks the modem to report each stored SMS with a
+    '+CMTI: "SM",<index>' line on its notification port (for example the
+    second serial interface of a USB stick, /dev/ttyUSB2) while gammu keeps
+    using the main port. Any serial device or pseudo-terminal works, so a
+    simulator can stand in for the modem.
+    """
+
+    def __init__(self, on_message):
+        Thread.__init__(self)
+        self.daemon = True
+        self.on_message = on_message
+        self.listening = False  # True while the port is open and set up
+        self.indications = 0
+        self._reconfigure = Event()
+        self.start()
+
+    def reconfigure(self):
+        """Reopen the port with the current settings"""
+        self._reconfigure.set()
+
+    def handle_line(self, line):
+        if line.startswith(b"+CMTI:"):
+            self.indications += 1
+            self.on_message()
+
+    def _open(self, port):
+        fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+        try:
+            tty.setraw(fd)
+            attrs = termios.tcgetattr(fd)
+            attrs[4] = attrs[5] = termios.B115200
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        except termios.error:
+            pass  # not a real serial line
+        return fd
+
+    def _listen(self, port):
+        fd = self._open(port)
+        try:
+            os.write(fd, b"AT+CNMI=2,1,0,0,0\r")
+            self.listening = True
+            buf = b""
+            while not self._reconfigure.is_set():
+                ready, _, _ = select.select([fd], [], [], 1)
+                if not ready:
+                    continue
+                chunk = os.read(fd, 256)
+                if not chunk:
+                    raise IOError("notification port closed")
+                buf += chunk
+                while b"\n" in buf:
+                    line, _, buf = buf.partition(b"\n")
+                    self.handle_line(line.strip())
+        finally:
+            self.listening = False
+            os.close(fd)
+
+    def run(self):
+        time.sleep(3)  # let the plugin finish loading
+        while True:
+            self._reconfigure.clear()
+            data = get_sms_options()
+            port = data["notify_port"].strip()
+            if data["use_sms"] == "off" or not port:
+                self._reconfigure.wait(60)
+                continue
+            try:
+                self._listen(port)
+            except (IOError, OSError) as e:
+                checker.add_status("SMS notification port " + port + ": " + str(e))
+                self._reconfigure.wait(30)
+
+
+class CommandWorker(Thread):
+    """
+    Runs the actions requested by SMS commands (enable, disable, reboot,
+    poweroff, update) so slow actions never hold up the modem.
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue()
+        self.start()
+
+    def put(self, name, action):
+        self.queue.put((name, action))
+
+    def run(self):
+        while True:
+            name, action = self.queue.get()
+            try:
+                action()
+            except Exception:
+                checker.add_status(
+                    "SMS command " + name + " failed: " + traceback.format_exc()
+                )
+
+
 checker = SMS()
+notifier = ModemNotifier(checker.new_message)
+commands = CommandWorker()
 
 
 ################################################################################
@@ -100,8 +224,29 @@ checker = SMS()
 ################################################################################
 
 
+_options = None  # settings from file, reloaded by update
+
+
+def poll_seconds(data):
+    """Fallback poll interval used while notifications are active."""
+    try:
+        return max(20, int(data["poll"]))
+    except (TypeError, ValueError):
+        return 300
+
+
 def get_sms_options():
     """Returns the data form file."""
+    global _options
+    if _options is None:
+        _options = load_sms_options()
+    data = dict(_options)
+    data["status"] = checker.status
+    return data
+
+
+def load_sms_options():
+    """Reads the data form file."""
     data = {
         "tel1": "+xxxyyyyyyyyy",
         "tel2": "+xxxyyyyyyyyy",
@@ -112,13 +257,14 @@ def get_sms_options():
         "txt4": "reboot",
         "txt5": "poweroff",
         "txt6": "update",
-        "status": checker.status,
+        "notify_port": "",
+        "poll": "300",
     }
 
     try:
         with open("./data/sms_adj.json", "r") as f:  # Read the settings from file
             file_data = json.load(f)
-        for key, value in file_data.iteritems():
+        for key, value in file_data.items():
             if key in data:
                 data[key] = value
     except Exception:
@@ -127,6 +273,39 @@ def get_sms_options():
     return data
 
 
+def set_enable(en):
+    def action():
+        gv.sd["en"] = en  # enable or disable system SIP
+        jsave(gv.sd, "sd")  # save en
+
+    return action
+
+
+def delayed(fn, secs=10):
+    def action():
+        time.sleep(secs)  # let the confirmation SMS go out
+        fn()
+
+    return action
+
+
+def perform_update(self):
+    def action():
+        try:
+            from plugins.system_update import perform_update
+
+            if perform_update():
+                self.add_status(
+                    "Received SMS was deleted, update was performed and program will restart"
+                )
+            else:
+                self.add_status("Received SMS was deleted, but the update failed")
+        except ImportError:
+            self.add_status("Received SMS was deleted, but could not perform update")
+
+    return action
+
+
 def sms_check(self):
     """Control and processing SMS"""
     data = get_sms_options()  # Load data from json file
@@ -232,8 +411,7 @@ def sms_check(self):
 
                 elif m["Text"] == comm2:  # If command = comm2 (stop - system SIP off)
                     self.add_status("Command " + comm2 + " is processed")
-                    gv.sd["en"] = 0  # disable system SIP
-                    jsave(gv.sd, "sd")  # save en = 0
+                    commands.put(comm2, set_enable(0))  # disable system SIP
                     message = {
                         "Text": "Command: " + comm2 + " was processed",
                         "SMSC": {"Location": 1},
@@ -251,8 +429,7 @@ def sms_check(self):
 
                 elif m["Text"] == comm3:  # If command = comm3 (start - system SIP on)
                     self.add_status("Command " + comm3 + " is processed")
-                    gv.sd["en"] = 1  # enable system SIP
-                    jsave(gv.sd, "sd")  # save en = 1
+                    commands.put(comm3, set_enable(1))  # enable system SIP
                     message = {
                         "Text": "Command: " + comm3 + " was processed",
                         "SMSC": {"Location": 1},
@@ -284,8 +461,7 @@ def sms_check(self):
                     )
                     sm.DeleteSMS(m["Folder"], m["Location"])
                     self.add_status("Received SMS was deleted and system is now reboot")
-                    self._sleep(10)
-                    reboot()  # restart linux system
+                    commands.put(comm4, delayed(reboot))  # restart linux system
 
                 elif m["Text"] == comm5:  # If command = comm5 (poweroff system)
                     self.add_status("Command " + comm5 + " is processed")
@@ -305,8 +481,7 @@ def sms_check(self):
                     self.add_status(
                         "Received SMS was deleted and system is now poweroff"
                     )
-                    self._sleep(10)
-                    poweroff()  # poweroff linux system
+                    commands.put(comm5, delayed(poweroff))  # poweroff linux system
 
                 elif m["Text"] == comm6:  # If command = comm6 (update SIP system)
                     self.add_status("Command " + comm6 + " is processed")
@@ -322,19 +497,8 @@ def sms_check(self):
                         + " was processed and confirmation was sent as SMS to: "
                         + m["Number"]
                     )
-                    try:
-                        from plugins.system_update import perform_update
-
-                        perform_update()
-                        self.add_status(
-                            "Received SMS was deleted, update was performed and program will restart"
-                        )
-                    except ImportError:
-                        self.add_status(
-                            "Received SMS was deleted, but could not perform update"
-                        )
-
                     sm.DeleteSMS(m["Folder"], m["Location"])
+                    commands.put(comm6, perform_update(self))
 
                 else:  # If SMS command is not defined
                     sm.DeleteSMS(m["Folder"], m["Location"])
@@ -375,10 +539,13 @@ class update(ProtectedPage):
     """Save user input to sms_adj.json file."""
 
     def GET(self):
+        global _options
         qdict = web.input()
         if "use_sms" not in qdict:
             qdict["use_sms"] = "off"
         with open("./data/sms_adj.json", "w") as f:  # write the settings to file
             json.dump(qdict, f)
+        _options = None
         checker.update()
+        notifier.reconfigure()
         raise web.seeother("/")
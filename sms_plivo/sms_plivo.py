@@ -22,6 +22,7 @@ from sip import template_render  # Needed for working with web.py templates
 from urls import urls  # Get access to SIP's URLs
 import web  # web.py framework
 from webpages import ProtectedPage  # Needed for security
+import notify_outbox
 
 SMS_ENABLED = True  # Toggles SMS option display to user
 VOICE_ENABLED = True  # Toggles voice option display to user
@@ -75,8 +76,8 @@ def send_sms(name, **kw):
         phone = kw["dest"]
     else:
         phone = save_settings.voice_numbers
-    response = sms.send_message(phone, kw[u"msg"])
-    return response
+    notify_outbox.enqueue("plivo_sms", {"phone": phone, "msg": kw[u"msg"]})
+    return u"SMS message queued"
 
 
 sms_alert = signal(u"sms_alert")
@@ -92,9 +93,8 @@ def send_voice(name, **kw):
         phone = kw["dest"]
     else:
         phone = save_settings.voice_numbers
-    response = voice.send_message(phone, kw[u"msg"])
-    print("voice response", response)
-    return response
+    notify_outbox.enqueue("plivo_voice", {"phone": phone, "msg": kw[u"msg"]})
+    return u"Voice message queued"
 
 
 voice_alert = signal(u"voice_alert")
@@ -165,15 +165,13 @@ class Test(ProtectedPage):
         if "type" in qdict.keys():
             if qdict["type"] == "SMS":
                 response = (
-                    send_sms(BROADCAST_NAME,
-                             msg="This is a {} SMS test message from {}.".format(BROADCAST_NAME, gv.sd["name"]),
-                             dest=qdict["dest"])
+                    sms.send_message(qdict["dest"],
+                             "This is a {} SMS test message from {}.".format(BROADCAST_NAME, gv.sd["name"]))
                 )
             if qdict["type"] == "Voice":
                 response = (
-                    send_voice(BROADCAST_NAME,
-                             msg="This is a {} voice test message from {}.".format(BROADCAST_NAME, gv.sd["name"]),
-                             dest=qdict["dest"])
+                    voice.send_message(qdict["dest"],
+                             "This is a {} voice test message from {}.".format(BROADCAST_NAME, gv.sd["name"]))
                 )
             web.header(u"Content-Type", u"text/csv")
             return response
@@ -256,14 +254,16 @@ class SMSAPI(object):
         self.src = plivokeys.src()
         self._api = self.url + '/Account/%s' % self.auth_id
         self.headers = {'User-Agent': 'PythonPlivo'}
+        self.session = requests.Session()  # keep-alive between messages
 
     def _request(self, path, data={}):
         path = path.rstrip('/') + '/'
         headers = {'content-type': 'application/json'}
         headers.update(self.headers)
-        r = requests.post(self._api + path, headers=headers,
+        r = self.session.post(self._api + path, headers=headers,
                           auth=(self.auth_id, self.auth_token),
-                          data=json.dumps(data))
+                          data=json.dumps(data), timeout=30)
+        r.raise_for_status()
         content = r.content
         if content:
             try:
@@ -275,16 +275,20 @@ class SMSAPI(object):
 
         return response
 
+    def deliver(self, phone, text_message):
+        # Raises on failure so the outbox can retry
+        phone = phone.replace(",", "<")
+        params = {
+            'src': self.src,  # Sender's phone number with country code
+            'dst': phone,  # Receiver's phone Number with country code
+            'text': text_message,  # Your SMS Text Message - English
+            'method': 'POST'  # The method used to call the url
+        }
+        return self._request('/Message/', data=params)
+
     def send_message(self, phone, text_message):
         try:
-            phone = phone.replace(",", "<")
-            params = {
-                'src': self.src,  # Sender's phone number with country code
-                'dst': phone,  # Receiver's phone Number with country code
-                'text': text_message,  # Your SMS Text Message - English
-                'method': 'POST'  # The method used to call the url
-            }
-            response = self._request('/Message/', data=params)
+            response = self.deliver(phone, text_message)
             return response
 
         except Exception as inst:
@@ -306,13 +310,15 @@ class VoiceAPI(object):
         self.src = plivokeys.src()
         self._api = 'account/%s/phlo/%s' % (self.auth_id, self.auth_phlo)
         self.headers = {'User-Agent': 'PythonPlivo'}
+        self.session = requests.Session()  # keep-alive between messages
 
     def _request(self, data={}):
         headers = {'content-type': 'application/json'}
         headers.update(self.headers)
-        r = requests.post(self.url + self._api, headers=headers,
+        r = self.session.post(self.url + self._api, headers=headers,
                           auth=(self.auth_id, self.auth_token),
-                          data=json.dumps(data))
+                          data=json.dumps(data), timeout=30)
+        r.raise_for_status()
 
         content = r.content
         if content:
@@ -324,16 +330,20 @@ class VoiceAPI(object):
             response = content
         return response
 
+    def deliver(self, phone, voice_message):
+        # Raises on failure so the outbox can retry
+        phone = phone.replace(",", "<")
+        params = {
+            'from': self.src,  # Sender's phone number with country code
+            'to': phone,  # Receiver's phone Number with country code
+            'items': voice_message,  # Your SMS Text Message - English
+        }
+        return self._request(data=params)
+
     def send_message(self, phone, voice_message):
 
         try:
-            phone = phone.replace(",", "<")
-            params = {
-                'from': self.src,  # Sender's phone number with country code
-                'to': phone,  # Receiver's phone Number with country code
-                'items': voice_message,  # Your SMS Text Message - English
-            }
-            response = self._request(data=params)
+            response = self.deliver(phone, voice_message)
             return response
 
         except Exception as inst:
@@ -347,3 +357,19 @@ class VoiceAPI(object):
 plivo_keys = PlivoKeys(KEY_DATA)
 sms = SMSAPI(plivo_keys)
 voice = VoiceAPI(plivo_keys)
+
+
+class PlivoChannel(notify_outbox.Channel):
+    """Delivers queued Plivo messages from the notification outbox."""
+
+    def __init__(self, name, api):
+        self.name = name
+        self.api = api
+        self.min_interval = 1.0
+
+    def send(self, payload):
+        self.api.deliver(payload["phone"], payload["msg"])
+
+
+notify_outbox.register(PlivoChannel("plivo_sms", sms))
+notify_outbox.register(PlivoChannel("plivo_voice", voice))
@@ -15,10 +15,12 @@ from sip import template_render  # Needed for working with web.py templates
 from urls import urls  # Get access to SIP's URLs
 import web  # web.py framework
 from webpages import ProtectedPage  # Needed for security
+import notify_outbox
 
 # *****
 # Twilio Specific imports
 from base64 import b64encode
+import http.client
 import urllib.request, urllib.parse
 import datetime
 import json
@@ -96,8 +98,11 @@ def send_sms(name, **kwargs):
         phone = kwargs["dest"]
     else:
         phone = sms_obj.outgoing_number
-    response = sms_obj.send_message(phone, kwargs["msg"], **kwargs)
-    return response
+    if "override" in kwargs and kwargs["override"]:  # Test page waits for the result
+        response = sms_obj.send_message(phone, kwargs["msg"], **kwargs)
+        return response
+    notify_outbox.enqueue("twilio_sms", {"phone": phone, "msg": kwargs["msg"]})
+    return u"SMS message queued"
 
 
 sms_alert = signal(u"sms_alert")
@@ -119,9 +124,12 @@ def send_voice(name, **kwargs):
         phone = kwargs["dest"]
     else:
         phone = voice_obj.outgoing_number
-    response = voice_obj.send_message(phone, kwargs[u"msg"], **kwargs)
-    print("voice response", response)
-    return response
+    if "override" in kwargs and kwargs["override"]:  # Test page waits for the result
+        response = voice_obj.send_message(phone, kwargs[u"msg"], **kwargs)
+        print("voice response", response)
+        return response
+    notify_outbox.enqueue("twilio_voice", {"phone": phone, "msg": kwargs[u"msg"]})
+    return u"Voice message queued"
 
 
 voice_alert = signal(u"voice_alert")
@@ -374,7 +382,8 @@ class SMS(object):
 
         self.headers = get_headers(self.account_sid, self.auth_token)
 
-    def send_message(self, phone, message, **kwargs):
+    def message_request(self, phone, message, **kwargs):
+        """Returns (url, data, headers) of the request that sends message."""
         if "override" in kwargs and kwargs["override"]:
 
             if "twilio_number" in kwargs:
@@ -395,8 +404,6 @@ class SMS(object):
             headers = get_headers(account_sid, auth_token)
 
         else:
-            if self.pause_messaging:
-                return "SMS message not sent. Messages have been paused by Twilio plugin"
             twilio_number = self.twilio_number
             auth_token = self.auth_token
             account_sid = self.account_sid
@@ -411,6 +418,12 @@ class SMS(object):
         # Data must be bytes (we're url encoding it)
         data = urllib.parse.urlencode(data).encode('ascii')
         url = 'https://api.twilio.com/2010-04-01/Accounts/{}/Messages.json'.format(account_sid)
+        return url, data, headers
+
+    def send_message(self, phone, message, **kwargs):
+        if not ("override" in kwargs and kwargs["override"]) and self.pause_messaging:
+            return "SMS message not sent. Messages have been paused by Twilio plugin"
+        url, data, headers = self.message_request(phone, message, **kwargs)
 
         # create Request object for POST
         request = urllib.request.Request(url, data=data, headers=headers, method="POST")
@@ -830,7 +843,8 @@ class Voice(object):
 
         return response_str
 
-    def send_message(self, phone, message, **kwargs):
+    def message_request(self, phone, message, **kwargs):
+        """Returns (url, data, headers) of the request that places the call."""
         if "override" in kwargs and kwargs["override"]:
 
             if "twilio_number" in kwargs:
@@ -852,8 +866,6 @@ class Voice(object):
 
             headers = get_headers(account_sid, auth_token)
         else:
-            if self.pause_messaging:
-                return "Voice message not sent. Messages have been paused by Twilio plugin"
             flow_sid = self.flow_sid
             twilio_number = self.twilio_number
             headers = self.headers
@@ -867,6 +879,12 @@ class Voice(object):
 
         data = urllib.parse.urlencode(data).encode('ascii')
         url = 'https://studio.twilio.com/v2/Flows/{}/Executions'.format(flow_sid)
+        return url, data, headers
+
+    def send_message(self, phone, message, **kwargs):
+        if not ("override" in kwargs and kwargs["override"]) and self.pause_messaging:
+            return "Voice message not sent. Messages have been paused by Twilio plugin"
+        url, data, headers = self.message_request(phone, message, **kwargs)
 
         request = urllib.request.Request(url, data=data, headers=headers)
         try:
@@ -880,6 +898,40 @@ class Voice(object):
 
         return response_str
 
+
+class TwilioChannel(notify_outbox.Channel):
+    """
+    Delivers queued SMS or voice messages from the notification outbox.
+    One keep-alive HTTPS connection is used for every message in a batch.
+    """
+
+    def __init__(self, name, host, messenger):
+        self.name = name
+        self.host = host
+        self.messenger = messenger
+        self.min_interval = 1.0
+        self.conn = None
+
+    def open(self):
+        self.conn = http.client.HTTPSConnection(self.host, timeout=30)
+
+    def send(self, payload):
+        if PAUSE_NOTIFICATIONS or self.messenger.pause_messaging:
+            print(u"{} message not sent as messages have been paused".format(self.name))
+            return
+        url, data, headers = self.messenger.message_request(payload["phone"], payload["msg"])
+        self.conn.request("POST", urllib.parse.urlsplit(url).path, body=data, headers=headers)
+        response = self.conn.getresponse()
+        body = response.read().decode("utf-8")
+        if response.status >= 300:
+            raise Exception("{} {}: {}".format(response.status, response.reason, body))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
 # Get the currently loaded settings and instantiate the messaging objects
 try:
     with open(
@@ -892,3 +944,6 @@ except IOError:
 voice_obj = Voice(stored_settings)
 sms_obj = SMS(stored_settings)
 stored_settings = None
+
+notify_outbox.register(TwilioChannel("twilio_sms", "api.twilio.com", sms_obj))
+notify_outbox.register(TwilioChannel("twilio_voice", "studio.twilio.com", voice_obj))
@@ -10,6 +10,7 @@ import os.path
 import shutil
 import subprocess
 import sys
+from threading import Event, Lock, Thread
 import time
 import traceback
 
@@ -23,24 +24,57 @@ from webpages import ProtectedPage
 
 # Add a new url to open the data entry page.
 urls.extend([u"/UPs", u"plugins.system_update.status_page",
-             u"/UPu", u"plugins.system_update.update_page"
+             u"/UPsr", u"plugins.system_update.refresh_page",
+             u"/UPset", u"plugins.system_update.settings_page",
+             u"/UPu", u"plugins.system_update.update_page",
+             u"/UPj", u"plugins.system_update.job_json"
              ])
 
 # Add this plugin to the home page plugins menu
 gv.plugin_menu.append([_(u"System update"), u"/UPs"])
 
 
-class StatusChecker():
+SETTINGS_FILE = u"./data/system_update.json"
+DEFAULT_INTERVAL = 24  # Hours between update checks
+
+
+def get_settings():
+    settings = {u"interval": DEFAULT_INTERVAL}
+    try:
+        with open(SETTINGS_FILE, u"r") as f:
+            settings.update(json.load(f))
+    except (IOError, ValueError):
+        pass
+    return settings
+
+
+def git_output(args):
+    return subprocess.check_output([u"git"] + args).decode(u"utf-8").strip()
+
+
+class StatusChecker(Thread):
+    """
+    Checks the remote repository for updates in the background, at
+    start-up and then every "interval" hours, and keeps the result in
+    self.status for the status page. update() requests a check now.
+    """
+
     def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
 
         self.status = {
             u"ver_str": gv.ver_str,
             u"ver_date": gv.ver_date,
             u"status": u"",
             u"remote": u"'None!",
-            u"can_update": False}
+            u"can_update": False,
+            u"checked": u"",
+            u"checking": False,
+            u"interval": get_settings()[u"interval"]}
 
-        self._sleep_time = 0
+        self._wake = Event()
+        self.start()
 
     def add_status(self, msg):
         if self.status[u"status"]:
@@ -49,38 +83,46 @@ class StatusChecker():
             self.status[u"status"] = msg
 
     def update(self):
-        self._sleep_time = 0
-
-    def _sleep(self, secs):
-        self._sleep_time = secs
-        while self._sleep_time > 0:
-            time.sleep(1)
-            self._sleep_time -= 1
+        self._wake.set()
 
     def update_rev_data(self):
-        """Returns the update revision data."""
+        """Updates the revision data in self.status."""
 
         command = u"git remote update"
         subprocess.call(command.split()) #  housekeeping, no retruned data needed.
 
-        command = u"git config --get remote.origin.url"
-        remote = subprocess.check_output(command.split()).strip()
-        remote = remote.decode('utf-8')
-        if remote:
-            self.status[u"remote"] = remote
-
-        command = u"git log -1 origin/master --format=%cd --date=short"
-        new_date = subprocess.check_output(command.split()).strip()
-        new_date = new_date.decode('utf-8')
-
-        command = u"git rev-list origin/master --count"
-        new_revision = int(subprocess.check_output(command.split()))
-
-        command =u"git log HEAD..origin/master --oneline"
-        log_H = (subprocess.check_output(command.split()))
-        log_H = log_H.decode('utf-8').split(u"\n")
-        changes = u"  " + u"\n  ".join(log_H)
-
+        if self.status[u"remote"] == u"'None!":
+            remote = git_output([u"config", u"--get", u"remote.origin.url"])
+            if remote:
+                self.status[u"remote"] = remote
+
+        # One call for all revision data: commits only in HEAD ("<"), only
+        # in origin/master (">") and the merge base ("-")
+        log = git_output([
+            u"log", u"--left-right", u"--boundary", u"--date=short",
+            u"--format=%m%x09%h%x09%cd%x09%s", u"HEAD...origin/master"])
+        ahead = []
+        behind = 0
+        new_date = gv.ver_date
+        base_date = None
+        for line in log.split(u"\n"):
+            if not line:
+                continue
+            mark, sha, date, subject = (line.split(u"\t", 3) + [u""] * 3)[:4]
+            if mark == u">":
+                if not ahead:
+                    new_date = date  # newest first
+                ahead.append(sha + u" " + subject)
+            elif mark == u"<":
+                behind += 1
+            elif mark == u"-" and base_date is None:
+                base_date = date
+        if not ahead and behind and base_date:
+            new_date = base_date  # origin/master is the merge base
+        new_revision = gv.revision - behind + len(ahead)
+        changes = u"  " + u"\n  ".join(ahead)
+
+        self.status[u"status"] = u""
         if new_revision == gv.revision and new_date == gv.ver_date:
             self.add_status(_(u"Up-to-date."))
             self.status[u"can_update"] = False
@@ -95,46 +137,111 @@ class StatusChecker():
             self.status[u"can_update"] = False
 
     def run(self):
+        while True:
+            self.status[u"checking"] = True
+            try:
+                self.update_rev_data()
+            except Exception:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                err_string = u"".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+                self.status[u"status"] = u""
+                self.add_status(_(u"System update plug-in encountered error") + u":\n" + err_string)
+            self.status[u"checking"] = False
+            self.status[u"checked"] = time.strftime(u"%Y-%m-%d %H:%M:%S")
+
+            try:
+                interval = float(get_settings()[u"interval"]) * 3600
+            except (TypeError, ValueError):
+                interval = DEFAULT_INTERVAL * 3600
+            self._wake.wait(max(interval, 60))
+            self._wake.clear()
+
+
+class UpdateJob(object):
+    """
+    Runs the update in a background thread. Output of each command is
+    kept in self.log for the status page to stream.
+    """
 
+    def __init__(self):
+        self.state = u"idle"  # idle, running, done or failed
+        self.log = []
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            if self.state == u"running":
+                return False
+            self.state = u"running"
+            self.log = []
+        t = Thread(target=self._run)
+        t.daemon = True
+        t.start()
+        return True
+
+    def add_log(self, line):
+        self.log.append(line.rstrip())
+
+    def run_command(self, command):
+        self.add_log(u"$ " + command)
+        proc = subprocess.Popen(
+            command.split(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        for line in proc.stdout:
+            self.add_log(line)
+        return proc.wait()
+
+    def _run(self):
         try:
-            self.status[u"status"] = u""
+            ok = perform_update(self)
+        except Exception as e:
+            self.add_log(u"System update error " + str(e))
+            ok = False
+        self.state = u"done" if ok else u"failed"
 
-        except Exception:
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            err_string = u"".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
-            self.add_status(_(u"System update plug-in encountered error") + u":\n" + err_string)
 
 checker = StatusChecker()
+job = UpdateJob()
 
 ################################################################################
 # Helper functions:                                                            #
 ################################################################################
 
 
-def perform_update():
+def perform_update(job=None):
     """
     Uses git pull to update SIP from GitHub repository.
     Handles case where data directory is a symlink.
+    Returns True if git pull succeeded.
+    Called without a job (e.g. by sms_adj) it runs in the caller's thread.
     """
+    if job is None:
+        job = UpdateJob()
     if os.path.islink("./data"):
+        job.add_log(u"Moving data directory link aside")
         os.rename("./data", "./data_updating")
         try:
             os.makedirs("./data")
         except OSError as e:
-            print("System update error ", e)
+            job.add_log(u"System update error " + str(e))
 
     command = u"git config core.filemode true"
-    subprocess.call(command.split())
+    job.run_command(command)
     
     command = u"git pull"
-    subprocess.call(command.split())
+    code = job.run_command(command)
     
     if os.path.isdir("./data_updating"):
         try:
             shutil.rmtree("./data")
             os.rename("./data_updating", "./data")
+            job.add_log(u"Data directory link restored")
         except OSError as e:
-            print("System update error ", e)        
+            job.add_log(u"System update error " + str(e))
+    return code == 0
 
 ################################################################################
 # Web pages:                                                                   #
@@ -142,16 +249,63 @@ def perform_update():
 
 
 class status_page(ProtectedPage):
-    """Load an html page with rev data."""
+    """Load an html page with the cached rev data."""
+
+    def GET(self):
+        qdict = web.input(watch=u"")
+        return template_render.system_update(
+            checker.status, job.state, job.log, qdict.watch == u"1"
+        )
+
+
+class refresh_page(ProtectedPage):
+    """Check for updates now."""
 
     def GET(self):
-        checker.update_rev_data()
-        return template_render.system_update(checker.status)
+        checker.status[u"checking"] = True
+        checker.update()
+        raise web.seeother(u"/UPs")
+
+
+class settings_page(ProtectedPage):
+    """Save the update check interval."""
+
+    def GET(self):
+        qdict = web.input(interval=u"")
+        settings = get_settings()
+        try:
+            settings[u"interval"] = max(float(qdict.interval), 0.1)
+        except ValueError:
+            raise web.seeother(u"/UPs")
+        with open(SETTINGS_FILE, u"w") as f:
+            json.dump(settings, f)
+        checker.status[u"interval"] = settings[u"interval"]
+        checker.update()
+        raise web.seeother(u"/UPs")
+
 
 class update_page(ProtectedPage):
-    """Update SIP from github and return text message from command line."""
+    """Start the update in the background and show its progress."""
 
     def GET(self):
-        perform_update()
-        raise web.seeother(u"/restart")
+        if job.start():
+            raise web.seeother(u"/UPs?watch=1")  # The job may finish before the page loads
+        raise web.seeother(u"/UPs")
+
 
+class job_json(ProtectedPage):
+    """Update job state and log lines from "since" on, in JSON format."""
+
+    def GET(self):
+        qdict = web.input(since=u"0")
+        try:
+            since = int(qdict.since)
+        except ValueError:
+            since = 0
+        lines = job.log[since:]
+        web.header(u"Content-Type", u"application/json")
+        return json.dumps({
+            u"state": job.state,
+            u"log": lines,
+            u"next": since + len(lines),
+            u"checking": checker.status[u"checking"]})
@@ -0,0 +1,202 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Shared notification outbox for the email, SMS and chat plugins.
+
+Signal handlers call enqueue() and return at once. A single background
+worker delivers queued messages per channel, in batches, no faster than
+the channel's rate limit, and retries failures with exponential backoff.
+The queue is kept in ./data/notify_outbox.json so messages survive a
+restart. Channels are registered by the plugin that owns them; queued
+messages for a channel wait until that plugin has registered it.
+"""
+
+from __future__ import print_function
+
+# standard library imports
+import json
+import os
+import threading
+import time
+
+OUTBOX_FILE = u"./data/notify_outbox.json"
+
+
+class Channel(object):
+    """
+    Base class for a delivery channel.
+    send() delivers one payload and raises on failure. open() and close()
+    bracket each batch so a connection can be reused for all of its
+    messages.
+    """
+
+    name = u""
+    batch_size = 10  # Messages delivered per batch
+    min_interval = 0.0  # Minimum seconds between two sends
+    max_attempts = 5  # Dropped after this many failures
+    backoff = 30  # Seconds before the first retry, doubled each time
+
+    def open(self):
+        pass
+
+    def send(self, payload):
+        """
+        Deliver payload, the dict given to enqueue(). Raise on failure
+        and the message is retried. A payload that goes to several
+        recipients may record progress in itself; the change is saved
+        with the queue, so a retry can skip recipients already served.
+        Channels must override this; the base class fails every send so
+        the messages are retried and reported rather than lost.
+        """
+        raise NotImplementedError(
+            u"channel {} does not implement send()".format(self.name)
+        )
+
+    def close(self):
+        pass
+
+
+class Outbox(object):
+    def __init__(self, path=OUTBOX_FILE):
+        self.path = path
+        self.channels = {}
+        self._queue = []
+        self._cond = threading.Condition()
+        self._worker = None
+        self._last_send = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                self._queue = json.load(f)
+        except (IOError, ValueError):
+            self._queue = []
+
+    def _save(self):
+        """Write the queue atomically. Caller holds the lock."""
+        tmp = self.path + u".tmp"
+        try:
+            with open(tmp, u"w") as f:
+                json.dump(self._queue, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            print(u"Notification outbox could not be saved:", e)
+
+    def register(self, channel):
+        """Add or replace a delivery channel and start the worker."""
+        with self._cond:
+            self.channels[channel.name] = channel
+            self._start()
+            self._cond.notify()
+
+    def enqueue(self, channel, payload, delay=0):
+        """
+        Queue payload (a JSON serialisable dict) for delivery on channel.
+        delay holds the message back for that many seconds.
+        """
+        item = {
+            u"channel": channel,
+            u"payload": payload,
+            u"attempts": 0,
+            u"due": time.time() + delay,
+        }
+        with self._cond:
+            self._queue.append(item)
+            self._save()
+            self._start()
+            self._cond.notify()
+
+    def pending(self, channel=None):
+        """Number of queued messages, optionally for one channel."""
+        with self._cond:
+            return len(
+                [i for i in self._queue if channel is None or i[u"channel"] == channel]
+            )
+
+    def _start(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _next_batch(self):
+        """
+        Wait for due messages and return (channel, items).
+        Caller holds the lock.
+        """
+        while True:
+            now = time.time()
+            wake = None
+            for item in self._queue:
+                ch = self.channels.get(item[u"channel"])
+                if ch is None:
+                    continue
+                due = max(
+                    item[u"due"],
+                    self._last_send.get(ch.name, 0) + ch.min_interval,
+                )
+                if due <= now:
+                    items = [
+                        i
+                        for i in self._queue
+                        if i[u"channel"] == ch.name and i[u"due"] <= now
+                    ][: ch.batch_size]
+                    return ch, items
+                if wake is None or due < wake:
+                    wake = due
+            self._cond.wait(None if wake is None else wake - now)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                ch, items = self._next_batch()
+            try:
+                ch.open()
+            except Exception as e:
+                self._failed(ch, items, e)
+                continue
+            for n, item in enumerate(items):
+                wait = self._last_send.get(ch.name, 0) + ch.min_interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    ch.send(item[u"payload"])
+                except Exception as e:
+                    self._failed(ch, items[n:], e)
+                    break
+                finally:
+                    self._last_send[ch.name] = time.time()
+                with self._cond:
+                    if item in self._queue:
+                        self._queue.remove(item)
+                    self._save()
+            try:
+                ch.close()
+            except Exception:
+                pass
+
+    def _failed(self, ch, items, err):
+        print(u"Notification outbox: {} delivery failed: {}".format(ch.name, err))
+        with self._cond:
+            for item in items:
+                item[u"attempts"] += 1
+                if item[u"attempts"] >= ch.max_attempts:
+                    print(u"Notification outbox: dropping {} message".format(ch.name))
+                    if item in self._queue:
+                        self._queue.remove(item)
+                else:
+                    item[u"due"] = time.time() + ch.backoff * 2 ** (item[u"attempts"] - 1)
+            self._save()
+
+
+outbox = Outbox()
+
+
+def register(channel):
+    outbox.register(channel)
+
+
+def enqueue(channel, payload, delay=0):
+    outbox.enqueue(channel, payload, delay)
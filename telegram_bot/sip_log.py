@@ -0,0 +1,135 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Read access to SIP style JSON-lines logs (./data/log.json and friends).
+
+These logs are written newest record first, so the most recent entries
+are the head of the file. LogReader keeps the first cache_size records
+parsed in memory and only re-reads them when the file's size or
+modification time changes. Queries that need older records continue
+reading the file from where the cache ends, one line at a time, so no
+caller has to parse the whole history.
+"""
+
+from __future__ import print_function
+
+# standard library imports
+from itertools import islice
+import json
+import os
+import threading
+import time
+
+
+class LogReader(object):
+    def __init__(self, path, cache_size=100, parse=json.loads):
+        self.path = path
+        self.cache_size = cache_size
+        self.parse = parse
+        self._lock = threading.Lock()
+        self._key = None  # (size, mtime) of the cached file
+        self._cache = []
+        self._complete = True  # True if the cache holds the whole file
+
+    def _parse_line(self, line):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            return self.parse(line)
+        except ValueError:
+            return None
+
+    def _refresh(self):
+        """Reload the head cache if the file has changed."""
+        try:
+            st = os.stat(self.path)
+            key = (st.st_size, st.st_mtime)
+        except OSError:
+            key = None
+        with self._lock:
+            if key == self._key:
+                return
+            cache = []
+            complete = True
+            if key is not None:
+                try:
+                    with open(self.path) as logf:
+                        for line in logf:
+                            if len(cache) >= self.cache_size:
+                                complete = False
+                                break
+                            rec = self._parse_line(line)
+                            if rec is not None:
+                                cache.append(rec)
+                except IOError:
+                    pass
+            self._cache = cache
+            self._complete = complete
+            self._key = key
+
+    def records(self):
+        """Generator of all records, newest first."""
+        self._refresh()
+        with self._lock:
+            cache = list(self._cache)
+            complete = self._complete
+        for rec in cache:
+            yield dict(rec)
+        if complete:
+            return
+        try:
+            with open(self.path) as logf:
+                seen = 0
+                for line in logf:
+                    rec = self._parse_line(line)
+                    if rec is None:
+                        continue
+                    seen += 1
+                    if seen > len(cache):
+                        yield rec
+        except IOError:
+            return
+
+    def latest(self, n=0):
+        """The n most recent records (0 = all), newest first."""
+        if n:
+            return list(islice(self.records(), n))
+        return list(self.records())
+
+    def since(self, timestamp):
+        """
+        Records that started at or after timestamp, newest first.
+        timestamp follows SIP's gv.now convention (local time in epoch
+        seconds).
+        """
+        cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp))
+        result = []
+        for rec in self.records():
+            if u"{} {}".format(rec.get(u"date", u""), rec.get(u"start", u"")) < cutoff:
+                break
+            result.append(rec)
+        return result
+
+    def by_station(self, station, n=0):
+        """The n most recent records (0 = all) for a station index."""
+        matches = (r for r in self.records() if r.get(u"station") == station)
+        if n:
+            return list(islice(matches, n))
+        return list(matches)
+
+
+sip_log = LogReader(u"./data/log.json")
+
+
+def latest(n=0):
+    return sip_log.latest(n)
+
+
+def since(timestamp):
+    return sip_log.since(timestamp)
+
+
+def by_station(station, n=0):
+    return sip_log.by_station(station, n)
@@ -14,8 +14,10 @@ import gv  # Get access to sip's settings
 import helpers
 import web  # web.py framework
 from blinker import signal
-from helpers import (clear_mm, get_ip, jsave, poweroff, read_log, reboot,
+from helpers import (clear_mm, get_ip, jsave, poweroff, reboot,
                      restart, stop_stations, timestr, uptime)
+import notify_outbox
+import sip_log
 from sip import template_render  # Needed for working with web.py templates
 from telegram import Update
 from telegram.ext import (Application, CommandHandler, ContextTypes,
@@ -113,10 +115,10 @@ class TelegramBot(Thread):
 
             if gv.sd["lg"]:
                 # Log is enabled, lets get the data from there
-                log = read_log()
+                log = sip_log.latest(5)
                 if len(log) > 0:
-                    txt += "\nLast {} Programs:".format(str(len(log[:5])))
-                    for l in log[:5]:
+                    txt += "\nLast {} Programs:".format(str(len(log)))
+                    for l in log:
                         l["station"] = gv.snames[l["station"]]
                         txt += "\n  <b>{station}</b> - Program: <i>{program}</i>".format(
                             **l
@@ -234,12 +236,10 @@ class TelegramBot(Thread):
         return application
 
     def _announce(self, text, parse_mode=None):
-        application = self.bot
-        for chat_id in self.currentChats:
-            if self.eventLoop:
-                self.eventLoop.create_task(application.updater.bot.sendMessage(chat_id, text=text, parse_mode=parse_mode))
-            else:
-                application.updater.bot.sendMessage(chat_id, text=text, parse_mode=parse_mode)
+        """Queue text for every subscribed chat."""
+        notify_outbox.enqueue(
+            "telegram", {"text": text, "parse_mode": parse_mode}
+        )
 
     def run(self):
         try:
@@ -273,12 +273,11 @@ class TelegramBot(Thread):
 
     def notifyStationScheduled(self, name, **kw):
         if self.data["stationScheduled"] == "on":
-            time.sleep(
-                2
-            )  # Sleep a couple of seconds to let SIP finish setting the gv variables
-            txt = "New Stations have been scheduled"
-            txt += get_running_programs_rs()
-            self._announce(txt, parse_mode="HTML")
+            # Text is built when sent, a couple of seconds from now,
+            # to let SIP finish setting the gv variables
+            notify_outbox.enqueue(
+                "telegram", {"kind": "stations_scheduled", "parse_mode": "HTML"}, delay=2
+            )
 
     def notifyAlarmToggled(self, name, **kw):
         txt = """<b>ALARM!!!</b> from <i>{}</i>:<br><pre>{}</pre>""".format(
@@ -287,6 +286,43 @@ class TelegramBot(Thread):
         self._announce(txt, parse_mode="HTML")
 
 
+class TelegramChannel(notify_outbox.Channel):
+    """
+    Delivers queued announcements to subscribed chats on the bot's
+    own event loop.
+    """
+
+    name = "telegram"
+    min_interval = 1.0
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def send(self, payload):
+        if self.bot.bot is None or self.bot.eventLoop is None:
+            raise Exception("telegram bot is not running")
+        if "text" not in payload:  # Built once so a retry sends the same text
+            payload["text"] = "New Stations have been scheduled" + get_running_programs_rs()
+        sent = payload.setdefault("sent", [])  # Chats already served, kept on retry
+        failed = []
+        for chat_id in self.bot.currentChats:
+            if chat_id in sent:
+                continue
+            future = asyncio.run_coroutine_threadsafe(
+                self.bot.bot.bot.sendMessage(
+                    chat_id, text=payload["text"], parse_mode=payload.get("parse_mode")
+                ),
+                self.bot.eventLoop,
+            )
+            try:
+                future.result(timeout=30)
+                sent.append(chat_id)
+            except Exception as e:
+                failed.append("{}: {}".format(chat_id, e))
+        if failed:
+            raise Exception("not delivered to " + ", ".join(failed))
+
+
 def get_running_programs_rs():  # From the running schedule info
     txt = ""
     for i in range(len(gv.rs)):
@@ -390,6 +426,7 @@ def run_bot():
     # time.sleep(10)    
     # await asyncio.sleep(10)
     bot.start()
+    notify_outbox.register(TelegramChannel(bot))
     
     # Connect Signals
     program_started = signal("stations_scheduled")
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 NAME = 'well.py'
-VERSION = '0.6'
+VERSION = '0.7'
 DESCRIPTION = 'Well pump control plugin for SIP'
 
 '''
@@ -52,9 +52,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import reqired libraries
 import json
-from threading import Thread
-from time import sleep
-import RPi.GPIO as GPIO
+from threading import Event, Lock, Thread
+import time
 # local module imports
 from blinker import signal
 import gv  # Access SIP's settings
@@ -66,7 +65,6 @@ from webpages import showInFooter # Enable plugin to display readings in UI foot
 from webpages import showOnTimeline # Enable plugin to display station data on timeline
 from helpers import stop_stations
 import atexit
-atexit.register(GPIO.cleanup) # Need to change this to set motor control relay to reflect correct sense
 
 # Add new URLs to access classes in this plugin.
 # fmt: off
@@ -78,99 +76,307 @@ urls.extend([
 
 # Add this plugin to the PLUGINS menu ["Menu Name", "URL"], (Optional)
 gv.plugin_menu.append([_(u"Well Plugin"), u"/well-sp"])
-#
+
+PIN_CONTROL = 33  # pump control input
+PIN_MOTOR = 35  # motor running input
+PIN_RESET = 37  # pump control reset
+PULSE_SECS = 2  # Length of a momentary reset pulse
+BOUNCE_MS = 200
+POLL_SECS = 1  # Input poll interval when edge detection is not available
+
+DEFAULTS = {u"time": u"30", u"stns": u"off", u"in_act": u"low", u"moment": u"off", u"out_act": u"low"}
+
+
 def well_options():
+    welldata = dict(DEFAULTS)
     try:
         with open("./data/well.json", "r") as f:  # Read the settings from file
-            welldata = json.load(f)
-        for key, value in file_data.iteritems():
+            file_data = json.load(f)
+        for key, value in file_data.items():
             if key in welldata:
                 welldata[key] = value
-    except Exception:
+    except (IOError, ValueError):
         pass
     return welldata
 
 #############################
 
-pump = showInFooter() #  instantiate class to enable data in footer
+
+class SoftGPIO(object):
+    """
+    Software stand-in for RPi.GPIO.
+    Pin levels are changed with set_level(), which runs any registered
+    edge callback the way the real library does, so the well control
+    timing can be exercised without hardware.
+    """
+
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    BOTH = 33
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None):
+        self.levels.setdefault(pin, 1 if pull_up_down == self.PUD_UP else 0)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+    def set_level(self, pin, level):
+        if self.levels.get(pin) != level:
+            self.levels[pin] = level
+            if pin in self.callbacks:
+                self.callbacks[pin](pin)
+
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:  # Not on a Pi
+    GPIO = SoftGPIO()
+atexit.register(GPIO.cleanup) # Need to change this to set motor control relay to reflect correct sense
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel on a monotonic clock.
+    Timers are kept in slots of tick seconds; advance() fires the ones
+    that are due and next_delay() tells a waiting thread how long it may
+    sleep. Callbacks run on the thread calling advance().
+    """
+
+    def __init__(self, tick=1.0, slots=64, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [[] for i in range(slots)]
+        self._lock = Lock()
+        self._last = int(clock() / tick)
+
+    def _slot(self, deadline):
+        return self.slots[int(deadline / self.tick) % len(self.slots)]
+
+    def schedule(self, delay, callback):
+        """Run callback after delay seconds. Returns a handle for cancel()."""
+        timer = [self.clock() + delay, callback]
+        with self._lock:
+            self._slot(timer[0]).append(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self._lock:
+            try:
+                self._slot(timer[0]).remove(timer)
+            except ValueError:  # Already fired
+                pass
+
+    def remaining(self, timer):
+        return max(0.0, timer[0] - self.clock())
+
+    def next_delay(self):
+        """Seconds until the earliest timer, None if there is none."""
+        with self._lock:
+            deadlines = [t[0] for slot in self.slots for t in slot]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - self.clock())
+
+    def advance(self):
+        now = self.clock()
+        current = int(now / self.tick)
+        due = []
+        with self._lock:
+            # Visit each slot passed since the last call, at most one turn
+            for n in range(max(self._last, current - len(self.slots) + 1), current + 1):
+                slot = self.slots[n % len(self.slots)]
+                for timer in [t for t in slot if t[0] <= now]:
+                    slot.remove(timer)
+                    due.append(timer)
+            self._last = current
+        for timer in sorted(due, key=lambda t: t[0]):
+            timer[1]()
+
+
+class WellControl(Thread):
+    """
+    Edge driven well pump supervision.
+    The thread sleeps until an edge on the control or motor input, or
+    until the next deadline on the timer wheel. A fault on the control
+    input starts the restart deadline; when it expires the pump
+    controller is reset, by releasing the output or with a momentary
+    pulse. Without edge detection the inputs are polled every POLL_SECS.
+    """
+
+    def __init__(self, gpio, wheel):
+        Thread.__init__(self)
+        self.daemon = True
+        self.gpio = gpio
+        self.wheel = wheel
+        self.options = well_options()
+        self.wake = Event()
+        self.edges = False  # Edge callbacks registered for both inputs
+        self.fault = False
+        self.motor = None
+        self.restart = None  # Restart deadline while in fault
+        self.pulse = None
+
+    def setup(self):
+        self.gpio.setwarnings(False)
+        self.gpio.setmode(self.gpio.BOARD)
+        self.gpio.setup(PIN_CONTROL, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.gpio.setup(PIN_MOTOR, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+        self.gpio.setup(PIN_RESET, self.gpio.OUT)
+        self.reset_output(False)  # Set output initial resting state
+        self.edges = True
+        for pin in (PIN_CONTROL, PIN_MOTOR):
+            try:
+                self.gpio.add_event_detect(
+                    pin, self.gpio.BOTH, callback=self._edge, bouncetime=BOUNCE_MS
+                )
+            except RuntimeError as e:
+                print(u"Well plugin: edge detection not available, polling inputs:", e)
+                self.edges = False
+
+    def _edge(self, pin):
+        self.wake.set()
+
+    def update(self):
+        self.options = well_options()
+        self.wake.set()
+
+    def reset_output(self, active):
+        """Drive the pump control reset output active or idle"""
+        high = active == (self.options[u"out_act"] == u"high")
+        self.gpio.output(PIN_RESET, 1 if high else 0)
+
+    def remaining(self):
+        """Seconds left before the pump is restarted, None if not in fault"""
+        restart = self.restart
+        if restart is None:
+            return None
+        return self.wheel.remaining(restart)
+
+    def check(self):
+        """Act on the current input levels"""
+        level = self.gpio.input(PIN_CONTROL)
+        fault = level == (1 if self.options[u"in_act"] == u"high" else 0)
+        if fault and not self.fault:
+            if self.options[u"stns"] == u"on":
+                stop_stations()  # Stop irrigating (if enabled in options)
+            if self.options[u"moment"] == u"off":
+                self.reset_output(True)
+            self.restart = self.wheel.schedule(
+                float(self.options[u"time"]) * 60, self.restart_pump
+            )
+        elif not fault and self.restart is not None:
+            self.wheel.cancel(self.restart)
+            self.restart = None
+        self.fault = fault
+        self.motor = self.gpio.input(PIN_MOTOR) == 0
+
+    def restart_pump(self):
+        self.restart = None
+        self.fault = False  # Start a new countdown if the fault persists
+        if self.options[u"moment"] == u"on":
+            self.reset_output(True)
+            self.pulse = self.wheel.schedule(PULSE_SECS, self.end_pulse)
+        else:
+            self.reset_output(False)
+
+    def end_pulse(self):
+        self.pulse = None
+        self.reset_output(False)
+
+    def step(self, timeout=None):
+        """Wait for an edge or the next deadline, then act on it"""
+        self.wake.wait(timeout)
+        self.wake.clear()
+        self.wheel.advance()
+        self.check()
+
+    def next_timeout(self):
+        """How long step() may wait: until the next deadline, or one poll"""
+        timeout = self.wheel.next_delay()
+        if not self.edges and (timeout is None or timeout > POLL_SECS):
+            timeout = POLL_SECS
+        return timeout
+
+    def run(self):
+        self.setup()
+        self.check()
+        while True:
+            self.step(self.next_timeout())
+
+
+class RestartFooter(showInFooter):
+    """Footer item whose value is worked out when the page asks for it"""
+
+    @property
+    def val(self):
+        remaining = control.remaining()
+        if remaining is None:
+            return u"OK"
+        return str(round(remaining / 60.0, 1)) + u" mins"
+
+    @val.setter
+    def val(self, value):
+        pass
+
+
+class PumpFooter(showInFooter):
+    @property
+    def val(self):
+        if control.motor is None:
+            return u"NA"
+        return u"RUNNING" if control.motor else u"STOPPED"
+
+    @val.setter
+    def val(self, value):
+        pass
+
+
+wheel = TimerWheel()
+control = WellControl(GPIO, wheel)
+
+pump = PumpFooter() #  instantiate class to enable data in footer
 pump.label = u"Well pump"
-pump.val = ('NA')
 pump.unit = u" "
 
-pump_restart = showInFooter()  #  instantiate class to enable data in footer
+pump_restart = RestartFooter()  #  instantiate class to enable data in footer
 pump_restart.label = u"Starting control "
-pump_restart.val = ('working')
 pump_restart.unit = u" "
 
-options = well_options()
-well_dry = False # Use for future latching operation
-
-def outhi():
-    return GPIO.output(37,1)
-
-def outlo():
-    return GPIO.output(37,0)
-
-def prog():
-    pump_restart.countdown = float(options["time"])
-    GPIO.setwarnings(False)
-    GPIO.setmode(GPIO. BOARD)
-    GPIO.setup(33, GPIO.IN,pull_up_down=GPIO.PUD_UP) # pump control input
-    GPIO.setup(35, GPIO.IN,pull_up_down=GPIO.PUD_UP) # motor running input
-    GPIO.setup(37, GPIO.OUT) # pump control reset
-    # Set output initial resting state
-    if options["out_act"] == ("high"):
-        outlo()
-    else:
-        outhi()
-    while True: #  Display simulated plugin data
-        if ((options["in_act"] == "high") and (GPIO.input(33) == 1)) or (GPIO.input(33) == 0):
-#          while (well_dry): # Use for future latching
-            if (options["stns"] == ("on")):
-                stop_stations()  # Stop irrigating (if enabled in options)
-            if options["moment"] == ("off"):
-                if options["out_act"] == ("high"):
-                    outhi()
-                else:
-                    outlo()
-            sleep(1)
-            pump_restart.countdown -= 0.0166 #  update plugin data 1
-            pump_restart.val = str(round(pump_restart.countdown,1))+(' mins')
-            if pump_restart.countdown <= 0.0:
-                pump_restart.countdown = float(options["time"])
-                pump_restart.val = ('OK')
-                if options["moment"] == ("off"):
-                    if options["out_act"] == ("high"):
-                        outlo()
-                    else:
-                        outhi()
-                if options["moment"] == ("on"):
-                    if options["out_act"] == ("high"):
-                        outhi()
-                        sleep(2)
-                        outlo()
-                    else:
-                        outlo()
-                        sleep(2)
-                        outhi()
-                       well_dry = False
-        else:
-            pump_restart.countdown = float(options["time"])       
-            pump_restart.val = ('OK')
 
-# -------------- Motor status information ------------------- #
-        if GPIO.input(35) == 0: 
-            pump.val = ('RUNNING') #+= 40 #  update plugin data 2
-        else:
-            pump.val = ('STOPPED') #+= 1          
-#-------------------------------------------------------------#
+### Stop new runs while the well is in fault ###
+def notify_zone_change(name, **kw):
+    if control.fault and control.options[u"stns"] == u"on" and any(gv.srvals):
+        stop_stations()
+
 
-    sleep(1)        
+zones = signal(u"zone_change")
+zones.connect(notify_zone_change)
 
-# Run data_test() in baskground thread
-ft = Thread(target = prog)
-ft.daemon = True
-ft.start()
+control.start()
 
 #################################
 
@@ -209,5 +415,5 @@ class save_settings(ProtectedPage):
             qdict["out_act"] = "low"
         with open("./data/well.json", "w") as f:  # write the settings to file
             json.dump(qdict, f)
-#        checker.update()
+        control.update()
         raise web.seeother(u"/")